@@ -0,0 +1,192 @@
+"""asyncio interface of the pipeline for services running an event loop.
+Blocking work runs on an executor, progress is delivered through async
+iterators and runs are cancelled cooperatively: the worker checks for
+cancellation after each stage and frame (see the progress parameter of the
+functions in main). At most max_concurrent movies are processed at once, so
+that a burst of requests cannot exhaust the memory. Each run has its own FFT
+settings (fourier.settings) and copy tracking stages, so concurrent runs
+don't change each other's."""
+import asyncio
+import contextvars
+import functools
+import threading
+import fourier
+import main
+
+
+class Cancelled(Exception):
+    """Raised inside of the worker to abort a cancelled run"""
+
+
+def _with_settings(call, fft_backend=None, fft_workers=None):
+    """Calls call with the FFT settings of a run"""
+    with fourier.settings(fft_backend, fft_workers):
+        return call()
+
+
+class Job:
+    """One run of a blocking pipeline function. Awaiting the job returns the
+    result of the function, iterating it with async for yields progress
+    events (stage, done, total) until the run finishes.
+    """
+
+    def __init__(self, function, kwargs, executor, limiter,
+                 fft_backend=None, fft_workers=None):
+        """Must be created in a running event loop, see Pipeline.
+        :param fft_backend: FFT backend used by the run, None - the one of
+            the creating context
+        :param fft_workers: FFT threads used by the run, None - as in the
+            creating context
+        """
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._cancelled = threading.Event()
+        call = functools.partial(function, progress=self._progress, **kwargs)
+        # the executor thread starts from a copy of the creating context
+        # with the settings of this run
+        self._call = functools.partial(contextvars.copy_context().run,
+                                       _with_settings, call, fft_backend,
+                                       fft_workers)
+        self._executor = executor
+        self._limiter = limiter
+        self._task = self._loop.create_task(self._run())
+
+    def _progress(self, stage, done, total):
+        """Called from the worker thread"""
+        if self._cancelled.is_set():
+            raise Cancelled()
+        self._loop.call_soon_threadsafe(self._events.put_nowait,
+                                        (stage, done, total))
+
+    async def _run(self):
+        try:
+            async with self._limiter:
+                if self._cancelled.is_set():
+                    raise Cancelled()
+                future = self._loop.run_in_executor(self._executor,
+                                                    self._call)
+                try:
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the worker stops at its next check point and only then
+                    # is its slot given to another run
+                    self._cancelled.set()
+                    try:
+                        await future
+                    except Exception:
+                        pass
+                    raise
+        except Cancelled:
+            raise asyncio.CancelledError()
+        finally:
+            self._events.put_nowait(None)
+
+    def cancel(self):
+        """Requests cancellation, awaiting the job then raises
+        asyncio.CancelledError"""
+        self._cancelled.set()
+        self._task.cancel()
+
+    def cancelled(self):
+        return self._task.cancelled()
+
+    def done(self):
+        return self._task.done()
+
+    def __await__(self):
+        return self._task.__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._events.get()
+        if event is None:
+            # repeated iteration ends at once as well
+            self._events.put_nowait(None)
+            raise StopAsyncIteration
+        return event
+
+
+class Pipeline:
+    """Asynchronous entry points of the pipeline sharing one executor and one
+    concurrency limit.
+    """
+
+    def __init__(self, executor=None, max_concurrent=1, fft_backend=None,
+                 fft_workers=None):
+        """
+        :param executor: concurrent.futures executor on which the blocking
+            work runs, None - default executor of the event loop (thread
+            pool; process pools cannot be used as progress and cancellation
+            are shared with the worker)
+        :param max_concurrent: maximal number of runs processed at once,
+            further runs wait for a free slot
+        :param fft_backend: FFT backend of the runs (see fourier.settings),
+            None - the one of the context starting them
+        :param fft_workers: FFT threads of each run, None - as in the context
+            starting them (e.g. cpu count / max_concurrent avoids
+            oversubscription)
+        """
+        if max_concurrent < 1:
+            raise ValueError("At least one concurrent run is needed, not " +
+                             str(max_concurrent))
+        self.executor = executor
+        self.limiter = asyncio.Semaphore(max_concurrent)
+        self.fft_backend = fft_backend
+        self.fft_workers = fft_workers
+
+    def _job(self, function, kwargs):
+        return Job(function, kwargs, self.executor, self.limiter,
+                   self.fft_backend, self.fft_workers)
+
+    def motion_correct_files(self, **kwargs):
+        """Starts main.motion_correct_files with the keyword arguments
+        (verbose is False by default).
+        :return: Job whose result is the corrected image"""
+        kwargs.setdefault("verbose", False)
+        return self._job(main.motion_correct_files, kwargs)
+
+    def motion_correct_movie(self, movie, **kwargs):
+        """Starts main.motion_correct_movie of already loaded movie.
+        :return: Job whose result is the corrected image"""
+        kwargs.setdefault("verbose", False)
+        kwargs["movie"] = movie
+        return self._job(main.motion_correct_movie, kwargs)
+
+    def deform_file(self, **kwargs):
+        """Starts main.deform_file with the keyword arguments (verbose is
+        False by default). When the job is cancelled, the partially written
+        movie is removed.
+        :return: Job whose result is ([images], coefficients)"""
+        kwargs.setdefault("verbose", False)
+        return self._job(main.deform_file, kwargs)
+
+    async def deform_file_stream(self, **kwargs):
+        """Asynchronous variant of main.deform_file_stream, each frame is
+        computed on the executor when it is requested, so the generation is
+        cancelled simply by not iterating further. Only the current frame is
+        in memory, therefore the concurrency limit is not applied.
+        :return: (frames, coefficients) - frames is async generator of
+            (t, numpy array)"""
+        kwargs.setdefault("verbose", False)
+        loop = asyncio.get_running_loop()
+        # frames are computed one after another, so they can share a context
+        context = contextvars.copy_context()
+
+        def run(call):
+            return loop.run_in_executor(self.executor, functools.partial(
+                context.run, _with_settings, call, self.fft_backend,
+                self.fft_workers))
+
+        frames, coeffs = await run(functools.partial(main.deform_file_stream,
+                                                     **kwargs))
+
+        async def iterate():
+            while True:
+                item = await run(functools.partial(next, frames, None))
+                if item is None:
+                    return
+                yield item
+
+        return iterate(), coeffs
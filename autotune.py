@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""Chooses alignment parameters so that correction of one movie fits into a
+time budget on this machine. Costs of the individual stages are estimated
+from short calibration probes (one correlation, one warp, one model fit) and
+the combination of parameters with the lowest expected error (see
+expected_error) within the budget is chosen. The
+chosen profile is saved as json and reused while the movie geometry and the
+budget stay the same."""
+import itertools
+import json
+import os
+import os.path
+import sys
+import time
+import warnings
+import numpy as np
+import fourier
+from image import Image
+from movie import Movie
+from deformation_model import DeformationModel
+
+# candidate values
+BINNINGS = (1, 2, 4)
+PARTITIONS_SIZES = (5, 4, 3)
+ITERATIONS = (10, 5, 3)
+
+
+def _best_time(fnc, repeats=3):
+    """Shortest of several runs of fnc in seconds"""
+    best = float("inf")
+    for i in range(repeats):
+        start = time.perf_counter()
+        fnc()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def probe_correlation(shape, max_shift, workers):
+    """Duration of one alignment step (correlation of shape data) with the
+    given number of FFT threads"""
+    rng = np.random.default_rng(0)
+    main = rng.random(shape)
+    template = rng.random(shape)
+    my = min(max_shift or shape[0], shape[0] - 1)
+    mx = min(max_shift or shape[1], shape[1] - 1)
+    with fourier.settings(workers=workers):
+        return _best_time(lambda: fourier.correlate(main, template, (my, mx)))
+
+
+def probe_warp(shape=(128, 128)):
+    """Duration of restoration of one pixel"""
+    img = Image(time_stamp=0, img_data=np.random.default_rng(0).random(shape))
+    model = DeformationModel()
+    model.coeffs = DeformationModel.generate_random_coeffs(shape, 1)
+    duration = _best_time(lambda: model.apply_model(img, 1, 0))
+    return duration / img.image_data.size
+
+
+def probe_fit(point_count, max_points=500):
+    """Duration of the model fit from point_count local shifts (measured on
+    at most max_points and scaled linearly)"""
+    count = min(point_count, max_points)
+    rng = np.random.default_rng(0)
+    positions = [(y, x, t) for y, x, t in rng.random((count, 3)) * 100]
+    shifts = list(rng.random(count))
+    model = DeformationModel()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        duration = _best_time(lambda: model.initialize_model(
+            positions, shifts, shifts), 1)
+    return duration * point_count / count
+
+
+def expected_error(binning, partitions_size, iterations):
+    """Rough expected error (in pixels of the frames) of the local shifts
+    described by the model, used to rank the candidates. Shifts are integer
+    in the binned pixels, so each local shift has uniform error of
+    binning / sqrt(12), which the fit averages over partitions_size ** 2
+    shifts per frame (6 spatial coefficients). Each sweep of the alignment is
+    assumed to halve the misalignment left by the previous one (starting from
+    one binned pixel)."""
+    quantization = binning / np.sqrt(12)
+    fit = quantization / np.sqrt(partitions_size ** 2 / 6)
+    return fit + binning * 0.5 ** iterations
+
+
+def estimate_seconds(frame_shape, frame_count, binning, partitions_size,
+                     iterations, search_window, workers, probes):
+    """Estimated duration of correction of one movie.
+    :param probes: dictionary used to cache results of the probes"""
+    def cached(key, fnc, *args):
+        if key not in probes:
+            probes[key] = fnc(*args)
+        return probes[key]
+
+    shape = (frame_shape[0] // binning, frame_shape[1] // binning)
+    patch = (shape[0] // partitions_size, shape[1] // partitions_size)
+    correlation = cached(("corr", shape, workers), probe_correlation,
+                         shape, None, workers)
+    patch_correlation = cached(("corr", patch, search_window, workers),
+                               probe_correlation, patch, search_window,
+                               workers)
+    points = frame_count * partitions_size * partitions_size
+    fit = cached(("fit", points), probe_fit, points)
+    warp = cached(("warp",), probe_warp)
+
+    return iterations * frame_count * correlation + \
+        iterations * points * patch_correlation + fit + \
+        frame_count * shape[0] * shape[1] * warp
+
+
+def autotune(frame_shape, frame_count, target_seconds, profile_path=None,
+             search_window=8, verbose=False):
+    """Chooses parameters for movies of frame_count frames of frame_shape, so
+    that their correction takes at most target_seconds.
+    :param profile_path: None or path to json file where is the profile saved
+        and from which is it reused when it was tuned for the same arguments
+    :return: profile (dictionary) usable by apply_profile"""
+    frame_shape = [int(s) for s in frame_shape]
+    if profile_path is not None and os.path.exists(profile_path):
+        profile = load_profile(profile_path)
+        if profile["frame_shape"] == frame_shape and \
+                profile["frame_count"] == frame_count and \
+                profile["target_seconds"] == target_seconds:
+            return profile
+
+    probes = {}
+    shape = tuple(frame_shape)
+    worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    for w in worker_counts:
+        probes[("corr", shape, w)] = probe_correlation(shape, None, w)
+    workers = min(worker_counts, key=lambda w: probes[("corr", shape, w)])
+
+    candidates = []
+    for binning, partitions_size, iterations in itertools.product(
+            BINNINGS, PARTITIONS_SIZES, ITERATIONS):
+        seconds = estimate_seconds(frame_shape, frame_count, binning,
+                                   partitions_size, iterations, search_window,
+                                   workers, probes)
+        error = expected_error(binning, partitions_size, iterations)
+        candidates.append((seconds, binning, partitions_size, iterations,
+                           error))
+        if verbose:
+            print("binning: {1} partitions: {2} iterations: {3} | "
+                  "{0:.2f}s error: {4:.3f}px".format(*candidates[-1]))
+
+    # the most accurate candidate within the budget (the faster one on ties),
+    # otherwise the fastest one
+    fitting = [c for c in candidates if c[0] <= target_seconds]
+    if fitting:
+        chosen = min(fitting, key=lambda c: (c[4], c[0]))
+    else:
+        chosen = min(candidates)
+    if chosen[0] > target_seconds:
+        warnings.warn("No parameters fit into " + str(target_seconds) +
+                      "s, the fastest ones take " + str(chosen[0]) + "s.")
+
+    profile = {"frame_shape": frame_shape,
+               "frame_count": frame_count,
+               "target_seconds": target_seconds,
+               "estimated_seconds": chosen[0],
+               "binning": chosen[1],
+               "partitions_size": chosen[2],
+               "max_iterations": chosen[3],
+               "shift_threshold": Movie().shift_threshold,
+               "local_search_window": search_window,
+               "fft_workers": workers}
+    if profile_path is not None:
+        save_profile(profile, profile_path)
+    return profile
+
+
+def apply_profile(movie, profile):
+    """Sets alignment parameters of the profile to the movie, its binning is
+    used only for the alignment, so the restored images and the coefficients
+    keep the resolution of the frames.
+    :return: context manager selecting the FFT threads of the profile for
+        the current thread (see fourier.settings)"""
+    movie.partitions_size = profile["partitions_size"]
+    movie.max_iterations = profile["max_iterations"]
+    movie.shift_threshold = profile["shift_threshold"]
+    movie.local_search_window = profile["local_search_window"]
+    movie.alignment_binning = profile["binning"]
+    return fourier.settings(workers=profile["fft_workers"])
+
+
+def save_profile(profile, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_profile(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    # usage: autotune.py height width frame_count target_seconds [profile]
+    print(json.dumps(autotune((int(sys.argv[1]), int(sys.argv[2])),
+                              int(sys.argv[3]), float(sys.argv[4]),
+                              sys.argv[5] if len(sys.argv) > 5 else None,
+                              verbose=True), indent=2))
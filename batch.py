@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+"""Motion correction of many movies by several nodes sharing one filesystem
+(e.g. NFS) without any scheduler. The work folder contains:
+    jobs.jsonl      - one job (movie) per line, written by submit_jobs
+    locks/NAME      - lease of the node processing job NAME, its modification
+                      time is renewed by heartbeats while the job runs
+    done/NAME.json  - completion marker
+    failed/NAME.txt - failure marker with the traceback
+    output/NAME.mrc - corrected sum
+Leases not renewed for lease_time seconds are considered abandoned by crashed
+nodes and are reclaimed. lease_time has to be considerably longer than the
+heartbeat period and the clock skew between the nodes."""
+import json
+import os
+import os.path
+import random
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from image import Image
+from main import motion_correct_files
+
+
+def submit_jobs(work_path, jobs):
+    """Creates work folder with jobs.
+    :param jobs: list of dictionaries with keys name (unique, usable as file
+        name), paths and time_points (see main.motion_correct_files) and
+        optionally options (other keyword arguments of motion_correct_files)
+    """
+    names = [j["name"] for j in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names are not unique.")
+
+    for folder in ("locks", "done", "failed", "output"):
+        os.makedirs(os.path.join(work_path, folder), exist_ok=True)
+
+    tmp_path = os.path.join(work_path, "jobs.jsonl.tmp")
+    with open(tmp_path, "w") as f:
+        for j in jobs:
+            f.write(json.dumps(j) + "\n")
+    os.replace(tmp_path, os.path.join(work_path, "jobs.jsonl"))
+
+
+def correct_job(job, output_path):
+    """Default job processing, corrected sum is saved as mrc file"""
+    res = motion_correct_files(job["paths"], job["time_points"],
+                               verbose=False, **job.get("options", {}))
+    img = Image(time_stamp=0, img_data=res)
+    tmp_path = output_path + ".tmp.mrc"
+    img.save_mrc(tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+class BatchRunner:
+    """One node processing jobs from the shared work folder."""
+
+    def __init__(self, work_path, node_id=None, lease_time=300.0,
+                 poll_interval=None, process=correct_job):
+        """
+        :param work_path: work folder created by submit_jobs
+        :param node_id: name of the node used in markers, None - host name and
+            process id
+        :param lease_time: seconds after which is a lease without heartbeat
+            considered abandoned
+        :param poll_interval: seconds between checks of jobs leased by other
+            nodes, None - lease_time / 3
+        :param process: function(job, output_path) processing one job
+        """
+        self.work_path = work_path
+        self.node_id = node_id or socket.gethostname() + "-" + str(os.getpid())
+        self.lease_time = lease_time
+        self.heartbeat_interval = lease_time / 3
+        self.poll_interval = poll_interval or lease_time / 3
+        self.process = process
+
+    def _path(self, folder, name):
+        return os.path.join(self.work_path, folder, name)
+
+    def jobs(self):
+        with open(os.path.join(self.work_path, "jobs.jsonl")) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def finished(self, name):
+        return os.path.exists(self._path("done", name + ".json")) or \
+            os.path.exists(self._path("failed", name + ".txt"))
+
+    def claim(self, name):
+        """Tries to acquire lease of the job.
+        :return: token of the lease or None when the job is leased by another
+            node"""
+        lock_path = self._path("locks", name)
+        token = self.node_id + " " + uuid.uuid4().hex
+        for attempt in range(2):
+            try:
+                # O_EXCL creation is atomic, only one node succeeds
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt == 0 and self.reclaim(lock_path):
+                    continue
+                return None
+            with os.fdopen(fd, "w") as f:
+                f.write(token)
+            return token
+        return None
+
+    def reclaim(self, lock_path):
+        """Removes lease which was not renewed for lease_time.
+        :return: True when the lease was removed"""
+        try:
+            if time.time() - os.stat(lock_path).st_mtime < self.lease_time:
+                return False
+            # rename is atomic, so only one of the reclaiming nodes gets it
+            stolen = lock_path + "." + uuid.uuid4().hex
+            os.rename(lock_path, stolen)
+        except FileNotFoundError:
+            return False
+
+        if time.time() - os.stat(stolen).st_mtime < self.lease_time:
+            # lease was renewed (or created anew) in the meantime, return it
+            # unless the lock was already taken by someone else
+            try:
+                os.link(stolen, lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stolen)
+            return False
+
+        os.remove(stolen)
+        return True
+
+    def owns(self, name, token):
+        try:
+            with open(self._path("locks", name)) as f:
+                return f.read() == token
+        except FileNotFoundError:
+            return False
+
+    def release(self, name, token):
+        """Removes the lease when it is still owned by token.
+        :return: True when the lease was removed"""
+        lock_path = self._path("locks", name)
+        # the lease is moved away first, so that a lease created by another
+        # node between the check and the removal cannot be removed
+        released = lock_path + "." + uuid.uuid4().hex
+        try:
+            os.rename(lock_path, released)
+        except FileNotFoundError:
+            return False
+        with open(released) as f:
+            owned = f.read() == token
+        if not owned:
+            # lease of another node, return it unless a new one was created
+            try:
+                os.link(released, lock_path)
+            except FileExistsError:
+                pass
+        os.remove(released)
+        return owned
+
+    def _heartbeat(self, name, token, stop, lost):
+        """Renews the lease until stop is set, lost is set when the lease was
+        reclaimed by another node"""
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                if not self.owns(name, token):
+                    lost.set()
+                    return
+                os.utime(self._path("locks", name))
+            except FileNotFoundError:
+                # removed by a reclaiming node between the check and utime
+                lost.set()
+                return
+
+    def run_job(self, job, token):
+        name = job["name"]
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(name, token, stop, lost),
+                                     daemon=True)
+        heartbeat.start()
+        start = time.time()
+        try:
+            self.process(job, self._path("output", name + ".mrc"))
+        except Exception:
+            marker = self._path("failed", name + ".txt")
+            content = self.node_id + "\n" + traceback.format_exc()
+        else:
+            marker = self._path("done", name + ".json")
+            content = json.dumps({"node": self.node_id,
+                                  "duration": time.time() - start})
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if lost.is_set() or not self.owns(name, token):
+            # lease was reclaimed by another node, which will finish the job
+            return False
+
+        tmp_path = marker + "." + uuid.uuid4().hex
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, marker)
+        self.release(name, token)
+        return True
+
+    def run(self, wait=True):
+        """Processes jobs until all of them are finished.
+        :param wait: True - when the remaining jobs are leased by other nodes,
+            waits for them to finish (or to be abandoned and reclaimed),
+            False - returns immediately
+        :return: list of names of jobs finished by this node"""
+        jobs = self.jobs()
+        # different order on each node lowers contention on the locks
+        random.Random(self.node_id).shuffle(jobs)
+
+        processed = []
+        while True:
+            remaining = [j for j in jobs if not self.finished(j["name"])]
+            if not remaining:
+                break
+
+            progress = False
+            for job in remaining:
+                if self.finished(job["name"]):
+                    continue
+                token = self.claim(job["name"])
+                if token is None:
+                    continue
+                if self.finished(job["name"]):  # finished before our claim
+                    self.release(job["name"], token)
+                    continue
+
+                if self.run_job(job, token):
+                    processed.append(job["name"])
+                progress = True
+
+            if not progress:
+                if not wait:
+                    break
+                time.sleep(self.poll_interval)
+
+        return processed
+
+
+if __name__ == "__main__":
+    # usage: batch.py work_folder [lease_time]
+    runner = BatchRunner(sys.argv[1], lease_time=float(sys.argv[2])
+                         if len(sys.argv) > 2 else 300.0)
+    print("Processed:", len(runner.run()))
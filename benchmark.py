@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""End-to-end accuracy versus throughput benchmark. Movies are generated by
+deforming a synthetic image with known coefficients, then the whole motion
+correction pipeline is run on them and its wall time, peak memory and errors
+against the ground truth are recorded."""
+import itertools
+import json
+import os
+import os.path
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from scipy import ndimage
+from image import Image
+from movie import Movie
+from deformation_model import DeformationModel
+from main import motion_correct_movie
+import mrc_io
+
+
+def synthetic_image(shape, rng):
+    """Smooth random texture with a grid over it, so that both global and
+    local alignment have something to lock on to."""
+    img = Image()
+    img.time_stamp = 0
+    data = ndimage.gaussian_filter(rng.standard_normal(shape), 2)
+    img.image_data = (data - data.min()) / (data.max() - data.min()) * 255
+    img.add_grid(grid_spacing=max(shape) // 8)
+    return img
+
+
+def deformed_movie(img, time_points, coeffs, noise, rng):
+    """Movie of img deformed by model with coeffs and with added gaussian noise
+    with standard deviation noise * (standard deviation of img)."""
+    model = DeformationModel()
+    model.coeffs = coeffs
+    sigma = noise * np.std(img.image_data)
+
+    movie = Movie()
+    for t in time_points:
+        frame = model.apply_model(img, 0, t)
+        if sigma > 0:
+            frame.image_data = frame.image_data + \
+                rng.normal(0, sigma, frame.shape())
+        movie.add(frame)
+    return movie
+
+
+def displacement_error(shape, time_points, true_coeffs, coeffs, global_shifts,
+                       samples=16):
+    """Root mean square error (in pixels) of the estimated displacement of
+    pixels in relation to the first frame. Estimated displacement consists of
+    the global shift and of the fitted model.
+    :param samples: number of sampled positions along each axis"""
+    true_model = DeformationModel()
+    true_model.coeffs = true_coeffs
+    model = DeformationModel()
+    model.coeffs = coeffs
+
+    y, x = np.meshgrid(np.linspace(0, shape[0] - 1, samples),
+                       np.linspace(0, shape[1] - 1, samples), indexing="ij")
+    t0 = time_points[0]
+
+    total = 0.0
+    for i, t in enumerate(time_points):
+        for axis in range(2):
+            true = true_model.calculate_shift(y, x, t, axis) - \
+                true_model.calculate_shift(y, x, t0, axis)
+            estimated = (model.calculate_shift(y, x, t, axis) -
+                         global_shifts[axis][i]) - \
+                (model.calculate_shift(y, x, t0, axis) -
+                 global_shifts[axis][0])
+            total += np.sum((true - estimated) ** 2)
+
+    return (total / (len(time_points) * 2 * samples * samples)) ** 0.5
+
+
+def image_error(reference, result, margin=0.1):
+    """Root mean square error between reference and result normalized by the
+    standard deviation of reference. Border of relative width margin is
+    ignored, because it is not present in all frames."""
+    my = int(reference.shape[0] * margin)
+    mx = int(reference.shape[1] * margin)
+    reference = reference[my:reference.shape[0] - my,
+                          mx:reference.shape[1] - mx]
+    result = result[my:result.shape[0] - my, mx:result.shape[1] - mx]
+    return float(np.sqrt(np.mean((reference - result) ** 2)) /
+                 np.std(reference))
+
+
+def run_case(shape, frame_count, noise, seed=0, time_step=0.5):
+    """Generates one movie and runs the pipeline on it.
+    :return: dictionary with the case parameters and measured values"""
+    rng = np.random.default_rng(seed)
+    time_points = [i * time_step for i in range(frame_count)]
+    img = synthetic_image(shape, rng)
+    true_coeffs = DeformationModel.generate_random_coeffs(
+        shape, max(time_points), rng)
+    movie = deformed_movie(img, time_points, true_coeffs, noise, rng)
+    simple_sum = movie.sum_images()
+
+    report = {}
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = motion_correct_movie(movie, verbose=False, report=report)
+    wall_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"shape": list(shape),
+            "frames": frame_count,
+            "noise": noise,
+            "seed": seed,
+            "wall_time": wall_time,
+            "stage_times": report["timings"],
+            "peak_memory": peak,
+            "displacement_error": displacement_error(
+                shape, time_points, true_coeffs, report["coeffs"],
+                report["global_shifts"]),
+            "simple_error": image_error(img.image_data,
+                                        simple_sum / frame_count),
+            "restored_error": image_error(img.image_data,
+                                          result / frame_count)}
+
+
+def run_benchmark(shapes=((64, 64), (128, 128)), frame_counts=(5, 10),
+                  noises=(0.0, 0.5), seed=0, output_path=None,
+                  verbose=True):
+    """Runs run_case for all combinations of shapes, frame_counts and noises.
+    :param output_path: None or path to json lines file where the results
+        are written
+    :return: list of results of run_case"""
+    results = []
+    for shape, frame_count, noise in itertools.product(shapes, frame_counts,
+                                                       noises):
+        res = run_case(shape, frame_count, noise, seed)
+        results.append(res)
+        if verbose:
+            print("{0[0]}x{0[1]} frames: {1:3d} noise: {2:.2f} | "
+                  "time: {3:8.2f}s memory: {4:8.1f}MB | "
+                  "displacement: {5:6.2f}px image: {6:.3f} (simple {7:.3f})"
+                  .format(shape, frame_count, noise, res["wall_time"],
+                          res["peak_memory"] / 2**20,
+                          res["displacement_error"], res["restored_error"],
+                          res["simple_error"]))
+
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            for res in results:
+                f.write(json.dumps(res) + "\n")
+
+    return results
+
+
+def run_io_benchmark(shape=(1024, 1024), frame_count=20,
+                     formats=tuple(mrc_io.FORMATS),
+                     compressions=(None, "gzip", "bzip2"), seed=0,
+                     verbose=True):
+    """Writes and reads a noisy synthetic movie in all combinations of formats
+    and compressions.
+    :return: list of dictionaries with format, compression, size (bytes),
+        write and read time (seconds) and maximal error relative to the data
+        range"""
+    rng = np.random.default_rng(seed)
+    img = synthetic_image(shape, rng)
+    data = img.image_data + rng.normal(0, 10, (frame_count,) + tuple(shape))
+    data_range = np.max(data) - np.min(data)
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for data_format, compression in itertools.product(formats,
+                                                          compressions):
+            path = os.path.join(folder, "movie.mrc")
+            start = time.perf_counter()
+            mrc_io.write(path, data, data_format, compression)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            loaded = mrc_io.read(path)
+            read_time = time.perf_counter() - start
+
+            res = {"format": data_format,
+                   "compression": compression,
+                   "size": os.path.getsize(path),
+                   "write_time": write_time,
+                   "read_time": read_time,
+                   "error": float(np.max(np.abs(loaded - data)) / data_range)}
+            results.append(res)
+            os.remove(path)
+            if verbose:
+                print("{format:8s} {0:6s} | size: {1:8.1f}MB write: "
+                      "{write_time:6.2f}s read: {read_time:6.2f}s | "
+                      "error: {error:.2e}".format(
+                          str(compression), res["size"] / 2**20, **res))
+
+    return results
+
+
+if __name__ == "__main__":
+    # usage: benchmark.py [output.jsonl | io]
+    if len(sys.argv) > 1 and sys.argv[1] == "io":
+        run_io_benchmark()
+    else:
+        run_benchmark(output_path=sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+"""Persistent on-disk cache of estimated shifts and model coefficients"""
+import hashlib
+import json
+import os
+import os.path
+import sys
+import tempfile
+import numpy as np
+
+
+class ShiftCache:
+    """Content addressed cache of alignment results. Each entry is a single
+    npz file named by a hash of the input frames, their time points and the
+    alignment parameters, so a rerun of the same movie with the same settings
+    can skip straight to the restoration. When the size of the cache exceeds
+    max_size, the least recently used entries are evicted.
+    """
+
+    def __init__(self, folder_path, max_size=512 * 1024 * 1024):
+        """
+        :param folder_path: folder where the entries are stored (created when
+            it does not exist)
+        :param max_size: maximal size of all entries in bytes
+        """
+        self.folder_path = folder_path
+        self.max_size = max_size
+        os.makedirs(folder_path, exist_ok=True)
+
+    @staticmethod
+    def key(frames, time_points, parameters=None):
+        """Calculates key of the entry.
+        :param frames: list of two dimensional numpy arrays (raw frames)
+        :param time_points: time stamps of the frames
+        :param parameters: dictionary of alignment parameters which influence
+            the result
+        :return: hexadecimal digest"""
+        h = hashlib.sha256()
+        for f in frames:
+            f = np.ascontiguousarray(f)
+            h.update(str((f.dtype.str, f.shape)).encode())
+            h.update(f.tobytes())
+        h.update(json.dumps([float(t) for t in time_points]).encode())
+        h.update(json.dumps(parameters or {}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder_path, key + ".npz")
+
+    def get(self, key):
+        """Returns dictionary with the stored arrays or None when the entry is
+        not present. Access refreshes the entry's position in LRU order."""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                entry = {k: f[k] for k in f.files}
+        except (IOError, ValueError):
+            return None
+
+        os.utime(path)
+        return entry
+
+    def put(self, key, **arrays):
+        """Stores the arrays under the key (e.g. global_shifts, positions,
+        local_shifts, coeffs) and evicts old entries when needed."""
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=self.folder_path)
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        # rename is atomic, so concurrent readers never see a partial entry
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def invalidate(self, key=None):
+        """Removes entry defined by key or the whole cache when key is None."""
+        if key is not None:
+            paths = [self._path(key)]
+        else:
+            paths = [p for p, _, _ in self._entries()]
+
+        for p in paths:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def size(self):
+        """Total size of all entries in bytes"""
+        return sum(s for _, s, _ in self._entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits into
+        max_size"""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(s for _, s, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _entries(self):
+        """[(path, size, last access time)]"""
+        res = []
+        for name in os.listdir(self.folder_path):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.folder_path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            res.append((path, st.st_size, st.st_mtime))
+        return res
+
+
+if __name__ == "__main__":
+    # usage: cache.py folder [clear | size | remove key]
+    cache = ShiftCache(sys.argv[1])
+    command = sys.argv[2] if len(sys.argv) > 2 else "size"
+    if command == "clear":
+        cache.invalidate()
+    elif command == "remove":
+        cache.invalidate(sys.argv[3])
+    elif command == "size":
+        print(cache.size())
+    else:
+        raise ValueError("Unknown command: '" + command + "'")
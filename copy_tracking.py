@@ -0,0 +1,90 @@
+"""Debugging aid counting copies of frame data. Frames are shared as
+read-only views and copied only when they are about to be written (see
+Image.make_writable); such copies and the shifted copies made by
+Movie.correct_for_shift are recorded here under the current stage when
+tracking is enabled. The counts are partial: temporaries of the computations
+(dtype conversions while loading, binned data, warped and interpolated
+arrays of the restoration, Fourier transforms) are not recorded.
+The stage is kept per thread (and asyncio task), so concurrent runs don't mix
+their stages. report gives the counts of the whole process, collect those of
+one run."""
+import contextlib
+import contextvars
+import threading
+import numpy as np
+
+_enabled = False
+_stage = contextvars.ContextVar("copy_tracking_stage", default="other")
+# counts of the innermost collect block of the current context
+_collected = contextvars.ContextVar("copy_tracking_collected", default=None)
+_counts = {}
+_lock = threading.Lock()
+
+
+def enable(enabled=True):
+    """Turns tracking on (or off) and forgets the previous counts"""
+    global _enabled
+    _enabled = enabled
+    reset()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _counts.clear()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Copies made by the current thread inside of the with block are
+    recorded under name (see fourier.bind for work handed to other threads)"""
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+@contextlib.contextmanager
+def collect():
+    """Copies made by the current thread inside of the with block are also
+    counted into the yielded dictionary {stage: (number of copies, copied
+    bytes)}, which is not affected by other threads"""
+    counts = {}
+    token = _collected.set(counts)
+    try:
+        yield counts
+    finally:
+        _collected.reset(token)
+
+
+def _add(counts, name, nbytes):
+    count, total = counts.get(name, (0, 0))
+    counts[name] = (count + 1, total + nbytes)
+
+
+def record(nbytes):
+    """Records one copy of nbytes in the current stage"""
+    if not _enabled:
+        return
+    name = _stage.get()
+    collected = _collected.get()
+    with _lock:
+        _add(_counts, name, nbytes)
+        if collected is not None:
+            _add(collected, name, nbytes)
+
+
+def copy(data):
+    """np.copy which is recorded"""
+    record(data.nbytes)
+    return np.copy(data)
+
+
+def report():
+    """:return: {stage: (number of copies, copied bytes)}"""
+    with _lock:
+        return dict(_counts)
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+"""Generates large synthetic datasets of doming movies with known ground
+truth. Samples are split into shards, each shard is one mrc stack with all
+frames of its samples and a json file describing them (coefficients, time
+points and source image). Shards are generated in parallel processes and a
+shard is finished only when its json file exists, so interrupted generation
+can be restarted and continues with the missing shards. Parameters of the
+dataset are stored next to the shards and a restart with different ones is
+refused, so shards of different datasets are never mixed."""
+import concurrent.futures
+import json
+import os
+import os.path
+import sys
+import numpy as np
+import mrc_io
+from image import Image
+from deformation_model import DeformationModel
+
+
+def sample_rng(seed, sample_index):
+    """Independent random stream for each sample. Sample is therefore the same
+    regardless of the shard size, the number of workers and restarts."""
+    return np.random.default_rng([seed, sample_index])
+
+
+def generate_sample(img, time_points, rng):
+    """Deforms img with randomly generated coefficients.
+    :param img: Image in time 0
+    :param time_points: time points of the generated frames
+    :param rng: numpy.random.Generator used for the coefficients
+    :return: (frames, coeffs) - frames is float32 numpy array
+        [time][y][x]"""
+    model = DeformationModel()
+    model.initialize_model_randomly(img.shape(), max(time_points), rng)
+
+    frames = np.empty((len(time_points),) + img.shape(), dtype=np.float32)
+    for i, t in enumerate(time_points):
+        frames[i] = model.apply_model(img, 0, t).image_data
+    return frames, model.coeffs
+
+
+def shard_name(shard_index):
+    return "shard" + str(shard_index).zfill(5)
+
+
+def load_source(path, shape=None):
+    """Loads source image the same way as main.deform_file does.
+    :param path: path to gray-scale image, None for scipy.misc.face"""
+    if path is None:
+        img = Image()
+        img.load_dummy(0)
+    else:
+        img = Image(path, 0)
+
+    if shape is None:
+        img.shrink_to_reasonable()
+    else:
+        img.resize(shape)
+    return img
+
+
+def generate_shard(folder_path, shard_index, sample_indices, sources, shape,
+                   time_points, seed, data_format="float32", compression=None):
+    """Generates one shard. Written files are renamed to their final names
+    only when complete, json file is the last one.
+    :return: name of the shard"""
+    name = shard_name(shard_index)
+    loaded = {}
+    entries = []
+    stack = []
+    for si in sample_indices:
+        rng = sample_rng(seed, si)
+        source = sources[rng.integers(len(sources))]
+        if source not in loaded:
+            loaded[source] = load_source(source, shape)
+
+        frames, coeffs = generate_sample(loaded[source], time_points, rng)
+        entries.append({"sample": si,
+                        "shard": name,
+                        "first_frame": len(stack) * len(time_points),
+                        "frame_count": len(time_points),
+                        "time_points": list(time_points),
+                        "source": source,
+                        "coeffs": coeffs.tolist()})
+        stack.append(frames)
+
+    # the file appears only when it is complete (also when compressed), so
+    # the shard is either complete or missing
+    mrc_io.write(os.path.join(folder_path, name + ".mrc"),
+                 np.concatenate(stack, axis=0), data_format, compression, 1)
+
+    tmp_path = os.path.join(folder_path, name + ".tmp.json")
+    with open(tmp_path, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, os.path.join(folder_path, name + ".json"))
+
+    return name
+
+
+def shard_is_complete(folder_path, shard_index, sample_indices):
+    """Whether the shard exists and contains exactly sample_indices (a shard
+    at the end of a dataset of other sample_count may be shorter or longer)"""
+    path = os.path.join(folder_path, shard_name(shard_index) + ".json")
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return [e["sample"] for e in json.load(f)] == list(sample_indices)
+
+
+def check_parameters(folder_path, parameters):
+    """Stores parameters of the dataset into the folder, or compares them with
+    the already stored ones when generation is restarted.
+    :raises ValueError: when the folder contains a dataset generated with
+        different parameters"""
+    path = os.path.join(folder_path, "dataset.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+        if stored != parameters:
+            raise ValueError("Folder '" + folder_path + "' contains dataset "
+                             "generated with different parameters: " +
+                             str(stored))
+        return
+
+    if any(name.startswith("shard") for name in os.listdir(folder_path)):
+        raise ValueError("Folder '" + folder_path + "' contains shards of "
+                         "unknown dataset")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(parameters, f)
+    os.replace(tmp_path, path)
+
+
+def generate_dataset(folder_path, sample_count, sources=None, shape=None,
+                     time_points=None, seed=0, shard_size=64, workers=None,
+                     verbose=True, data_format="float32", compression=None):
+    """
+    Generates sample_count deformed movies.
+    :param folder_path: where to save the shards and the manifest
+    :param sample_count: number of generated movies
+    :param sources: list of paths to gray-scale images which are deformed,
+        each sample randomly chooses one of them. None - scipy.misc.face
+    :param shape: (height, width) to which are the sources resized, None is
+        the same as in main.deform_file
+    :param time_points: time points of frames of each movie (None is equal to
+        range(10))
+    :param seed: seed of the whole dataset
+    :param shard_size: number of samples in one shard
+    :param workers: number of processes, None - number of cpus, 1 - everything
+        is generated in the current process
+    :param verbose: True - printing progress
+    :param data_format: format of the shards, one of mrc_io.FORMATS
+    :param compression: compression of the shards: None, "gzip" or "bzip2"
+    :return: path to the manifest (json lines file with entry for each sample)
+    """
+    if time_points is None:
+        time_points = range(10)
+    time_points = [float(t) for t in time_points]
+    if sources is None:
+        sources = [None]
+
+    os.makedirs(folder_path, exist_ok=True)
+    # samples don't depend on their count, so it can differ between runs
+    check_parameters(folder_path, {
+        "sources": sources,
+        "shape": None if shape is None else list(shape),
+        "time_points": time_points, "seed": seed, "shard_size": shard_size,
+        "data_format": data_format, "compression": compression})
+
+    shards = [list(range(start, min(start + shard_size, sample_count)))
+              for start in range(0, sample_count, shard_size)]
+    missing = [i for i in range(len(shards))
+               if not shard_is_complete(folder_path, i, shards[i])]
+    if verbose:
+        print("Generating", len(missing), "of", len(shards), "shards")
+
+    args = [(folder_path, i, shards[i], sources, shape, time_points, seed,
+             data_format, compression) for i in missing]
+    if workers == 1:
+        for a in args:
+            name = generate_shard(*a)
+            if verbose:
+                print("Finished", name)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(generate_shard, *a) for a in args]
+            for f in concurrent.futures.as_completed(futures):
+                name = f.result()
+                if verbose:
+                    print("Finished", name)
+
+    manifest_path = os.path.join(folder_path, "manifest.jsonl")
+    with open(manifest_path, "w") as manifest:
+        for i in range(len(shards)):
+            with open(os.path.join(folder_path, shard_name(i) + ".json")) as f:
+                for entry in json.load(f):
+                    manifest.write(json.dumps(entry) + "\n")
+
+    return manifest_path
+
+
+if __name__ == "__main__":
+    # usage: dataset.py folder sample_count [source_image ...]
+    generate_dataset(sys.argv[1], int(sys.argv[2]), sys.argv[3:] or None)
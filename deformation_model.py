@@ -1,4 +1,5 @@
 """Remembers model of deformation and allows its generation"""
+import json
 import numpy as np
 import my_math
 from image import Image
@@ -17,56 +18,86 @@ class DeformationModel:
     def __init__(self):
         self.coeffs = np.zeros((18, 2))  # c_0 through c_17
 
-    def apply_model(self, original, t1, t2, resolution_scaling_factor=1):
+    def apply_model(self, original, t1, t2, resolution_scaling_factor=1,
+                    binning=1, roi=None):
         """Applies model and calculates other time position
             :param original numpy array representing an image in the time t1
             :param t1 time stamp of the 'original'
             :param t2 time stamp to which should the model move the 'original'
             :param resolution_scaling_factor in how much grater resolution
                 should the deformation be calculated
+            :param binning the result is binned by this factor, only the
+                centres of the output pixels are deformed and sampled from
+                area-averaged 'original' (only its part covered by the
+                deformed roi is binned)
+            :param roi None or (y0, x0, y1, x1) region of the 'original' to
+                which is the result cropped
             :returns numpy array with original image in time t2 base on the
                 model
         """
         img = Image()
         img.time_stamp = t2
 
-        if t1 == t2:
+        if t1 == t2 and binning == 1 and roi is None:
             img.initialize_with_image(original)
             return img
 
-        calc_shift_fnc = self.calculate_shift
-        orig_get_fnc = original.get
-        interp_fnc = my_math.linear_interpolation
-
-        def generate(y, x):
-            """Function describing the transformed image"""
-            realy = y / resolution_scaling_factor
-            realx = x / resolution_scaling_factor
-
-            # move to time t2
-            posy = y + calc_shift_fnc(realy, realx, t2, 0) - \
-                    calc_shift_fnc(realy, realx, t1, 0)
-            posx = x + calc_shift_fnc(realy, realx, t2, 1) - \
-                    calc_shift_fnc(realy, realx, t1, 1)
-
-            x_left = int(posx)   # math.floor(pos[0])
-            x_right = x_left + 1    # math.ceil(pos[0])
-            y_down = int(posy)    # math.floor(pos[1])
-            y_up = y_down + 1       # math.ceil(pos[1])
-
-            v11 = orig_get_fnc(y_down, x_left, resolution_scaling_factor)
-            v12 = orig_get_fnc(y_down, x_right, resolution_scaling_factor)
-            v21 = orig_get_fnc(y_up, x_left, resolution_scaling_factor)
-            v22 = orig_get_fnc(y_up, x_right, resolution_scaling_factor)
-
-            return interp_fnc(y_down, x_left, y_up, x_right, v11, v12, v21, v22,
-                              posy, posx)
-
-        img.image_data = np.fromfunction(np.vectorize(generate),
-                                (original.shape()[0]*resolution_scaling_factor,
-                                 original.shape()[1]*resolution_scaling_factor))
-
-        if resolution_scaling_factor != 1:
+        scaling = resolution_scaling_factor
+        if scaling != 1 and (binning != 1 or roi is not None):
+            raise ValueError("resolution_scaling_factor cannot be combined " +
+                             "with binning or roi.")
+
+        if roi is None:
+            roi = (0, 0) + original.shape()
+        y0, x0, y1, x1 = roi
+        if not (0 <= y0 < y1 <= original.height() and
+                0 <= x0 < x1 <= original.width()):
+            raise ValueError("Region of interest " + str(roi) +
+                             " is outside of the image.")
+
+        # (scaled) full resolution coordinates of centres of output pixels
+        center = (binning - 1) / 2
+        ys = y0 * scaling + np.arange((y1 - y0) * scaling // binning) * \
+            binning + center
+        xs = x0 * scaling + np.arange((x1 - x0) * scaling // binning) * \
+            binning + center
+        y, x = np.meshgrid(ys, xs, indexing="ij")
+        realy = y / scaling
+        realx = x / scaling
+
+        # move to time t2
+        posy = y + self.calculate_shift(realy, realx, t2, 0) - \
+            self.calculate_shift(realy, realx, t1, 0)
+        posx = x + self.calculate_shift(realy, realx, t2, 1) - \
+            self.calculate_shift(realy, realx, t1, 1)
+
+        source = original
+        if binning != 1:
+            posy = (posy - center) / binning
+            posx = (posx - center) / binning
+            # only the binned pixels around the sampled positions are needed
+            # (one more row and column for the interpolation), so the rest of
+            # the frame is not binned
+            top = max(int(math.floor(posy.min())), 0)
+            left = max(int(math.floor(posx.min())), 0)
+            bottom = min(int(math.floor(posy.max())) + 2,
+                         original.height() // binning)
+            right = min(int(math.floor(posx.max())) + 2,
+                        original.width() // binning)
+            if top >= bottom or left >= right:
+                # the whole result is sampled outside of the 'original'
+                img.image_data = np.zeros(posy.shape)
+                return img
+            source = Image()
+            source.image_data = my_math.bin_data(
+                original.image_data[top * binning:bottom * binning,
+                                    left * binning:right * binning], binning)
+            posy -= top
+            posx -= left
+
+        img.image_data = source.gather(posy, posx, "constant", 0.0, scaling)
+
+        if scaling != 1:
             img.image_data = skimage.transform.resize(img.image_data,
                                                       original.shape(),
                                                       preserve_range=True)
@@ -94,6 +125,88 @@ class DeformationModel:
 
         return shift
 
+    def trajectories(self, positions, time_points, reference_time=None,
+                     chunk_size=65536, out=None, dtype=np.float64):
+        """
+        Shifts of many positions in many time points at once.
+        :param positions: (N, 2) array like object with (y, x) positions
+        :param time_points: T time points
+        :param reference_time: None - shifts as returned by calculate_shift,
+            otherwise shifts relative to the shift in reference_time
+        :param chunk_size: number of positions processed at once, temporary
+            memory is proportional to chunk_size * T
+        :param out: None or (N, T, 2) array (e.g. numpy.memmap) into which
+            are the shifts written
+        :param dtype: type of the created result
+        :return: (N, T, 2) array with (shift_y, shift_x) of each position in
+            each time point, global shifts of the frames (corrected before the
+            model is estimated) are not part of the model and are not included
+        """
+        positions = np.asarray(positions)
+        if out is None:
+            out = np.empty((len(positions), len(time_points), 2), dtype=dtype)
+        elif out.shape != (len(positions), len(time_points), 2):
+            raise ValueError("Output of shape " + str(out.shape) +
+                             " doesn't match " + str(len(positions)) +
+                             " positions and " + str(len(time_points)) +
+                             " time points")
+
+        for start, chunk in self.iter_trajectories(positions, time_points,
+                                                   reference_time, chunk_size):
+            out[start:start + len(chunk)] = chunk
+        return out
+
+    def iter_trajectories(self, positions, time_points, reference_time=None,
+                          chunk_size=65536):
+        """Generator variant of trajectories yielding (start, chunk) where
+        chunk is (chunk_size, T, 2) array of shifts of positions[start:start
+        + chunk_size]"""
+        if chunk_size < 1:
+            raise ValueError("Chunk size has to be at least 1, not " +
+                             str(chunk_size))
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim != 2 or positions.shape[1] != 2:
+            raise ValueError("Positions have to be of shape (N, 2), not " +
+                             str(positions.shape))
+
+        # positions along the first axis, time points along the second one
+        t = np.asarray(time_points, dtype=np.float64)[np.newaxis, :]
+        for start in range(0, len(positions), chunk_size):
+            y = positions[start:start + chunk_size, 0, np.newaxis]
+            x = positions[start:start + chunk_size, 1, np.newaxis]
+            chunk = np.empty((len(y), t.shape[1], 2))
+            for axis in range(2):
+                chunk[:, :, axis] = self.calculate_shift(y, x, t, axis)
+                if reference_time is not None:
+                    chunk[:, :, axis] -= self.calculate_shift(
+                        y, x, reference_time, axis)
+            yield start, chunk
+
+    def save_coeffs(self, path):
+        """Saves coefficients into numpy (.npy) file"""
+        np.save(path, np.asarray(self.coeffs))
+
+    def load_coeffs(self, path):
+        """Loads coefficients saved by save_coeffs, stored in ShiftCache entry
+        (.npz) or in json file (list of coefficients or object with "coeffs",
+        e.g. an entry of dataset manifest)"""
+        if path.endswith(".npz"):
+            with np.load(path) as f:
+                coeffs = f["coeffs"]
+        elif path.endswith(".json"):
+            with open(path) as f:
+                coeffs = json.load(f)
+            if isinstance(coeffs, dict):
+                coeffs = coeffs["coeffs"]
+        else:
+            coeffs = np.load(path)
+
+        coeffs = np.asarray(coeffs, dtype=np.float64)
+        if coeffs.shape != (2, 9):
+            raise ValueError("Coefficients have to be of shape (2, 9), not " +
+                             str(coeffs.shape))
+        self.coeffs = coeffs
+
     def initialize_model(self, positions, shifts_y, shifts_x):
         """
         Estimates model coefficients from calculated shifts.
@@ -123,19 +236,109 @@ class DeformationModel:
 
         self.coeffs = result
 
-    def initialize_model_randomly(self, shape=(2048, 2048), tn=50):
+    @staticmethod
+    def spatial_basis(y, x):
+        """Terms multiplied by c_0 through c_5
+        :return: (len(y), 6) array"""
+        return np.stack((np.ones_like(x), x, x * x, y, y * y, x * y), axis=-1)
+
+    @staticmethod
+    def temporal_basis(t):
+        """Terms multiplied by c_6 through c_8
+        :return: (len(t), 3) array"""
+        return np.stack((t, t * t, t * t * t), axis=-1)
+
+    @staticmethod
+    def fit_coeffs_batch(positions, shifts_y, shifts_x, iterations=10):
+        """
+        Estimates coefficients of many movies sharing the same positions (the
+        same partitioning and time points), the batch counterpart of
+        initialize_model.
+        :param positions: K positions (y, x, time_stamp) shared by all movies
+        :param shifts_y: (M, K) array with shifts on y axis of M movies
+        :param shifts_x: (M, K) array with shifts on x axis
+        :param iterations: number of alternating refinements of the spatial
+            and temporal coefficients
+        :return: (M, 2, 9) array of coefficients
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        # the same sign convention as in initialize_model
+        shifts = -np.stack((np.asarray(shifts_y, dtype=np.float64),
+                            np.asarray(shifts_x, dtype=np.float64)), axis=1)
+        if shifts.ndim != 3 or shifts.shape[2] != len(positions):
+            raise ValueError("Shifts have to be of shape (M, " +
+                             str(len(positions)) + "), not " +
+                             str(np.shape(shifts_y)))
+        count = len(positions)
+        # raw powers of pixel coordinates and times span many orders of
+        # magnitude, the bases are built from coordinates scaled into
+        # <-1, 1> and the coefficients are converted back at the end
+        scale = np.max(np.abs(positions), axis=0)
+        scale[scale == 0] = 1
+        scaled = positions / scale
+        spatial = DeformationModel.spatial_basis(scaled[:, 0], scaled[:, 1])
+        temporal = DeformationModel.temporal_basis(scaled[:, 2])
+
+        # shift is linear in the 18 products c_i * c_j (i < 6 <= j), all
+        # movies are solved by one shared pseudo-inverse and the products are
+        # approximated by rank one matrices
+        design = (spatial[:, :, np.newaxis] *
+                  temporal[:, np.newaxis, :]).reshape(count, 18)
+        products = (shifts @ np.linalg.pinv(design).T).reshape(
+            shifts.shape[:2] + (6, 3))
+        u, sv, vt = np.linalg.svd(products)
+        c = u[..., 0] * sv[..., :1]
+        d = vt[..., 0, :]
+
+        # alternating least squares, normal equations of all movies are
+        # assembled from the shared outer products of the bases
+        spatial_outer = (spatial[:, :, np.newaxis] *
+                         spatial[:, np.newaxis, :]).reshape(count, 36)
+        temporal_outer = (temporal[:, :, np.newaxis] *
+                          temporal[:, np.newaxis, :]).reshape(count, 9)
+
+        def solve(weights, basis, outer, n):
+            normal = ((weights * weights) @ outer).reshape(
+                weights.shape[:2] + (n, n))
+            rhs = (weights * shifts) @ basis
+            return (np.linalg.pinv(normal) @ rhs[..., np.newaxis])[..., 0]
+
+        for i in range(iterations):
+            c = solve(d @ temporal.T, spatial, spatial_outer, 6)
+            d = solve(c @ spatial.T, temporal, temporal_outer, 3)
+
+        # basis terms of the scaled coordinates are the original terms
+        # divided by the terms of the scale
+        sy, sx, st = scale
+        c = c / DeformationModel.spatial_basis(np.array([sy]),
+                                               np.array([sx]))[0]
+        d = d / DeformationModel.temporal_basis(np.array([st]))[0]
+        return np.concatenate((c, d), axis=-1)
+
+    def initialize_model_randomly(self, shape=(2048, 2048), tn=50, rng=None):
         """Randomly generates model with reasonable coefficients."""
-        self.coeffs = self.generate_random_coeffs(shape, tn)
+        self.coeffs = self.generate_random_coeffs(shape, tn, rng)
 
     @staticmethod
-    def generate_random_coeffs(shape, tn):
+    def generate_random_coeffs(shape, tn, rng=None):
         """Generates vector of reasonable random model coefficients a_i.
             shape is (height, width) tuple.
             Generated coefficients are in interval <-0.1,0.1> with c_0 in
             <-0.01, 0.01>.
             :param shape: Shape of the image for which the coefficients should
                 be generated. If provided, the
-            :param tn: time stamp of the last generated frame"""
+            :param tn: time stamp of the last generated frame
+            :param rng: numpy.random.Generator used for generation, if None
+                the global numpy.random state is used"""
+        if rng is None:
+            rng = np.random
+        # Generator and the legacy global state name the same thing differently
+        randint = rng.integers if hasattr(rng, "integers") else rng.randint
+
+        def uniform(low, high):
+            # the legacy state accepts low > high, Generator does not
+            return rng.uniform(min(low, high), max(low, high))
+
         res = np.zeros((2, 9))
 
         # reasonable space-dependent part
@@ -146,7 +349,7 @@ class DeformationModel:
             c = res[i]
 
             # generate quadratic coefficients
-            c[2] = np.random.uniform(min_val, (0.05*width) / (width*width))
+            c[2] = uniform(min_val, (0.05*width) / (width*width))
             longer = max(width, height)
             # c[4] is chosen so that ration between it and c[2] is in <1/3, 3>
             # and so that the combined effect of c[2] and c[4] is at most 5% of
@@ -155,10 +358,10 @@ class DeformationModel:
                               (height*height))
             upper_bound = min(c[2] * 3.0, (0.1 * longer - c[2] * width) / \
                               (height*height))
-            c[4] = np.random.uniform(lower_bound, upper_bound)
+            c[4] = uniform(lower_bound, upper_bound)
 
             # rotation
-            rotation = np.random.uniform(-math.pi, math.pi)
+            rotation = rng.uniform(-math.pi, math.pi)
             cs = math.cos(rotation)
             sn = math.sin(rotation)
             c[2] = c[2]*cs*cs + c[4]*sn*sn
@@ -166,9 +369,9 @@ class DeformationModel:
             c[5] = 2*c[4]*sn*cs - 2*c[2]*sn*cs
 
             # translation of the origin
-            originx = -1*np.random.randint(-int(0.1 * width), int(width + \
+            originx = -1*randint(-int(0.1 * width), int(width + \
                                             0.1 * width))
-            originy = -1*np.random.randint(-int(0.1 * height), int(height + \
+            originy = -1*randint(-int(0.1 * height), int(height + \
                                             0.1 * height))
             c[0] = c[2] * originx * originx + c[4] * originy * originy + \
                 c[5] * originy * originx
@@ -176,7 +379,7 @@ class DeformationModel:
             c[3] = 2 * c[4] * originy + c[5] * originx
 
             #time-dependent part
-            xn = np.random.uniform(0.001, 2)  # max scaling value
+            xn = rng.uniform(0.001, 2)  # max scaling value
             c[6] = (3 * xn) / tn
             c[7] = (-6*xn) / (tn*tn)
             c[8] = (4*xn) / (tn*tn*tn)
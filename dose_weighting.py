@@ -0,0 +1,95 @@
+"""Exposure (dose) weighted sum of restored frames. High frequencies of
+frames which received more electrons are damaged and are down-weighted
+according to the critical exposure curve of Grant and Grigorieff (eLife,
+2015). Frames are accumulated one by one into a running Fourier sum, so the
+weighted sum needs memory of just two spectra regardless of the number of
+frames."""
+import numpy as np
+import fourier
+
+# critical exposure Ne(k) = a * k^b + c in electrons per square angstrom for
+# spatial frequency k in inverse angstroms
+CRITICAL_EXPOSURE = (0.245, -1.665, 2.81)
+
+
+class DoseWeighter:
+    """Running dose weighted sum. Time stamps of the frames are regarded as
+    the cumulative exposure (scaled by dose_per_time).
+    """
+
+    def __init__(self, pixel_size, dose_per_time=1.0, pre_exposure=0.0):
+        """
+        :param pixel_size: size of the pixel of the added frames in angstroms
+        :param dose_per_time: exposure (electrons per square angstrom)
+            received per one unit of time stamps
+        :param pre_exposure: exposure received before the first time stamp
+        """
+        if pixel_size <= 0:
+            raise ValueError("Pixel size has to be positive, not " +
+                             str(pixel_size))
+        self.pixel_size = pixel_size
+        self.dose_per_time = dose_per_time
+        self.pre_exposure = pre_exposure
+        self.reset()
+
+    def reset(self, binning=1):
+        """Forgets all added frames
+        :param binning: binning of the following frames in relation to the
+            pixel_size"""
+        self.binning = binning
+        self.shape = None
+        self.spectrum = None
+        self.squared_weights = None
+        self.critical = None
+        self.frame_count = 0
+
+    def critical_exposure(self, shape):
+        """Critical exposure of each frequency of rfft2 spectrum of data of
+        shape (infinite for the zero frequency)"""
+        ky = np.fft.fftfreq(shape[0])[:, np.newaxis]
+        kx = np.fft.rfftfreq(shape[1])[np.newaxis, :]
+        k = np.hypot(ky, kx) / (self.pixel_size * self.binning)
+        a, b, c = CRITICAL_EXPOSURE
+        with np.errstate(divide="ignore"):
+            return a * k ** b + c
+
+    def frame_weights(self, time_stamp):
+        """Weights of frequencies of frame with time_stamp (the current
+        shape is used)"""
+        exposure = self.pre_exposure + time_stamp * self.dose_per_time
+        return np.exp(-exposure / (2 * self.critical))
+
+    def add(self, frame, time_stamp):
+        """Adds weighted spectrum of frame into the sum
+        :param frame: two dimensional numpy array
+        :param time_stamp: time stamp of the frame"""
+        if self.spectrum is None:
+            self.shape = frame.shape
+            self.critical = self.critical_exposure(frame.shape)
+            self.spectrum = np.zeros(self.critical.shape, dtype=np.complex128)
+            self.squared_weights = np.zeros(self.critical.shape)
+        elif frame.shape != self.shape:
+            raise ValueError("Frame of shape " + str(frame.shape) +
+                             " doesn't match the previous frames of shape " +
+                             str(self.shape))
+
+        weights = self.frame_weights(time_stamp)
+        self.spectrum += weights * fourier.rfft2(frame, self.shape)
+        self.squared_weights += weights * weights
+        self.frame_count += 1
+
+    def result(self):
+        """Weighted sum of the added frames. Each frequency is normalized by
+        the square root of the sum of its squared weights (Grant and
+        Grigorieff), so the noise of independent frames keeps the power it has
+        in the plain sum instead of being amplified where all the weights are
+        small. It is scaled by the square root of the number of frames, so the
+        zero frequency (mean) is the same as in the plain sum.
+        :return: two dimensional numpy array"""
+        if self.spectrum is None:
+            raise RuntimeError("No frames were added")
+
+        scale = np.zeros(self.squared_weights.shape)
+        np.divide(self.frame_count, self.squared_weights, out=scale,
+                  where=self.squared_weights > 0)
+        return fourier.irfft2(self.spectrum * np.sqrt(scale), self.shape)
@@ -0,0 +1,182 @@
+"""Fourier transforms used by the alignment. The backend is selectable:
+"numpy", "scipy" (scipy.fft with multiple workers) or "pyfftw" (when
+installed, FFTW plans are cached for each shape and wisdom can be saved and
+loaded). All transforms are real-to-complex on sizes padded to fast lengths.
+set_backend selects the process wide default, settings overrides it only for
+the current thread (or asyncio task), so concurrent runs can use different
+numbers of threads."""
+import contextlib
+import contextvars
+import os
+import pickle
+import threading
+import numpy as np
+import scipy.fft
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+BACKENDS = ("numpy", "scipy", "pyfftw")
+
+_backend = "scipy"
+_workers = os.cpu_count() or 1
+_plans = {}
+_plans_lock = threading.Lock()
+# (name, workers) overriding the default in the current context
+_settings = contextvars.ContextVar("fourier_settings", default=None)
+
+
+def _check(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown FFT backend: '" + str(name) + "'")
+    if name == "pyfftw" and pyfftw is None:
+        raise RuntimeError("pyFFTW is not installed")
+
+
+def set_backend(name, workers=None):
+    """Selects backend used by all transforms (outside of settings blocks).
+    :param name: one of BACKENDS
+    :param workers: number of threads used by one transform (ignored by
+        numpy), None - number of cpus"""
+    global _backend, _workers
+    _check(name)
+
+    _backend = name
+    _workers = workers or os.cpu_count() or 1
+    with _plans_lock:
+        _plans.clear()
+
+
+def get_backend():
+    """:return: (name, workers) of the backend used in the current context"""
+    return _settings.get() or (_backend, _workers)
+
+
+@contextlib.contextmanager
+def settings(name=None, workers=None):
+    """Backend used by the transforms of the current thread (or asyncio task)
+    inside of the with block, other threads keep theirs.
+    :param name: one of BACKENDS, None - the current one
+    :param workers: number of threads used by one transform, None - the
+        current number"""
+    current = get_backend()
+    name = name or current[0]
+    _check(name)
+    token = _settings.set((name, workers or current[1]))
+    try:
+        yield
+    finally:
+        _settings.reset(token)
+
+
+def bind(fnc, threads=1):
+    """Wraps fnc so that it uses the backend of the calling context (and the
+    other context variables, e.g. stage of copy_tracking) also when it runs
+    on another thread (e.g. of an executor)
+    :param threads: number of threads running fnc at once, workers of the
+        backend are divided among them, so that their transforms don't
+        oversubscribe the cpus"""
+    context = contextvars.copy_context()
+    name, workers = get_backend()
+    workers = max(1, workers // threads)
+
+    def call(*args, **kwargs):
+        with settings(name, workers):
+            return fnc(*args, **kwargs)
+
+    def run(*args, **kwargs):
+        # one context cannot be entered by several threads at once
+        return context.copy().run(call, *args, **kwargs)
+    return run
+
+
+def fast_shape(shape):
+    """Smallest shape not smaller than shape, for which the transforms are
+    fast"""
+    return tuple(scipy.fft.next_fast_len(int(s), real=True) for s in shape)
+
+
+def _plan(kind, in_shape, shape):
+    """Cached FFTW object for transform of kind ("rfft2" or "irfft2") of
+    input of in_shape (zero padded or cropped to shape)"""
+    workers = get_backend()[1]
+    key = (kind, in_shape, shape, workers)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is None:
+            if kind == "rfft2":
+                template = pyfftw.empty_aligned(in_shape, dtype="float64")
+                plan = pyfftw.builders.rfft2(template, s=shape,
+                                             threads=workers)
+            else:
+                template = pyfftw.empty_aligned(in_shape, dtype="complex128")
+                plan = pyfftw.builders.irfft2(template, s=shape,
+                                              threads=workers)
+            # plans share their buffers, so one plan must not be used by
+            # several threads at once
+            plan = (plan, threading.Lock())
+            _plans[key] = plan
+    return plan
+
+
+def rfft2(data, shape):
+    """Two dimensional real-to-complex transform of data zero padded to
+    shape"""
+    backend, workers = get_backend()
+    if backend == "numpy":
+        return np.fft.rfft2(data, shape)
+    if backend == "scipy":
+        return scipy.fft.rfft2(data, shape, workers=workers)
+
+    plan, lock = _plan("rfft2", data.shape, tuple(shape))
+    with lock:
+        # output array is reused by the next call of the plan
+        return np.copy(plan(data))
+
+
+def irfft2(data, shape):
+    """Inverse of rfft2 with real output of shape"""
+    backend, workers = get_backend()
+    if backend == "numpy":
+        return np.fft.irfft2(data, shape)
+    if backend == "scipy":
+        return scipy.fft.irfft2(data, shape, workers=workers)
+
+    plan, lock = _plan("irfft2", data.shape, tuple(shape))
+    with lock:
+        return np.copy(plan(data))
+
+
+def correlate(main, template, max_shift):
+    """Cross-correlation of main and template for shifts up to max_shift.
+    :param max_shift: (my, mx) maximal searched shift along each axis, must be
+        smaller than the shape of the data
+    :return: numpy array window of shape (2 * my + 1, 2 * mx + 1), where
+        window[my + ky][mx + kx] = sum(main[y + ky][x + kx] * template[y][x])
+    """
+    my, mx = max_shift
+    # padding by max_shift is enough for the correlation to be exact (not
+    # circular) inside of the window
+    shape = fast_shape((main.shape[0] + my, main.shape[1] + mx))
+    corr = irfft2(rfft2(main, shape) * np.conj(rfft2(template, shape)), shape)
+    return np.roll(corr, (my, mx), axis=(0, 1))[:2 * my + 1, :2 * mx + 1]
+
+
+def save_wisdom(path):
+    """Saves accumulated FFTW wisdom (only pyfftw backend)"""
+    if pyfftw is None:
+        raise RuntimeError("pyFFTW is not installed")
+    with open(path, "wb") as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+def load_wisdom(path):
+    """Loads FFTW wisdom saved by save_wisdom, so that planning of the same
+    shapes is fast (only pyfftw backend)"""
+    if pyfftw is None:
+        raise RuntimeError("pyFFTW is not installed")
+    with open(path, "rb") as f:
+        pyfftw.import_wisdom(pickle.load(f))
@@ -4,9 +4,15 @@ from scipy import misc
 from scipy import ndimage
 import numpy as np
 import warnings
+import skimage.io
 import skimage.transform
 import os.path
-import mrcfile as mrc
+import mrc_io
+import copy_tracking
+
+# handling of positions outside of the image in Image.gather and
+# Image.scatter
+BOUNDARY_MODES = ("constant", "nearest", "reflect", "wrap")
 
 
 class Image:
@@ -32,7 +38,7 @@ class Image:
         x = x // resolution_scaling_factor
         if self.__outside_boundaries(y, x):
             return 0.0
-        return self.image_data[y][x]
+        return self.image_data[y, x]
 
     def __setitem__(self, key, value):
         """Setting image data. Key should be two element lit-like object of
@@ -43,19 +49,147 @@ class Image:
         """Setting image data."""
         if self.__outside_boundaries(y, x):
             # Do nothing, when trying to set element outside the image
-            warnings.warn("Trying to set element (y:" + str(value[0]) + \
-                          ", x:" + str(value[1]) + ") outside the image.")
+            warnings.warn("Trying to set element (y:" + str(y) + \
+                          ", x:" + str(x) + ") outside the image.")
             return
 
-        self.image_data[y][x] = value
+        self.make_writable()
+        self.image_data[y, x] = value
 
     def __outside_boundaries(self, y, x):
         return x < 0 or x >= self.width() or y < 0 or y >= self.height()
 
+    @staticmethod
+    def boundary_indices(indices, size, mode):
+        """Maps integer indices into <0, size) according to the boundary mode.
+        :param mode: one of BOUNDARY_MODES
+        :return: (indices, inside) where inside is boolean mask of the
+            original indices inside of <0, size) for "constant" mode (their
+            indices are clipped) and None for the other modes"""
+        if mode == "constant":
+            inside = (indices >= 0) & (indices < size)
+            return np.clip(indices, 0, size - 1), inside
+        if mode == "nearest":
+            return np.clip(indices, 0, size - 1), None
+        if mode == "reflect":
+            # d c b a | a b c d | d c b a
+            indices = np.mod(indices, 2 * size)
+            return np.where(indices >= size, 2 * size - 1 - indices,
+                            indices), None
+        if mode == "wrap":
+            return np.mod(indices, size), None
+        raise ValueError("Unknown boundary mode: '" + str(mode) + "'")
+
+    @staticmethod
+    def is_integer(*arrays):
+        return all(np.issubdtype(a.dtype, np.integer) for a in arrays)
+
+    def gather(self, y, x, mode="constant", cval=0.0,
+               resolution_scaling_factor=1):
+        """Reads image data on arrays of positions at once (bulk variant of
+        get).
+        :param y: array of y positions (broadcastable against x)
+        :param x: array of x positions
+        :param mode: handling of positions outside of the image, one of
+            BOUNDARY_MODES: "constant" - cval, "nearest" - the closest edge
+            pixel, "reflect" - image mirrored at its edge, "wrap" - image
+            repeated periodically
+        :param cval: value outside of the image in the "constant" mode
+        :param resolution_scaling_factor: positions are in resolution greater
+            by this factor than image data (as in get)
+        :return: numpy array of values, pixels on integer positions are read
+            directly, fractional positions are bilinearly interpolated from
+            their four neighbours"""
+        y = np.asarray(y)
+        x = np.asarray(x)
+        if self.is_integer(y, x):
+            return self._gather_pixels(y, x, mode, cval,
+                                       resolution_scaling_factor)
+
+        y_down = np.floor(y).astype(int)
+        x_left = np.floor(x).astype(int)
+        wy = y - y_down
+        wx = x - x_left
+
+        def get(yi, xi):
+            return self._gather_pixels(yi, xi, mode, cval,
+                                       resolution_scaling_factor)
+
+        p1 = get(y_down, x_left) * (1 - wx) + get(y_down, x_left + 1) * wx
+        p2 = get(y_down + 1, x_left) * (1 - wx) + \
+            get(y_down + 1, x_left + 1) * wx
+        return p1 * (1 - wy) + p2 * wy
+
+    def _gather_pixels(self, y, x, mode, cval, resolution_scaling_factor):
+        yi, y_inside = self.boundary_indices(y // resolution_scaling_factor,
+                                             self.height(), mode)
+        xi, x_inside = self.boundary_indices(x // resolution_scaling_factor,
+                                             self.width(), mode)
+        values = self.image_data[yi, xi]
+        if mode == "constant":
+            values = np.where(y_inside & x_inside, values, cval)
+        return values
+
+    def scatter(self, y, x, values, mode="constant", accumulate=False):
+        """Writes values to arrays of positions at once (bulk variant of set).
+        :param y: array of y positions (broadcastable against x and values)
+        :param x: array of x positions
+        :param values: array of written values
+        :param mode: handling of positions outside of the image: "constant" -
+            they are ignored, other BOUNDARY_MODES map them into the image as
+            in gather
+        :param accumulate: False - values on integer positions replace the
+            pixels, True - they are added (repeated positions are added
+            several times); each value on fractional position is always
+            split among its four neighbours by bilinear weights and added
+        """
+        self.make_writable()
+        y, x, values = np.broadcast_arrays(np.asarray(y), np.asarray(x),
+                                           np.asarray(values))
+        if self.is_integer(y, x):
+            self._scatter_pixels(y, x, values, mode, accumulate)
+            return
+
+        y_down = np.floor(y).astype(int)
+        x_left = np.floor(x).astype(int)
+        wy = y - y_down
+        wx = x - x_left
+        for dy, weight_y in ((0, 1 - wy), (1, wy)):
+            for dx, weight_x in ((0, 1 - wx), (1, wx)):
+                self._scatter_pixels(y_down + dy, x_left + dx,
+                                     values * weight_y * weight_x, mode, True)
+
+    def _scatter_pixels(self, y, x, values, mode, accumulate):
+        yi, y_inside = self.boundary_indices(y, self.height(), mode)
+        xi, x_inside = self.boundary_indices(x, self.width(), mode)
+        if mode == "constant":
+            inside = y_inside & x_inside
+            yi = yi[inside]
+            xi = xi[inside]
+            values = values[inside]
+        if accumulate:
+            np.add.at(self.image_data, (yi, xi), values)
+        else:
+            self.image_data[yi, xi] = values
+
     def initialize_with_image(self, other):
-        self.image_data = np.copy(other.image_data)
+        """Shares data of the other image, both images then hold read-only
+        views and whichever is written to first copies them (see
+        make_writable)"""
+        if other.image_data.flags.writeable:
+            other.image_data = other.image_data.view()
+            other.image_data.flags.writeable = False
+        self.image_data = other.image_data.view()
         self.time_stamp = other.time_stamp
 
+    def make_writable(self):
+        """Copies shared (read-only) image data, so that they can be modified
+        without affecting other images.
+        :return: writable image data"""
+        if not self.image_data.flags.writeable:
+            self.image_data = copy_tracking.copy(self.image_data)
+        return self.image_data
+
     def initialize_empty(self, shape):
         self.image_data = np.empty(shape)
         self.time_stamp = 0
@@ -81,27 +215,23 @@ class Image:
         :param grid_size: width of lines
         :param grid_spacing: distance between lines
         """
-        for yi in range(self.image_data.shape[0]):
-            for xi in range(self.image_data.shape[1]):
-                if (xi + grid_spacing)%(grid_spacing + grid_size) < grid_size \
-                        or \
-                    (yi + grid_spacing)%(grid_spacing + grid_size) < grid_size:
-                    self.image_data[yi][xi] = 0.0
+        self.make_writable()
+        period = grid_spacing + grid_size
+        ys = np.arange(self.image_data.shape[0])[:, np.newaxis]
+        xs = np.arange(self.image_data.shape[1])[np.newaxis, :]
+        lines = ((xs + grid_spacing) % period < grid_size) | \
+            ((ys + grid_spacing) % period < grid_size)
+        self.image_data[lines] = 0.0
 
     def shift_part(self, x0, y0, x1, y1, shiftX, shiftY, newVal=0):
-        d = np.zeros((abs(y0 - y1), abs(x0 - x1)))
-        for yi in range(self.image_data.shape[0]):
-            for xi in range(self.image_data.shape[1]):
-                y = yi - y0
-                x = xi - x0
-                d[y][x] = self.image_data[yi][xi]
-                self.image_data[yi][xi] = newVal
-
-        for yi in range(d.shape[0]):
-            for xi in range(d.shape[1]):
-                y = y0 + yi + shiftY
-                x = x0 + xi + shiftX
-                self.image_data[y][x] = d[yi][xi]
+        """Moves rectangle <y0, y1) x <x0, x1) by (shiftY, shiftX), the
+        uncovered area is filled with newVal and the part moved outside of
+        the image is lost."""
+        ys, xs = np.mgrid[y0:y1, x0:x1]
+        d = self.gather(ys, xs)
+        self.make_writable()
+        self.image_data[y0:y1, x0:x1] = newVal
+        self.scatter(ys + shiftY, xs + shiftX, d)
 
     def shift_patches(self, shiftsX, shiftsY):
         x0 = 0
@@ -141,7 +271,39 @@ class Image:
         :param path:
         :param time_stamp:
         """
-        self.image_data = misc.imread(path, flatten=True)
+        self.image_data = self.read_gray(path)
+        self.time_stamp = time_stamp
+
+    @staticmethod
+    def read_gray(path, out=None):
+        """Reads image file as gray-scale float image (color images are
+        converted with the same ITU-R 601-2 luma transform as
+        scipy.misc.imread(path, flatten=True) used).
+        :param out: None - new array is returned, otherwise numpy array of the
+            same shape into which is the image decoded
+        :return: numpy array with the image"""
+        data = skimage.io.imread(path)
+        if data.ndim == 3:
+            data = data[:, :, 0] * 0.299 + data[:, :, 1] * 0.587 + \
+                data[:, :, 2] * 0.114
+
+        if out is None:
+            return data.astype(np.float64)
+        if out.shape != data.shape:
+            raise RuntimeError("Image '" + path + "' has shape " +
+                               str(data.shape) + " instead of " +
+                               str(out.shape))
+        out[...] = data
+        return out
+
+    def load_mrc(self, path, time_stamp):
+        """
+        Loads image from mrc file containing one frame
+        :param path:
+        :param time_stamp:
+        """
+        data = mrc_io.read(path)
+        self.image_data = data.reshape(data.shape[-2:])
         self.time_stamp = time_stamp
 
     def shrink_to_reasonable(self):
@@ -168,15 +330,23 @@ class Image:
         else:
             name = os.path.join(folder_path, name + ".png")
 
-        misc.imsave(name, self.image_data)
+        # scale the data into the whole 8 bit range
+        low = np.min(self.image_data)
+        high = np.max(self.image_data)
+        scale = 255.0 / (high - low) if high > low else 0.0
+        data = ((self.image_data - low) * scale).astype(np.uint8)
+        skimage.io.imsave(name, data, check_contrast=False)
 
-    def save_mrc(self, path):
+    def save_mrc(self, path, data_format="float32", compression=None):
+        """
+        Saves image into mrc file
+        :param path:
+        :param data_format: one of mrc_io.FORMATS (default float64 type cannot
+            be saved into mrc file format)
+        :param compression: None, "gzip" or "bzip2"
+        """
         if self.image_data is None:
             warnings.warn("Trying to save an empty image.")
             return
 
-        # default float64 type cannot be saved into mrc file format
-        cp = self.image_data.astype(dtype=np.float32)
-
-        with mrc.new(path, overwrite=True) as f:
-            f.set_data(cp)
+        mrc_io.write(path, self.image_data, data_format, compression)
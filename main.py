@@ -1,14 +1,23 @@
+import contextlib
 from image import Image
 from deformation_model import DeformationModel
 from movie import Movie
+from cache import ShiftCache
+import autotune
+import copy_tracking
+import mrc_io
+import my_math
 import numpy as np
+import os.path
+import time
 from scipy import optimize
 import mrcfile as mrc
 
 
 
 def deform_file(path=None, shape=None, time_points=None, coefficients=None,
-                save=None, add_grid=True, save_movie=True, verbose=True):
+                save=None, add_grid=True, save_movie=True, verbose=True,
+                progress=None):
     """
     Deforms provided file based on the deformation model.
     :param path: Path to an image file in gray-scale, which should be loaded.
@@ -24,10 +33,12 @@ def deform_file(path=None, shape=None, time_points=None, coefficients=None,
     :param add_grid: True - black grid is drawn over the image to better show
         the resulting deformation
     :param save_movie: True - if save=True then also the movie of the deformed
-        images is saved as a STAR file format (with the individual images saved
-        as mrc files)
+        images is saved as mrc stack (movie.mrc in the save folder)
     :param verbose: True - printing additional information about the current
         process state
+    :param progress: None or callable progress(stage, done, total) called
+        after each generated frame (stage "deform"), exception raised by it
+        aborts the generation
     :return: ([images], coefficients) - images are numpy array with resulting
                                         data ordered as time_points
                                       - coefficients are coefficients used in
@@ -36,6 +47,55 @@ def deform_file(path=None, shape=None, time_points=None, coefficients=None,
     if time_points is None:
         time_points = range(10)
 
+    writer = None
+    sinks = []
+    if save:
+        sinks.append(lambda t, frame: Image(time_stamp=t, img_data=frame).save(
+            save, name="DeformationTime" + str(t)))
+        if save_movie:
+            writer = mrc_io.StackWriter(os.path.join(save, "movie.mrc"),
+                                        len(time_points))
+            sinks.append(lambda t, frame: writer.write(frame))
+
+    def sink(t, frame):
+        for s in sinks:
+            s(t, frame)
+
+    with contextlib.ExitStack() as stack:
+        if writer is not None:
+            # on error (or cancellation by progress) the writer is closed and
+            # its temporary file removed, otherwise the movie is finished
+            stack.enter_context(writer)
+        frames, coeffs = deform_file_stream(path, shape, time_points,
+                                            coefficients, add_grid,
+                                            sink if sinks else None, verbose,
+                                            progress)
+        results = [frame for t, frame in frames]
+
+    if verbose:
+        print("Deformations finished.")
+
+    return results, coeffs
+
+
+def deform_file_stream(path=None, shape=None, time_points=None,
+                       coefficients=None, add_grid=True, sink=None,
+                       verbose=True, progress=None):
+    """
+    Streaming variant of deform_file, frames are computed one at a time when
+    the returned generator is iterated, so only the current frame is held in
+    memory. The source image is loaded and the coefficients are chosen
+    immediately.
+    :param sink: None or callable sink(t, frame) to which is each frame passed
+        (e.g. written) before it is yielded
+    Other parameters are the same as in deform_file.
+    :return: (frames, coefficients) - frames is generator of (t, numpy array)
+        ordered as time_points, each array is owned by the caller (also the
+        undeformed one of time 0)
+    """
+    if time_points is None:
+        time_points = range(10)
+
     if verbose:
         print("Loading file")
 
@@ -50,48 +110,44 @@ def deform_file(path=None, shape=None, time_points=None, coefficients=None,
     else:
         img.resize(shape)
 
-    if verbose:
-        print("Applying model")
-
     model = DeformationModel()
     if coefficients is None:
         model.initialize_model_randomly(img.shape(), max(time_points))
     else:
         model.coeffs = coefficients
 
-    results = []
-    for t in time_points:
-        results.append(model.apply_model(img, 0, t))
-        if verbose:
-            print("Generated deformation in time point:", t)
-
-    if save:
+    def frames():
         if verbose:
-            print("Saving results")
-
-        for i in results:
-            i.save(save, name="DeformationTime" + str(i.time_stamp))
-
-        if save_movie:
-            movie = Movie()
-            for i in results:
-                movie.add(i, True)
-            movie.save_movie_mrc("./")
-
-    results = [i.image_data for i in results]
-
-    if verbose:
-        print("Deformations finished.")
-
-    return results, model.coeffs
+            print("Applying model")
+        for i, t in enumerate(time_points):
+            frame = model.apply_model(img, 0, t).image_data
+            if not frame.flags.writeable:
+                # t == 0 gives read-only view of the source image
+                frame = copy_tracking.copy(frame)
+            if sink is not None:
+                sink(t, frame)
+            if verbose:
+                print("Generated deformation in time point:", t)
+            if progress is not None:
+                progress("deform", i + 1, len(time_points))
+            yield t, frame
+
+    return frames(), model.coeffs
 
 
 def motion_correct_files(paths=[], time_points=[], coefficients=None,
-                         save_path=None, save_partial=False, verbose=True):
+                         save_path=None, save_partial=False, verbose=True,
+                         cache_path=None, low_memory=False, output_binning=1,
+                         roi=None, preprocessor=None, profile=None,
+                         alignment_mode="leave_one_out", group_size=1,
+                         dose_weighter=None, preview=None, preview_binning=4,
+                         progress=None):
     """
     Corrects motion (proof of concept implementation)
-    :param paths: paths to deformed gray-scale files
-    :param time_points: time_points of the provided files
+    :param paths: paths to deformed gray-scale files, one compact mrc file or
+        one STAR (xmd) file saved by Movie.save_movie_starfile
+    :param time_points: time_points of the provided files (ignored for STAR
+        file, which contains them)
     :param coefficients: coefficients used to correct motion, if None the whole
         calculation including coefficient estimation is performed
     :param save_path: None - result is only returned, any other value is
@@ -100,6 +156,38 @@ def motion_correct_files(paths=[], time_points=[], coefficients=None,
         in save_path (individual corrected images)
     :param verbose: True - printing additional information about the current
         process state
+    :param cache_path: None - nothing is cached, other values are regarded as
+        folder of ShiftCache where the estimated shifts and coefficients are
+        stored and reused by later runs on the same data
+    :param low_memory: True - global alignment works without copies of the
+        frames (see Movie.align_stack)
+    :param output_binning: binning of the restored images, the model is still
+        estimated from the full resolution data
+    :param roi: None - whole images are restored, otherwise (y0, x0, y1, x1)
+        region to which are the restored images cropped
+    :param preprocessor: None or callable applied to each frame while it is
+        loaded (e.g. preprocessing.Preprocessor)
+    :param profile: None or alignment parameters chosen by autotune.autotune,
+        neither preprocessor nor the FFT backend of other runs are changed
+    :param alignment_mode: strategy of the global alignment, one of
+        movie.ALIGNMENT_MODES (see Movie.alignment_mode)
+    :param group_size: number of consecutive frames summed before global and
+        local alignment (see Movie.group_frames)
+    :param dose_weighter: None - plain sum of the restored images is
+        returned, otherwise dose_weighting.DoseWeighter (with pixel size of
+        the loaded frames) by which is the sum weighted while the images are
+        restored
+    :param preview: None or callable preview(stage, data) which receives
+        progressively better sums as soon as they are ready: "global" - binned
+        globally corrected sum, "local" - binned sum restored by the model
+        (before the full resolution restoration), "final" - the result
+    :param preview_binning: binning of the "global" and "local" previews (in
+        relation to the output)
+    :param progress: None or callable progress(stage, done, total) called
+        after each loaded frame ("load"), after each sweep of the global
+        alignment and each aligned partition stack, after each stage
+        ("global", "local", "fit") and after each restored image ("restore"),
+        exception raised by it aborts the correction (e.g. cancellation)
     :return: numpy array representing the corrected image
     """
 
@@ -107,55 +195,196 @@ def motion_correct_files(paths=[], time_points=[], coefficients=None,
         print("Loading files")
 
     movie = Movie()
-    if (len(paths) == 1 and paths[0].endswith("mrc")):
-        # single compact mrc file
-        movie.load_compact_mrc(paths[0], time_points)
-        for img in movie.micrographs:
-            img.save("./", "ld")
-    else:
-        for p, t in zip(paths, time_points):
-            img = Image(p, t)
-            movie.add(img)
-
-    movie.save_sum("./", "_simple_total")
-
-    if verbose:
-        print("Correcting for global shift")
-    movie.correct_global_shift()
-
-    movie.save_sum("./", "_global_corrected_total")
+    movie.low_memory = low_memory
+    movie.alignment_mode = alignment_mode
+    movie.group_size = group_size
+    movie.preprocessor = preprocessor
+    # FFT threads of the profile are used only by this run
+    fft_settings = contextlib.nullcontext() if profile is None else \
+        autotune.apply_profile(movie, profile)
+    with fft_settings:
+        if (len(paths) == 1 and paths[0].endswith("mrc")):
+            # single compact mrc file
+            movie.load_compact_mrc(paths[0], time_points, progress=progress)
+        elif len(paths) == 1 and paths[0].endswith((".xmd", ".star")):
+            # STAR file referencing one mrc file per frame, time_points are
+            # taken from the file
+            movie.load_movie_starfile(paths[0], progress=progress)
+        else:
+            movie.load_image_sequence(paths, time_points, progress=progress)
+
+        return motion_correct_movie(movie, coefficients, save_path,
+                                    save_partial, verbose, cache_path,
+                                    output_binning=output_binning, roi=roi,
+                                    dose_weighter=dose_weighter,
+                                    preview=preview,
+                                    preview_binning=preview_binning,
+                                    progress=progress)
+
+
+def motion_correct_movie(movie, coefficients=None, save_path=None,
+                         save_partial=False, verbose=True, cache_path=None,
+                         report=None, output_binning=1, roi=None,
+                         dose_weighter=None, preview=None, preview_binning=4,
+                         progress=None):
+    """
+    Corrects motion of already loaded movie, micrographs of the movie are
+    replaced by the restored ones (with dose_weighter they are released one
+    by one as they are accumulated and the movie is left empty). Parameters
+    are the same as in motion_correct_files.
+    :param movie: Movie which should be corrected
+    :param save_partial: True - partial results are saved into folder defined
+        in save_path (sums after loading and global correction and individual
+        corrected images)
+    :param report: None or dictionary into which are stored durations (in
+        seconds) of the individual stages under key "timings" (global, local,
+        fit, restore), global shifts ("global_shifts") and used coefficients
+        ("coeffs"); when copy_tracking is enabled also copies of frame data
+        made by this run in the individual stages ("copies", see
+        copy_tracking.collect)
+    :return: numpy array representing the corrected image
+    """
+    if report is None:
+        report = {}
+    timings = report.setdefault("timings", {})
+    save_partial = save_path and save_partial
+
+    if save_partial:
+        movie.save_sum(save_path, "_simple_total")
+
+    cache = None
+    cached = None
+    if cache_path is not None:
+        cache = ShiftCache(cache_path)
+        cache_key = ShiftCache.key([m.image_data for m in movie.micrographs],
+                                   [m.time_stamp for m in movie.micrographs],
+                                   movie.alignment_parameters())
+        cached = cache.get(cache_key)
+
+    # counts of this run only, other runs may be tracked concurrently
+    with copy_tracking.collect() as copies:
+        start = time.perf_counter()
+        with copy_tracking.stage("global"):
+            if cached is not None:
+                if verbose:
+                    print("Using cached shifts and coefficients")
+                global_shifts = cached["global_shifts"]
+                movie.apply_shifts(*global_shifts)
+                if preview is not None:
+                    preview("global", my_math.bin_data(movie.sum_images(),
+                                                       preview_binning))
+            elif preview is not None:
+                if verbose:
+                    print("Correcting for global shift (progressively)")
+                # binned alignment gives the preview at once and its shifts are
+                # only refined at full resolution
+                y_shifts, x_shifts, coarse_sum = movie.coarse_global_shift(
+                    preview_binning, progress)
+                preview("global", coarse_sum)
+                global_shifts = movie.correct_global_shift(
+                    (y_shifts, x_shifts), preview_binning, progress)
+            else:
+                if verbose:
+                    print("Correcting for global shift")
+                global_shifts = movie.correct_global_shift(progress=progress)
+        timings["global"] = time.perf_counter() - start
+        report["global_shifts"] = global_shifts
+        if progress is not None:
+            progress("global", 1, 1)
+
+        if save_partial:
+            movie.save_sum(save_path, "_global_corrected_total")
 
-    if coefficients is None:
-        if verbose:
-            print("Calculating local shifts")
-        local_shifts = movie.calculate_local_shifts()
+        model = DeformationModel()
+        if coefficients is not None:
+            model.coeffs = coefficients
+        elif cached is not None:
+            model.coeffs = cached["coeffs"]
+        else:
+            if verbose:
+                print("Calculating local shifts")
+            start = time.perf_counter()
+            with copy_tracking.stage("local"):
+                local_shifts = movie.calculate_local_shifts(progress)
+            timings["local"] = time.perf_counter() - start
+            if progress is not None:
+                progress("local", 1, 1)
+
+            if verbose:
+                print("Estimating deformation model coefficients")
+            start = time.perf_counter()
+            with copy_tracking.stage("fit"):
+                model.initialize_model(*local_shifts)
+            timings["fit"] = time.perf_counter() - start
+            if progress is not None:
+                progress("fit", 1, 1)
+
+            if cache is not None:
+                cache.put(cache_key, global_shifts=np.array(global_shifts),
+                          positions=np.array(local_shifts[0]),
+                          local_shifts=np.array(local_shifts[1:]),
+                          coeffs=model.coeffs)
+
+        report["coeffs"] = model.coeffs
+
+        if preview is not None:
+            # only the centres of the binned output pixels are deformed, so
+            # the preview costs a fraction of the restoration
+            preview("local", sum(model.apply_model(
+                m, m.time_stamp, 0, binning=output_binning * preview_binning,
+                roi=roi).image_data for m in movie.micrographs))
 
         if verbose:
-            print("Estimating deformation model coefficients")
-        model = DeformationModel()
-        model.initialize_model(*local_shifts)
+            print("Applying model")
+
+        if dose_weighter is not None:
+            dose_weighter.reset(output_binning)
+
+        start = time.perf_counter()
+        with copy_tracking.stage("restore"):
+            count = len(movie.micrographs)
+            for i in range(count):
+                m = movie.micrographs[i]
+                restored = model.apply_model(m, m.time_stamp, 0,
+                                             binning=output_binning, roi=roi)
+                if dose_weighter is not None:
+                    # accumulated in the same pass, the restored image is still
+                    # in cache; neither of the images is kept, so the memory
+                    # doesn't grow with the number of frames
+                    dose_weighter.add(restored.image_data, m.time_stamp)
+                    movie.micrographs[i] = None
+                else:
+                    movie.micrographs[i] = restored
+                if save_partial:
+                    restored.save(save_path, name=("partial" + str(i)))
+                del m, restored
+                if verbose:
+                    print("Restored image " + str(i))
+                if progress is not None:
+                    progress("restore", i + 1, count)
+        timings["restore"] = time.perf_counter() - start
+    if copy_tracking.is_enabled():
+        report["copies"] = copies
+
+    if dose_weighter is not None:
+        movie.micrographs = []
+        result = dose_weighter.result()
     else:
-        model = DeformationModel()
-        model.coeffs = coefficients
+        result = movie.sum_images()
 
-    if verbose:
-        print("Applying model")
-
-    for i in range(len(movie.micrographs)):
-        m = movie.micrographs[i]
-        movie.micrographs[i] = model.apply_model(m, m.time_stamp, 0)
-        if save_path and save_partial:
-            movie.micrographs[i].save(save_path, name=("partial" + str(i)))
-        if verbose:
-            print("Restored image " + str(i))
+    if preview is not None:
+        preview("final", result)
 
     if save_path:
-        movie.save_sum(save_path)
+        img = Image()
+        img.time_stamp = 0
+        img.image_data = result
+        img.save(save_path, "_total")
 
     if verbose:
         print("Restoration finished")
 
-    return movie.sum_images()
+    return result
 
 
 if __name__ == "__main__":
@@ -1,5 +1,4 @@
 #!/usr/bin/python3
-from image import Image
 from movie import Movie
 import glob, os, sys
 
@@ -10,10 +9,7 @@ if __name__ == "__main__":
     file_list = list(glob.glob("*.jpg"))
     file_list.sort()
     movie = Movie()
-    for f in file_list:
-        path = folder + "/" + f
-        img = Image(path, 0)
-        movie.add(img, data_check=False)
+    paths = [folder + "/" + f for f in file_list]
+    movie.load_image_sequence(paths, list(range(len(paths))))
     movie.save_movie_mrc(output)
 
-
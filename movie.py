@@ -1,9 +1,17 @@
+import math
 import numpy as np
-from scipy import signal
 from scipy import ndimage
 from image import Image
+import fourier
 import os.path
-import mrcfile as mrc
+import warnings
+import concurrent.futures
+import mrc_io
+import copy_tracking
+import my_math
+
+# global alignment strategies, see Movie.alignment_mode
+ALIGNMENT_MODES = ("leave_one_out", "reference", "all_pairs")
 
 
 class Movie:
@@ -11,6 +19,58 @@ class Movie:
     def __init__(self):
         self.micrographs = []
         self.partitions_size = 5
+        # iterative alignment stops after max_iterations or when no shift
+        # changes by more than shift_threshold pixels
+        self.max_iterations = 10
+        self.shift_threshold = 0.2
+        # global alignment strategy, one of ALIGNMENT_MODES:
+        # "leave_one_out" - iterative alignment against the sum of the others
+        # "reference" - each frame is aligned to reference_frame (None - sum
+        #   of all frames, index of a group when frames are grouped)
+        # "all_pairs" - frames closer than pair_window (None - all of them) are
+        #   correlated with each other and shifts are solved by least squares
+        # correlations of the last two modes are independent and run on
+        # alignment_workers threads (None - the default of
+        # ThreadPoolExecutor, min(32, number of cpus + 4)), FFT workers are
+        # divided among them (see alignment_threads)
+        self.alignment_mode = "leave_one_out"
+        self.reference_frame = None
+        self.pair_window = None
+        self.alignment_workers = None
+        # low-dose frames are aligned in groups of group_size consecutive
+        # frames ("fixed" - non-overlapping groups, "sliding" - group starting
+        # at each frame) and the shifts of the groups are interpolated back to
+        # the frames (see group_frames)
+        self.group_size = 1
+        self.group_mode = "fixed"
+        # local alignment runs on globally corrected data, so only small
+        # shifts around zero are searched for
+        self.local_search_window = 8
+        self.local_statistics = []
+        # align without copies of the micrographs, see align_stack
+        self.low_memory = False
+        # global and local shifts are estimated on copies of the micrographs
+        # binned by alignment_binning (local_search_window is then in the
+        # binned pixels), returned shifts and positions are in the pixels of
+        # the micrographs
+        self.alignment_binning = 1
+        # callable applied to each raw frame while it is loaded, e.g.
+        # preprocessing.Preprocessor
+        self.preprocessor = None
+
+    def alignment_parameters(self):
+        """Parameters influencing the estimated shifts"""
+        return {"partitions_size": self.partitions_size,
+                "max_iterations": self.max_iterations,
+                "shift_threshold": self.shift_threshold,
+                "local_search_window": self.local_search_window,
+                "low_memory": self.low_memory,
+                "alignment_mode": self.alignment_mode,
+                "reference_frame": self.reference_frame,
+                "pair_window": self.pair_window,
+                "group_size": self.group_size,
+                "group_mode": self.group_mode,
+                "alignment_binning": self.alignment_binning}
 
     def add(self, img, data_check=True):
         if data_check:
@@ -25,47 +85,362 @@ class Movie:
         self.micrographs.append(img)
 
     @staticmethod
-    def relative_shifts(raw_data):
+    def relative_shifts(raw_data, max_shift=None):
         """Calculates shifts for list of two dimensional data with each other."""
-        total_sum = np.sum(raw_data, axis=0)
+        y_shifts, x_shifts, _ = Movie.align_stack(raw_data, max_shift)
+        return y_shifts, x_shifts
+
+    @staticmethod
+    def align_stack(raw_data, max_shift=None, max_iterations=10,
+                    threshold=0.2, low_memory=False, progress=None):
+        """Iteratively aligns each item of raw_data against the sum of all the
+        others. Items whose shift changed by less than threshold are considered
+        converged and are not aligned in the following iterations.
+        :param raw_data: list of two dimensional data, items are replaced by
+            their shifted versions
+        :param max_shift: None - the whole correlation map is searched, other
+            values restrict the search to shifts <-max_shift, max_shift>
+        :param max_iterations: maximal number of sweeps over raw_data
+        :param threshold: change of shift (in pixels) under which is an item
+            considered converged
+        :param low_memory: True - items of raw_data are left untouched, only
+            their shifts are tracked and shifted versions are created in a
+            fixed set of scratch buffers (memory usage is raw_data plus few
+            items instead of twice the raw_data plus temporaries)
+        :param progress: None or callable called as
+            progress("global", iteration, max_iterations) after each sweep
+            (it may raise to abort the alignment)
+        :return: (y_shifts, x_shifts, statistics) where statistics contains
+            dictionary for each iteration with keys iteration, aligned
+            (number of not yet converged items), max_change and mean_change"""
+        if low_memory:
+            total_sum = np.zeros(raw_data[0].shape)
+            for d in raw_data:
+                total_sum += d
+            shifted = np.empty_like(total_sum)
+        else:
+            total_sum = np.sum(raw_data, axis=0)
+            # shifted items are written into spare, the arrays created here
+            # (owned) are then reused as spare instead of a new array per shift
+            spare = None
+            owned = set()
+        sum_without_current = np.empty_like(total_sum)
 
         y_shifts = [0] * len(raw_data)
         x_shifts = [0] * len(raw_data)
-        iteration = 0
-        while iteration < 10:  # TODO: how many iterations?
-            iteration += 1
+        active = list(range(len(raw_data)))
+        statistics = []
+        for iteration in range(max_iterations):
             max_change = 0
-
-            for i in range(len(raw_data)):
-                current = raw_data[i]
-                sum_without_current = total_sum - current
+            total_change = 0
+            converged = []
+
+            for i in active:
+                if low_memory:
+                    # shifts are integer, so linear interpolation is exact
+                    current = Movie.correct_for_shift(
+                        raw_data[i], y_shifts[i], x_shifts[i], shifted, 1)
+                else:
+                    current = raw_data[i]
+                np.subtract(total_sum, current, out=sum_without_current)
 
                 # TODO: apply B-factor??
 
-                y, x = Movie.one_on_one_shift(sum_without_current, current)
+                y, x = Movie.one_on_one_shift(sum_without_current, current,
+                                              max_shift)
                 y_shifts[i] += y
                 x_shifts[i] += x
 
-                raw_data[i] = Movie.correct_for_shift(current, y, x)
-                total_sum = sum_without_current + raw_data[i]
-                max_change = max(max_change, max(abs(x), abs(y)))
-
-            if max_change < 0.2:  # TODO: what exact value?
+                if low_memory:
+                    current = Movie.correct_for_shift(
+                        raw_data[i], y_shifts[i], x_shifts[i], shifted, 1)
+                elif y != 0 or x != 0:
+                    if spare is None:
+                        spare = np.empty(current.shape)
+                        copy_tracking.record(spare.nbytes)
+                    raw_data[i] = Movie.correct_for_shift(current, y, x, spare)
+                    spare = current if i in owned else None
+                    owned.add(i)
+                    current = raw_data[i]
+                np.add(sum_without_current, current, out=total_sum)
+
+                change = max(abs(x), abs(y))
+                max_change = max(max_change, change)
+                total_change += change
+                if change < threshold:
+                    converged.append(i)
+
+            statistics.append({"iteration": iteration + 1,
+                               "aligned": len(active),
+                               "max_change": max_change,
+                               "mean_change": total_change / len(active)})
+            if progress is not None:
+                progress("global", iteration + 1, max_iterations)
+
+            active = [i for i in active if i not in converged]
+            if max_change < threshold or not active:
                 break
 
+        return y_shifts, x_shifts, statistics
+
+    @staticmethod
+    def alignment_threads(workers, task_count):
+        """Number of threads of the parallel alignment modes. Each of them
+        gets its share of the FFT workers of the current backend (see
+        fourier.bind), so the correlations don't oversubscribe the cpus.
+        :param workers: None - the default of ThreadPoolExecutor
+            (min(32, number of cpus + 4)), otherwise the number of threads
+        :param task_count: number of correlations, there are never more
+            threads than correlations"""
+        if workers is None:
+            workers = min(32, (os.cpu_count() or 1) + 4)
+        return max(1, min(workers, task_count))
+
+    @staticmethod
+    def reference_shifts(raw_data, reference=None, max_shift=None,
+                         workers=None):
+        """Aligns each item of raw_data to one fixed reference. Items are not
+        modified and correlations run in parallel.
+        :param reference: None - sum of all items, integer - index of the
+            reference item, otherwise two dimensional reference data
+        :param workers: number of threads (see alignment_threads)
+        :return: (y_shifts, x_shifts) by which should be the items shifted"""
+        if reference is None:
+            reference = np.zeros(raw_data[0].shape)
+            for d in raw_data:
+                reference += d
+        elif isinstance(reference, (int, np.integer)):
+            reference = raw_data[reference]
+
+        threads = Movie.alignment_threads(workers, len(raw_data))
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            shifts = list(executor.map(fourier.bind(
+                lambda d: Movie.one_on_one_shift(reference, d, max_shift),
+                threads), raw_data))
+        return [s[0] for s in shifts], [s[1] for s in shifts]
+
+    @staticmethod
+    def pairwise_shifts(raw_data, max_shift=None, window=None, workers=None):
+        """Correlates all pairs of items (or only those whose indices differ by
+        at most window) and finds shifts of the items which agree with the
+        relative shifts of the pairs in the least squares sense. Shifts are
+        fixed by requiring their zero mean.
+        :param window: None - all pairs, otherwise maximal difference of
+            indices of correlated items
+        :param workers: number of threads (see alignment_threads)
+        :return: (y_shifts, x_shifts) by which should be the items shifted"""
+        count = len(raw_data)
+        if window is None:
+            window = count - 1
+        if window < 1:
+            raise ValueError("Pair window has to be at least 1, not " +
+                             str(window))
+        pairs = [(i, j) for i in range(count)
+                 for j in range(i + 1, min(i + window + 1, count))]
+        if not pairs:
+            return [0.0] * count, [0.0] * count
+
+        threads = Movie.alignment_threads(workers, len(pairs))
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            relative = np.array(list(executor.map(fourier.bind(
+                lambda p: Movie.one_on_one_shift(raw_data[p[0]],
+                                                 raw_data[p[1]], max_shift),
+                threads), pairs)))
+
+        # relative shift of pair (i, j) is shift[j] - shift[i], the last
+        # equation sets the mean to zero
+        system = np.zeros((len(pairs) + 1, count))
+        for row, (i, j) in enumerate(pairs):
+            system[row, i] = -1
+            system[row, j] = 1
+        system[-1] = 1
+        rhs = np.vstack((relative, np.zeros((1, 2))))
+        shifts = np.linalg.lstsq(system, rhs, rcond=None)[0]
+        return list(shifts[:, 0]), list(shifts[:, 1])
+
+    @staticmethod
+    def group_frames(raw_data, time_stamps, group_size, mode="fixed"):
+        """Sums groups of group_size consecutive items of raw_data, so that
+        fewer and less noisy items are aligned.
+        :param time_stamps: time stamps of the items
+        :param mode: "fixed" - non-overlapping groups (the last one may be
+            smaller), "sliding" - group starting at each item for which it is
+            complete
+        :return: (sums, times) - list of sums of the groups and mean time
+            stamps of their items"""
+        if group_size < 1:
+            raise ValueError("Group size has to be at least 1, not " +
+                             str(group_size))
+        if mode == "fixed":
+            starts = range(0, len(raw_data), group_size)
+        elif mode == "sliding":
+            starts = range(max(len(raw_data) - group_size, 0) + 1)
+        else:
+            raise ValueError("Unknown group mode: '" + str(mode) + "'")
+
+        sums = []
+        times = []
+        for start in starts:
+            total = np.zeros(raw_data[start].shape)
+            for d in raw_data[start:start + group_size]:
+                total += d
+            sums.append(total)
+            times.append(float(np.mean(time_stamps[start:start + group_size])))
+        return sums, times
+
+    @staticmethod
+    def interpolate_shifts(group_times, shifts, time_stamps):
+        """Linearly interpolates shifts of groups (see group_frames) to the
+        time stamps of the individual frames. Outside of the group times the
+        first or last segment is extrapolated.
+        :return: list of shifts in time_stamps"""
+        order = np.argsort(group_times)
+        group_times = np.asarray(group_times, dtype=float)[order]
+        shifts = np.asarray(shifts, dtype=float)[order]
+        time_stamps = np.asarray(time_stamps, dtype=float)
+        if len(group_times) == 1:
+            return [shifts[0]] * len(time_stamps)
+
+        res = np.interp(time_stamps, group_times, shifts)
+        for end, neighbour in ((0, 1), (-1, -2)):
+            slope = (shifts[end] - shifts[neighbour]) / \
+                (group_times[end] - group_times[neighbour])
+            outside = time_stamps < group_times[0] if end == 0 else \
+                time_stamps > group_times[-1]
+            res[outside] = shifts[end] + \
+                (time_stamps[outside] - group_times[end]) * slope
+        return list(res)
+
+    def coarse_global_shift(self, binning, progress=None):
+        """Quick global alignment of binned micrographs (micrographs are not
+        modified), alignment_mode and grouping are the same as in
+        correct_global_shift.
+        :param binning: binning factor
+        :param progress: None or progress callback (see align_stack)
+        :return: (y_shifts, x_shifts, aligned_sum) where shifts are in the
+            pixels of the full resolution micrographs and aligned_sum is the
+            binned sum of the aligned micrographs"""
+        binned = [my_math.bin_data(m.image_data, binning)
+                  for m in self.micrographs]
+        # estimate_shifts may replace items of the list, not the binned data
+        y_shifts, x_shifts = self.estimate_shifts(list(binned),
+                                                  progress=progress)
+        aligned_sum = np.zeros(binned[0].shape)
+        shifted = np.empty_like(aligned_sum)
+        for d, y, x in zip(binned, y_shifts, x_shifts):
+            aligned_sum += self.correct_for_shift(d, y, x, shifted, 1)
+        return [y * binning for y in y_shifts], \
+            [x * binning for x in x_shifts], aligned_sum
+
+    def estimate_shifts(self, raw_data, max_shift=None, progress=None):
+        """Global shifts of raw_data (one item per micrograph) by the
+        alignment_mode, frames are grouped when group_size is set.
+        :param raw_data: list of two dimensional data, its items may be
+            replaced (see align_stack)
+        :param progress: None or progress callback of align_stack (used only
+            by the leave_one_out alignment)
+        :return: (y_shifts, x_shifts) in the pixels of raw_data"""
+        time_stamps = [m.time_stamp for m in self.micrographs]
+        if self.group_size > 1:
+            raw_data, group_times = self.group_frames(
+                raw_data, time_stamps, self.group_size, self.group_mode)
+
+        if self.alignment_mode == "leave_one_out":
+            y_shifts, x_shifts, _ = self.align_stack(raw_data, max_shift,
+                                                     self.max_iterations,
+                                                     self.shift_threshold,
+                                                     self.low_memory,
+                                                     progress)
+        elif self.alignment_mode == "reference":
+            y_shifts, x_shifts = self.reference_shifts(
+                raw_data, self.reference_frame, max_shift,
+                self.alignment_workers)
+        elif self.alignment_mode == "all_pairs":
+            y_shifts, x_shifts = self.pairwise_shifts(
+                raw_data, max_shift, self.pair_window, self.alignment_workers)
+        else:
+            raise ValueError("Unknown alignment mode: '" +
+                             str(self.alignment_mode) + "'")
+
+        if self.group_size > 1:
+            y_shifts = self.interpolate_shifts(group_times, y_shifts,
+                                               time_stamps)
+            x_shifts = self.interpolate_shifts(group_times, x_shifts,
+                                               time_stamps)
         return y_shifts, x_shifts
 
-    def correct_global_shift(self):
+    def correct_global_shift(self, initial_shifts=None, max_shift=None,
+                             progress=None):
+        """Aligns all micrographs with each other. When low_memory is set,
+        micrographs are corrected in place.
+        :param initial_shifts: None or (y_shifts, x_shifts) already estimated
+            e.g. by coarse_global_shift, alignment then only refines them
+            (on shifted copies of the micrographs, with low_memory the
+            micrographs are shifted in place first)
+        :param max_shift: None or maximal searched shift (in addition to the
+            initial shifts)
+        :param progress: None or progress callback (see align_stack)
+        :return: (y_shifts, x_shifts) by which were the micrographs corrected"""
         if not self.micrographs:
-            return
-
-        raw_data = [np.copy(m.image_data) for m in self.micrographs]
+            return [], []
+
+        if initial_shifts is not None and self.low_memory:
+            # no shifted copies, the frames are interpolated twice instead
+            # (which is exact for the integer shifts of align_stack)
+            self.apply_shifts(*initial_shifts)
+            y_shifts, x_shifts = self.correct_global_shift(None, max_shift,
+                                                           progress)
+            return [y + i for y, i in zip(y_shifts, initial_shifts[0])], \
+                [x + i for x, i in zip(x_shifts, initial_shifts[1])]
+
+        # align_stack replaces items of the list, it never writes into them
+        binning = self.alignment_binning
+        scratch = None
+        if initial_shifts is not None and binning > 1:
+            # shifted frames are needed only until they are binned
+            scratch = np.empty(self.micrographs[0].shape())
+        raw_data = []
+        for i, m in enumerate(self.micrographs):
+            d = m.image_data
+            if initial_shifts is not None:
+                d = self.correct_for_shift(d, initial_shifts[0][i],
+                                           initial_shifts[1][i], scratch)
+            if binning > 1:
+                d = my_math.bin_data(d, binning)
+            raw_data.append(d)
+        if binning > 1 and max_shift is not None:
+            max_shift = int(math.ceil(max_shift / binning))
+
+        y_shifts, x_shifts = self.estimate_shifts(raw_data, max_shift,
+                                                  progress)
+        if binning > 1:
+            y_shifts = [y * binning for y in y_shifts]
+            x_shifts = [x * binning for x in x_shifts]
+        if initial_shifts is not None:
+            y_shifts = [y + i for y, i in zip(y_shifts, initial_shifts[0])]
+            x_shifts = [x + i for x, i in zip(x_shifts, initial_shifts[1])]
+        self.apply_shifts(y_shifts, x_shifts)
 
-        y_shifts, x_shifts = self.relative_shifts(raw_data)
+        return y_shifts, x_shifts
 
+    def apply_shifts(self, y_shifts, x_shifts):
+        """Corrects each micrograph for its (already known) shift. When
+        low_memory is set, writable floating point micrographs are corrected
+        in place through one scratch buffer."""
+        scratch = None
         for i, m in enumerate(self.micrographs):
-            m.image_data = self.correct_for_shift(m.image_data, y_shifts[i],
-                                                  x_shifts[i])
+            data = m.image_data
+            if self.low_memory and data.flags.writeable and \
+                    np.issubdtype(data.dtype, np.floating):
+                if scratch is None or scratch.shape != data.shape:
+                    scratch = np.empty(data.shape)
+                res = self.correct_for_shift(data, y_shifts[i], x_shifts[i],
+                                             scratch)
+                if res is scratch:
+                    data[...] = scratch
+            else:
+                m.image_data = self.correct_for_shift(data, y_shifts[i],
+                                                      x_shifts[i])
 
     @staticmethod
     def partitions_sizes(shape, partition_axis_count=5):
@@ -84,8 +459,9 @@ class Movie:
 
     def partition(self, raw_data):
         """Returns partitioned micrographs i.e. each micrograph is divided into
-        25 partitions. When it is not possible to divide axis into 5 equal
-        partitions several first partitions are expanded by one item.
+        partitions_size x partitions_size (by default 25) partitions. When it
+        is not possible to divide axis into equal partitions several first
+        partitions are expanded by one item.
         :param raw_data list of micrographs [micrograph][y][x]
         :return [stack_index \in <0,24>][micrograph][y][x]"""
         partition_size = self.partitions_size
@@ -94,7 +470,7 @@ class Movie:
         # partitions along horizontal and vertical axis
         def size_to_splits(size):
             return [sum(size[:i]) for i in range(len(size))][1:]
-        sizes = self.partitions_sizes(raw_data[0].shape)
+        sizes = self.partitions_sizes(raw_data[0].shape, partition_size)
 
         vsplits = size_to_splits(sizes[0])
         hsplits = size_to_splits(sizes[1])
@@ -118,15 +494,25 @@ class Movie:
                 res[i].append(s)
         return res
 
-    def calculate_local_shifts(self):
-        """
+    def calculate_local_shifts(self, progress=None):
+        """Calculates shifts of the individual partitions. Shifts are searched
+        only in the local_search_window around zero (the global shift is
+        expected to be already corrected). Statistics of the alignment of each
+        partition stack are stored in local_statistics.
+        :param progress: None or callable called as
+            progress("local", aligned partitions, number of partitions) after
+            each partition stack (it may raise to abort the alignment)
         :return: ([(y,x,t)], [(shift_y, shift_x)])
         """
         psize = self.partitions_size
+        binning = self.alignment_binning
         raw_data = [m.image_data for m in self.micrographs]
+        if binning > 1:
+            raw_data = [my_math.bin_data(d, binning) for d in raw_data]
         partitions = self.partition(raw_data)
 
         # calculate positions
+        center = (binning - 1) / 2
         center_pos = []
         for it in range(len(raw_data)):
             last = [0, 0]
@@ -134,9 +520,9 @@ class Movie:
                 size_y = p[it].shape[0]
                 size_x = p[it].shape[1]
 
-
-                center_pos.append((last[0] + size_y // 2,
-                                   last[1] + size_x // 2,
+                # centre of the binned pixel in the full resolution pixels
+                center_pos.append(((last[0] + size_y // 2) * binning + center,
+                                   (last[1] + size_x // 2) * binning + center,
                                    self.micrographs[it].time_stamp))
 
                 last[1] += size_x
@@ -145,8 +531,26 @@ class Movie:
                     last[0] += size_y
 
         # calculate shifts
-        data = [np.copy(m) for m in partitions]
-        shifts = [self.relative_shifts(stack) for stack in data]
+        # lists of views, align_stack only replaces their items
+        data = [list(m) for m in partitions]
+        time_stamps = [m.time_stamp for m in self.micrographs]
+        if self.group_size > 1:
+            grouped = [self.group_frames(stack, time_stamps, self.group_size,
+                                         self.group_mode) for stack in data]
+            data = [g[0] for g in grouped]
+        shifts = []
+        for stack in data:
+            shifts.append(self.align_stack(stack, self.local_search_window,
+                                           self.max_iterations,
+                                           self.shift_threshold))
+            if progress is not None:
+                progress("local", len(shifts), len(data))
+        self.local_statistics = [s[2] for s in shifts]
+        if self.group_size > 1:
+            group_times = grouped[0][1]
+            shifts = [(self.interpolate_shifts(group_times, s[0], time_stamps),
+                       self.interpolate_shifts(group_times, s[1], time_stamps))
+                      for s in shifts]
         # We have [stack][axis][time] and want [stack * time](shift_x, shift_y)
         time = len(shifts[0][0])
         time_stack = time * len(shifts)
@@ -154,30 +558,108 @@ class Movie:
         s_x = [None] * time_stack
         for ti in range(time):
             for si in range(len(shifts)):
-                s_y[ti * len(shifts) + si] = shifts[si][0][ti]
-                s_x[ti * len(shifts) + si] = shifts[si][1][ti]
+                s_y[ti * len(shifts) + si] = shifts[si][0][ti] * binning
+                s_x[ti * len(shifts) + si] = shifts[si][1][ti] * binning
 
         return center_pos, s_y, s_x
 
     @staticmethod
-    def one_on_one_shift(main, template):
+    def one_on_one_shift(main, template, max_shift=None):
         """Calculates by how much is template shifted in relation to the main
-        (template is doing the shifting)"""
-        template = template[::-1, ::-1]  # we are using convolution
-        corr = signal.fftconvolve(main, template)
-        y, x = np.unravel_index(np.argmax(corr), corr.shape)  # find the match
-        # resulting array has size + 2 * size // 2 size and no movement means
-        # that highest peak is at size // 2 coordinates (this works for odd
-        # sizes, even sizes are inherently imprecise so TODO:)
-        y = (corr.shape[0] // 2) - y
-        x = (corr.shape[1] // 2) - x
-        return y, x
-
-    def load_compact_mrc(self, file_path, time_points):
-        """Loads movie from mrc file. (All frames are saved in one mrc file)"""
-        with mrc.open(file_path) as f:
+        (template is doing the shifting)
+        :param max_shift: None - all possible shifts are considered, other
+            values restrict the result to <-max_shift, max_shift> on both axes
+            which is considerably cheaper as data are padded just by max_shift
+        """
+        my = main.shape[0] - 1
+        mx = main.shape[1] - 1
+        if max_shift is not None:
+            my = min(max_shift, my)
+            mx = min(max_shift, mx)
+
+        window = fourier.correlate(main, template, (my, mx))
+
+        if window[my][mx] >= window.max():  # prefer no movement on ties
+            return 0, 0
+        y, x = np.unravel_index(np.argmax(window), window.shape)  # find match
+        # window is centered on no movement and correlation peak at +k means
+        # that template is shifted by -k
+        return my - int(y), mx - int(x)
+
+    def load_image_sequence(self, paths, time_points, workers=None,
+                            progress=None):
+        """Loads movie from a sequence of image files (png, jpg, ...). All
+        frames are decoded (and preprocessed) in parallel directly into one
+        preallocated array of shape (len(paths), height, width), whose slices
+        are the frames.
+        :param paths: paths to gray-scale (or color) images
+        :param time_points: time stamps of the images
+        :param workers: number of decoding threads, None - chosen by
+            concurrent.futures
+        :param progress: None or callable called as
+            progress("load", loaded frames, number of frames) after each frame
+            (it may raise to abort the loading)"""
+        if len(self.micrographs) != 0:  # already contains data
+            warnings.warn("Loading image sequence into non-empty movie.")
+            self.micrographs = []
+
+        if len(paths) != len(time_points):
+            raise ValueError("Length of time_points doesn't correspond to " +
+                             "the number of paths.")
+        if len(set(time_points)) != len(time_points):
+            raise RuntimeError("Movie contains two micrographs with equal " +
+                               "time stamps.")
+        if len(paths) == 0:
+            return
+
+        first = Image.read_gray(paths[0])
+        raw_shape = first.shape
+        first = self.preprocess(first)
+        stack = np.empty((len(paths),) + first.shape)
+        stack[0] = first
+        if progress is not None:
+            progress("load", 1, len(paths))
+
+        def decode(i):
+            if self.preprocessor is None:
+                Image.read_gray(paths[i], stack[i])
+                return
+
+            data = Image.read_gray(paths[i])
+            if data.shape != raw_shape:
+                raise RuntimeError("Image '" + paths[i] + "' has shape " +
+                                   str(data.shape) + " instead of " +
+                                   str(raw_shape))
+            stack[i] = self.preprocessor(data)
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(decode, i)
+                       for i in range(1, len(paths))]
+            try:
+                for i, future in enumerate(futures):
+                    # result() propagates exceptions raised in the threads
+                    future.result()
+                    if progress is not None:
+                        progress("load", i + 2, len(paths))
+            finally:
+                # frames not yet decoded are skipped when aborted
+                for future in futures:
+                    future.cancel()
+
+        for data, t in zip(stack, time_points):
+            self.add(Image(time_stamp=t, img_data=data), data_check=False)
+
+    def load_compact_mrc(self, file_path, time_points, progress=None):
+        """Loads movie from mrc file. (All frames are saved in one mrc file)
+        When preprocessor is set, uncompressed file is memory mapped and only
+        the preprocessed frames are kept in memory.
+        :param progress: None or callable called as
+            progress("load", loaded frames, number of frames) after each frame
+            (it may raise to abort the loading)"""
+        with mrc_io.open_mrc(file_path, self.preprocessor is not None) as \
+                (f, scaling):
             if len(self.micrographs) != 0:  # already conatins data
-                warning.warn("Loading mrc file data inro non-empty file.")
+                warnings.warn("Loading mrc file data inro non-empty file.")
                 self.micrographs = []
 
             if len(time_points) != len(f.data):
@@ -185,29 +667,125 @@ class Movie:
                                  "to the number of images contained in file.")
 
             for img,t in zip(f.data, time_points):
-                self.add(Image(time_stamp = t, img_data = img))
+                self.add(Image(time_stamp = t, img_data = self.preprocess(
+                    mrc_io.decode(img, scaling))))
+                if progress is not None:
+                    progress("load", len(self.micrographs), len(time_points))
+
 
+    def preprocess(self, data):
+        """Applies preprocessor on raw frame data (if there is any)"""
+        if self.preprocessor is None:
+            return data
+        return self.preprocessor(data)
 
     def sum_images(self):
         """Sums all images"""
-        return np.sum((m.image_data for m in self.micrographs), axis=0)
-
-    def save_movie_mrc(self, file_path):
-        """Saves the whole movie into mrc file without dose informations"""
+        return sum(m.image_data for m in self.micrographs)
+
+    def save_movie_mrc(self, file_path, data_format="float32",
+                       compression=None, workers=None):
+        """Saves the whole movie into mrc file without dose informations
+        :param data_format: one of mrc_io.FORMATS (float64 is not compatible
+            with mrc file format)
+        :param compression: None, "gzip" or "bzip2"
+        :param workers: number of compressing threads"""
         if len(self.micrographs) == 0:
-            warning.warn("Trying to save movie without frames")
+            warnings.warn("Trying to save movie without frames")
             return
 
-        # merge images into one 3D one with float32 data format (float64 is not
-        # compatible with mrc file format)
+        # merge images into one 3D one
         res = np.array([i.image_data for i in self.micrographs])
-        cp = res.astype(dtype=np.float32)
+        mrc_io.write(file_path + "movie.mrc", res, data_format, compression,
+                     workers)
+
+    def load_movie_starfile(self, file_path, workers=None, progress=None):
+        """Loads movie saved by save_movie_starfile i.e. STAR file with _image
+        and _time labels in its loop. Paths of the images are relative to the
+        folder of the STAR file. Frames are loaded (and preprocessed) in
+        parallel.
+        :param file_path: path to the STAR (xmd) file
+        :param workers: number of loading threads, None - chosen by
+            concurrent.futures
+        :param progress: None or callable called as
+            progress("load", loaded frames, number of frames) after each frame
+            (it may raise to abort the loading)"""
+        if len(self.micrographs) != 0:  # already contains data
+            warnings.warn("Loading STAR file data into non-empty movie.")
+            self.micrographs = []
+
+        names, time_points = self.read_starfile(file_path)
+        folder_path = os.path.dirname(file_path)
+
+        def load(item):
+            img = Image()
+            img.load_mrc(os.path.join(folder_path, item[0]), item[1])
+            img.image_data = self.preprocess(img.image_data)
+            return img
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(load, item)
+                       for item in zip(names, time_points)]
+            try:
+                for future in futures:
+                    self.add(future.result())
+                    if progress is not None:
+                        progress("load", len(self.micrographs), len(names))
+            finally:
+                # frames not yet loaded are skipped when aborted
+                for future in futures:
+                    future.cancel()
 
-        with mrc.new(file_path + "movie.mrc", overwrite=True) as f:
-            f.set_data(cp)
-            f.set_image_stack()
-
-    def save_movie_starfile(self, folder_path, file_name):
+    @staticmethod
+    def read_starfile(file_path):
+        """Reads loop of the STAR file written by save_movie_starfile.
+        :return: ([image names], [time stamps])
+        :raises ValueError: when the file contains no loop, a loop misses
+            _image or _time label or its row doesn't have value for each
+            label"""
+        labels = []
+        names = []
+        time_points = []
+        in_loop = False
+        found_loop = False
+        with open(file_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("data_"):
+                    # new data block ends the loop of the previous one
+                    in_loop = False
+                elif line == "loop_":
+                    # each loop has its own labels
+                    in_loop = True
+                    found_loop = True
+                    labels = []
+                elif in_loop and line.startswith("_"):
+                    labels.append(line.split()[0])
+                elif in_loop:
+                    for label in ("_image", "_time"):
+                        if label not in labels:
+                            raise ValueError("Loop in file '" + file_path +
+                                             "' is missing " + label +
+                                             " label.")
+                    values = line.split()
+                    if len(values) != len(labels):
+                        raise ValueError("Row '" + line + "' in file '" +
+                                         file_path + "' has " +
+                                         str(len(values)) + " values " +
+                                         "instead of " + str(len(labels)) +
+                                         ".")
+                    names.append(values[labels.index("_image")])
+                    time_points.append(float(values[labels.index("_time")]))
+
+        if not found_loop:
+            raise ValueError("File '" + file_path + "' doesn't contain loop " +
+                             "with _image and _time labels.")
+        return names, time_points
+
+    def save_movie_starfile(self, folder_path, file_name, workers=None,
+                            data_format="float32", compression=None):
         """Saves the whole movie into STAR format file defined in XMIPP
         (http://xmipp.cnb.csic.es/twiki/bin/view/Xmipp/FileFormats#Metadata_Files),
         where each image is individually saved into mrc file. Beside references
@@ -216,12 +794,20 @@ class Movie:
         :param folder_path: where to save the individual files
         :param file_name: how should be files named. STAR file will be
             "'name'.xmd" the image files will be imgxx_name.mrc, where xx is id
-            of image eg. 01, 23, ...."""
+            of image eg. 01, 23, ....
+        :param workers: number of threads writing the images, None - chosen
+            by concurrent.futures
+        :param data_format: one of mrc_io.FORMATS
+        :param compression: None, "gzip" or "bzip2"
+        """
         # save the images into mrc file
         names = [file_name + str(i).zfill(2) + ".mrc" for i in
                  range(len(self.micrographs))]
-        for name, img in zip(names, self.micrographs):
-            img.save_mrc(os.path.join(folder_path, name))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            # list() propagates exceptions raised in the threads
+            list(executor.map(lambda n, img: img.save_mrc(
+                os.path.join(folder_path, n), data_format, compression),
+                names, self.micrographs))
 
         # create the encapsulating STAR file
         with open(os.path.join(folder_path, file_name + ".xmd"), "w") as f:
@@ -249,9 +835,16 @@ class Movie:
         img.save(folder_path, ending)
 
     @staticmethod
-    def correct_for_shift(data, y_shift, x_shift):
+    def correct_for_shift(data, y_shift, x_shift, output=None, order=3):
         """Corrects for y_shift and x_shift. Meaning it shifts provided data by
-        -y_shift and -x_shift"""
+        -y_shift and -x_shift
+        :param output: None - new array is returned, otherwise array of the
+            same shape into which is the result written (data itself is
+            returned without copying when there is no shift)
+        :param order: order of the spline interpolation"""
         if x_shift == 0 and y_shift == 0:
             return data
-        return ndimage.interpolation.shift(data, (-y_shift, -x_shift), cval=0.0)
+        if output is None:
+            copy_tracking.record(data.nbytes)
+        return ndimage.shift(data, (-y_shift, -x_shift), output=output,
+                             order=order, cval=0.0)
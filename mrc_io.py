@@ -0,0 +1,241 @@
+"""Reading and writing of mrc files in compact formats. Besides the default
+float32 (mode 2), data can be stored as float16 (mode 12) or as integers
+(modes 0, 1, 6) scaled to the whole range of the type; the scaling is
+remembered in a header label. Files can be compressed by gzip or bzip2,
+compression runs in parallel on independent chunks which are concatenated
+into one multi-member stream readable by any gzip/bzip2 implementation.
+Files appear under their path only when they are complete. Reading detects
+all of this and returns float data, float32 unless the file stores float64,
+so the stored frames are not duplicated in double precision."""
+import bz2
+import concurrent.futures
+import contextlib
+import gzip
+import os
+import numpy as np
+import mrcfile as mrc
+
+FORMATS = {"float32": np.float32,
+           "float16": np.float16,
+           "int16": np.int16,
+           "uint16": np.uint16,
+           "int8": np.int8}
+COMPRESSIONS = {"gzip": gzip.compress, "bzip2": bz2.compress}
+SCALING_LABEL = "doming-generator scaling"
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def encode(data, data_format="float32"):
+    """Converts data into data_format.
+    :return: (converted data, (scale, offset)) where for integer formats
+        original = converted * scale + offset, for floats scaling is None"""
+    dtype = FORMATS[data_format]
+    if np.issubdtype(dtype, np.floating):
+        return np.asarray(data, dtype=dtype), None
+
+    info = np.iinfo(dtype)
+    low = float(np.min(data))
+    high = float(np.max(data))
+    scale = (high - low) / (info.max - info.min) if high > low else 1.0
+    offset = low - info.min * scale
+    res = np.empty(np.shape(data), dtype=dtype)
+    np.rint((np.asarray(data) - offset) / scale, out=res, casting="unsafe")
+    return res, (scale, offset)
+
+
+def write(path, data, data_format="float32", compression=None, workers=None):
+    """Writes two or three dimensional data (stack of images) into mrc file.
+    :param data_format: one of FORMATS
+    :param compression: None, "gzip" or "bzip2"
+    :param workers: number of compressing threads, None - chosen by
+        concurrent.futures"""
+    if data_format not in FORMATS:
+        raise ValueError("Unknown data format: '" + str(data_format) + "'")
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression: '" + str(compression) + "'")
+
+    encoded, scaling = encode(data, data_format)
+    tmp_path = path + ".tmp"
+    with mrc.new(tmp_path, overwrite=True) as f:
+        f.set_data(encoded)
+        if encoded.ndim == 3:
+            f.set_image_stack()
+        if scaling is not None:
+            f.header.label[f.header.nlabl] = "{0} {1!r} {2!r}".format(
+                SCALING_LABEL, *scaling)
+            f.header.nlabl += 1
+
+    if compression is not None:
+        try:
+            compress_file(tmp_path, path, compression, workers)
+        finally:
+            os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+class StackWriter:
+    """Writes stack of images into mrc file one frame at a time, so that the
+    whole stack never has to be held in memory. Only float formats are
+    supported as integer formats are scaled to the range of the whole stack.
+    The file appears under path only when all frames are written and the
+    writer is closed (compression, if any, is done then)."""
+
+    MODES = {"float32": 2, "float16": 12}
+
+    def __init__(self, path, frame_count, frame_shape=None,
+                 data_format="float32", compression=None, workers=None):
+        """
+        :param frame_count: number of frames which will be written
+        :param frame_shape: (height, width) of the frames, None - taken from
+            the first written frame
+        :param data_format: "float32" or "float16"
+        :param compression: None, "gzip" or "bzip2"
+        :param workers: number of compressing threads
+        """
+        if data_format not in self.MODES:
+            raise ValueError("Unsupported data format for streamed writing: '"
+                             + str(data_format) + "'")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression: '" + str(compression) + "'")
+
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.compression = compression
+        self.workers = workers
+        self.frame_count = frame_count
+        self.mode = self.MODES[data_format]
+        self.written = 0
+        self.file = None
+        if frame_shape is not None:
+            self.open(frame_shape)
+
+    def open(self, frame_shape):
+        self.file = mrc.new_mmap(self.tmp_path,
+                                 (self.frame_count,) + tuple(frame_shape),
+                                 self.mode, overwrite=True)
+        self.file.set_image_stack()
+
+    def write(self, frame):
+        """Writes the next frame"""
+        if self.file is None:
+            self.open(np.shape(frame))
+        if self.written == self.frame_count:
+            raise RuntimeError("All " + str(self.frame_count) +
+                               " frames were already written")
+        self.file.data[self.written] = frame
+        self.written += 1
+
+    def close(self):
+        """Finishes the file. Incomplete stack is discarded."""
+        if self.file is None:
+            if self.written != self.frame_count:
+                raise RuntimeError("No frames were written")
+            return
+        self.file.update_header_stats()
+        self.file.close()
+        self.file = None
+
+        if self.written != self.frame_count:
+            os.remove(self.tmp_path)
+            raise RuntimeError("Only " + str(self.written) + " of " +
+                               str(self.frame_count) + " frames were written")
+        if self.compression is not None:
+            try:
+                compress_file(self.tmp_path, self.path, self.compression,
+                              self.workers)
+            finally:
+                os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            # failed run, the partial stack is not kept
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp_path)
+
+
+def compress_file(source_path, path, compression, workers=None):
+    """Compresses source_path by chunks in parallel into path. The output is
+    written into temporary file in the same folder and renamed to path when
+    it is complete."""
+    compress = COMPRESSIONS[compression]
+    workers = workers or os.cpu_count() or 1
+    tmp_path = path + "." + compression + ".tmp"
+    try:
+        with open(source_path, "rb") as source, open(tmp_path, "wb") as f, \
+                concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            while True:
+                # at most 2 chunks per thread are held in memory
+                chunks = [source.read(CHUNK_SIZE) for i in range(2 * workers)]
+                chunks = [c for c in chunks if c]
+                if not chunks:
+                    break
+                # zlib and bz2 release the GIL while compressing
+                for compressed in executor.map(compress, chunks):
+                    f.write(compressed)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def is_compressed(path):
+    with open(path, "rb") as f:
+        magic = f.read(3)
+    return magic[:2] == b"\x1f\x8b" or magic == b"BZh"
+
+
+def scaling(f):
+    """(scale, offset) stored in the header of open mrc file or None"""
+    for label in f.header.label[:f.header.nlabl]:
+        label = label.decode(errors="ignore").strip()
+        if label.startswith(SCALING_LABEL):
+            scale, offset = label[len(SCALING_LABEL):].split()
+            return float(scale), float(offset)
+    return None
+
+
+def decode(data, file_scaling):
+    """Converts (part of) data read from mrc file into floats. float32 and
+    float64 data are returned without a copy, float16 and integer data are
+    converted into float32."""
+    if file_scaling is None:
+        if data.dtype in (np.float32, np.float64):
+            return data
+        return np.asarray(data, dtype=np.float32)
+    res = np.asarray(data, dtype=np.float32)
+    res *= np.float32(file_scaling[0])
+    res += np.float32(file_scaling[1])
+    return res
+
+
+@contextlib.contextmanager
+def open_mrc(path, mmap=False):
+    """Opens mrc file of any format for reading.
+    :param mmap: True - uncompressed files are memory mapped
+    :return: (mrcfile object, scaling)"""
+    if mmap and not is_compressed(path):
+        opener = mrc.mmap
+    else:
+        opener = mrc.open
+    with opener(path, mode="r") as f:
+        yield f, scaling(f)
+
+
+def read(path):
+    """Reads whole mrc file of any format.
+    :return: float32 (float64 when stored so) numpy array"""
+    with open_mrc(path) as (f, file_scaling):
+        res = decode(f.data, file_scaling)
+    # the data were read into memory owned only by the (closed) file
+    res.setflags(write=True)
+    return res
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 
 def point_distance(p1, p2):
@@ -63,3 +64,16 @@ def linear_interpolation(y1, x1, y2, x2, v11, v12, v21, v22, p_y, p_x):
 
     return p
 
+
+def bin_data(data, binning):
+    """
+    Bins two dimensional data by averaging binning x binning blocks. Incomplete
+    blocks at the bottom and right edge are discarded.
+    :param data: two dimensional numpy array
+    :param binning: size of the block
+    :return: numpy array of shape (height // binning, width // binning)
+    """
+    h = data.shape[0] // binning
+    w = data.shape[1] // binning
+    return data[:h * binning, :w * binning].reshape(
+        h, binning, w, binning).mean(axis=(1, 3))
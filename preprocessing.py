@@ -0,0 +1,127 @@
+"""Preprocessing of raw frames applied while they are loaded (see
+Movie.preprocessor). All steps are done in one pass over each frame, so the
+raw movie never has to be written back to disk."""
+import numpy as np
+import mrc_io
+import my_math
+import fourier
+
+
+class Preprocessor:
+    """Dark subtraction, gain reference multiplication, hot/dead pixel
+    replacement and binning of one frame. Instances are callable and can be
+    used concurrently from several threads.
+    """
+
+    def __init__(self, gain=None, dark=None, defect_mask=None,
+                 hot_pixel_sigma=None, binning=1, binning_mode="real"):
+        """
+        :param gain: None, numpy array or path to mrc file with gain reference
+            by which are frames multiplied
+        :param dark: None, numpy array or path to mrc file with dark reference
+            which is subtracted from frames (before gain multiplication)
+        :param defect_mask: None or boolean numpy array with True in known
+            defective (dead) pixels
+        :param hot_pixel_sigma: None or number of standard deviations above the
+            mean of a frame from which is a pixel considered hot
+        :param binning: binning factor
+        :param binning_mode: "real" - averaging of binning x binning blocks,
+            "fourier" - cropping of the spectrum
+        """
+        if binning_mode not in ("real", "fourier"):
+            raise ValueError("Unknown binning mode: '" + str(binning_mode) +
+                             "'")
+        self.gain = self.load_reference(gain)
+        self.dark = self.load_reference(dark)
+        self.defect_mask = defect_mask
+        self.hot_pixel_sigma = hot_pixel_sigma
+        self.binning = binning
+        self.binning_mode = binning_mode
+
+    @staticmethod
+    def load_reference(reference):
+        """Loads reference image from mrc file when path is provided"""
+        if isinstance(reference, str):
+            data = mrc_io.read(reference)
+            return data.reshape(data.shape[-2:])
+        return reference
+
+    def __call__(self, data):
+        """Preprocesses one frame.
+        :param data: two dimensional numpy array with raw frame (not modified)
+        :return: new float64 numpy array"""
+        for ref in (self.gain, self.dark, self.defect_mask):
+            if ref is not None and ref.shape != data.shape:
+                raise ValueError("Reference of shape " + str(ref.shape) +
+                                 " doesn't match frame of shape " +
+                                 str(data.shape))
+
+        # the only full size allocation, everything else is done in place
+        res = np.array(data, dtype=np.float64)
+        if self.dark is not None:
+            np.subtract(res, self.dark, out=res)
+        if self.gain is not None:
+            np.multiply(res, self.gain, out=res)
+
+        mask = self.defect_mask
+        if self.hot_pixel_sigma is not None:
+            hot = res > res.mean() + self.hot_pixel_sigma * res.std()
+            mask = hot if mask is None else hot | mask
+        if mask is not None:
+            self.replace_defects(res, mask)
+
+        if self.binning != 1:
+            if self.binning_mode == "real":
+                res = my_math.bin_data(res, self.binning)
+            else:
+                res = self.fourier_bin(res, self.binning)
+        return res
+
+    @staticmethod
+    def replace_defects(data, mask):
+        """Replaces pixels in mask by the median of their non-defective
+        neighbours (zero when there is none). Only the defective pixels are
+        touched.
+        :param data: two dimensional numpy array modified in place
+        :param mask: boolean numpy array of the same shape"""
+        ys, xs = np.nonzero(mask)
+        if len(ys) == 0:
+            return
+
+        values = []
+        valid = []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dy == 0 and dx == 0:
+                    continue
+                ny = ys + dy
+                nx = xs + dx
+                inside = (ny >= 0) & (ny < data.shape[0]) & \
+                    (nx >= 0) & (nx < data.shape[1])
+                ny = np.clip(ny, 0, data.shape[0] - 1)
+                nx = np.clip(nx, 0, data.shape[1] - 1)
+                values.append(data[ny, nx])
+                valid.append(inside & ~mask[ny, nx])
+
+        values = np.where(valid, values, np.nan)
+        counts = np.sum(valid, axis=0)
+        medians = np.zeros(len(ys))
+        has_valid = counts > 0
+        medians[has_valid] = np.nanmedian(values[:, has_valid], axis=0)
+        data[ys, xs] = medians
+
+    @staticmethod
+    def fourier_bin(data, binning):
+        """Bins data by cropping its spectrum to the low frequencies
+        :return: numpy array of shape (height // binning, width // binning)"""
+        h = data.shape[0] // binning
+        w = data.shape[1] // binning
+        spectrum = fourier.rfft2(data, data.shape)
+        top = (h + 1) // 2
+        bottom = h // 2
+        cropped = np.concatenate((spectrum[:top, :w // 2 + 1],
+                                  spectrum[data.shape[0] - bottom:,
+                                           :w // 2 + 1]))
+        # irfft2 normalizes by the smaller size, so the mean is preserved
+        # only after division by the ratio of the sizes
+        return fourier.irfft2(cropped, (h, w)) * (h * w) / data.size
@@ -0,0 +1,140 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import threading
+import numpy as np
+import skimage.io
+from unittest import mock
+import sys
+sys.path.append("..")
+import async_api
+import fourier
+import mrc_io
+from image import Image
+from movie import Movie
+
+
+def steps(count, tokens, started=None, progress=None):
+    """Blocking function with count check points, each of them takes one of
+    the tokens (threading.Semaphore)"""
+    if started is not None:
+        started.set()
+    for i in range(count):
+        tokens.acquire(timeout=5)
+        progress("step", i + 1, count)
+    return count
+
+
+class PipelineTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "source.png")
+        data = np.random.default_rng(0).integers(0, 255, (30, 40))
+        skimage.io.imsave(self.path, data.astype(np.uint8))
+        self.backend = fourier.get_backend()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        fourier.set_backend(*self.backend)
+
+    async def test_deform_file(self):
+        pipeline = async_api.Pipeline()
+        job = pipeline.deform_file(path=self.path, shape=(30, 40),
+                                   time_points=[0, 1, 2])
+        events = [e async for e in job]
+        self.assertEqual(events, [("deform", i, 3) for i in (1, 2, 3)])
+        results, coeffs = await job
+        self.assertEqual(len(results), 3)
+
+        frames, stream_coeffs = await pipeline.deform_file_stream(
+            path=self.path, shape=(30, 40), time_points=[0, 1, 2],
+            coefficients=coeffs)
+        streamed = [frame async for t, frame in frames]
+        for s, r in zip(streamed, results):
+            np.testing.assert_array_equal(s, r)
+
+    async def test_motion_correct_movie(self):
+        movie = Movie()
+        for i in range(3):
+            movie.add(Image(time_stamp=i, img_data=np.random.rand(20, 20)))
+        job = async_api.Pipeline().motion_correct_movie(
+            movie, coefficients=np.zeros((2, 9)))
+        events = [e async for e in job]
+        # sweeps of the global alignment precede the end of the stage
+        self.assertEqual(events[0][0], "global")
+        self.assertIn(("global", 1, 1), events)
+        self.assertEqual(events[-1], ("restore", 3, 3))
+        self.assertEqual((await job).shape, (20, 20))
+
+    async def test_cancel(self):
+        tokens = threading.Semaphore(1)
+        job = async_api.Job(steps, {"count": 100, "tokens": tokens}, None,
+                            asyncio.Semaphore(1))
+        self.assertEqual(await job.__anext__(), ("step", 1, 100))
+        job.cancel()
+        tokens.release(100)
+        with self.assertRaises(asyncio.CancelledError):
+            await job
+        self.assertTrue(job.cancelled())
+        # the worker stopped at the next check point
+        self.assertEqual([e async for e in job], [])
+
+    async def test_limiter(self):
+        limiter = asyncio.Semaphore(1)
+        tokens = threading.Semaphore(0)
+        started = [threading.Event(), threading.Event()]
+        jobs = [async_api.Job(steps, {"count": 1, "tokens": tokens,
+                                      "started": s}, None, limiter)
+                for s in started]
+        await asyncio.sleep(0.1)
+        self.assertTrue(started[0].is_set())
+        self.assertFalse(started[1].is_set())
+        tokens.release(2)
+        self.assertEqual([await j for j in jobs], [1, 1])
+        self.assertTrue(started[1].is_set())
+
+    async def test_fft_settings(self):
+        fourier.set_backend("scipy", 3)
+        limiter = asyncio.Semaphore(2)
+        jobs = [async_api.Job(lambda progress: fourier.get_backend(), {},
+                              None, limiter, fft_workers=w) for w in (1, 2)]
+        self.assertEqual([await j for j in jobs], [("scipy", 1),
+                                                   ("scipy", 2)])
+        self.assertEqual(fourier.get_backend(), ("scipy", 3))
+
+        pipeline = async_api.Pipeline(fft_backend="numpy")
+        frames, _ = await pipeline.deform_file_stream(
+            path=self.path, shape=(30, 40), time_points=[0, 1])
+        self.assertEqual(len([f async for f in frames]), 2)
+
+    async def test_cancel_deform_file(self):
+        written = threading.Event()
+        gate = threading.Event()
+        write = mrc_io.StackWriter.write
+
+        def blocking_write(writer, frame):
+            write(writer, frame)
+            written.set()
+            gate.wait(5)
+
+        with mock.patch.object(mrc_io.StackWriter, "write", blocking_write):
+            job = async_api.Pipeline().deform_file(
+                path=self.path, shape=(30, 40), time_points=[0, 1, 2],
+                save=self.tmp.name)
+            await asyncio.to_thread(written.wait, 5)
+            job.cancel()
+            gate.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await job
+        # the partial movie is removed
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         ["DeformationTime0.png", "source.png"])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, async_api.Pipeline, max_concurrent=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import os
+import tempfile
+import warnings
+import numpy as np
+from unittest import mock
+from scipy import ndimage
+import skimage.io
+import sys
+sys.path.append("..")
+import autotune
+import fourier
+import main
+from movie import Movie
+from preprocessing import Preprocessor
+
+
+class AutotuneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = fourier.get_backend()
+
+    def tearDown(self):
+        fourier.set_backend(*self.backend)
+
+    def test_budget(self):
+        profile = autotune.autotune((64, 60), 3, 1e6)
+        self.assertEqual(profile["binning"], autotune.BINNINGS[0])
+        self.assertEqual(profile["partitions_size"],
+                         autotune.PARTITIONS_SIZES[0])
+        self.assertEqual(profile["max_iterations"], autotune.ITERATIONS[0])
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            profile = autotune.autotune((64, 60), 3, 1e-9)
+            self.assertTrue(any("No parameters" in str(i.message) for i in w))
+        self.assertGreater(profile["estimated_seconds"], 1e-9)
+
+    def test_accuracy_order(self):
+        # only binning 1 with the coarsest settings fits among binning 1
+        def seconds(frame_shape, frame_count, binning, partitions_size,
+                    iterations, *args):
+            cheap = binning > 1 or (partitions_size, iterations) == (3, 3)
+            return 1 if cheap else 10
+
+        with mock.patch.object(autotune, "estimate_seconds",
+                               side_effect=seconds):
+            profile = autotune.autotune((64, 60), 3, 5)
+        # full settings at binning 2 are more accurate
+        self.assertEqual((profile["binning"], profile["partitions_size"],
+                          profile["max_iterations"]), (2, 5, 10))
+        self.assertLess(autotune.expected_error(2, 5, 10),
+                        autotune.expected_error(1, 3, 3))
+        self.assertLess(autotune.expected_error(1, 5, 10),
+                        autotune.expected_error(1, 5, 5))
+
+    def test_profile_reuse(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "profile.json")
+            profile = autotune.autotune((32, 32), 2, 1e6, path)
+            self.assertEqual(autotune.load_profile(path), profile)
+
+            # saved profile is returned without tuning
+            profile["binning"] = 4
+            autotune.save_profile(profile, path)
+            self.assertEqual(autotune.autotune((32, 32), 2, 1e6, path)
+                             ["binning"], 4)
+            self.assertNotEqual(autotune.autotune((32, 32), 2, 1e5, path)
+                                ["binning"], 4)
+
+    def test_apply_profile(self):
+        profile = {"binning": 2, "partitions_size": 3, "max_iterations": 4,
+                   "shift_threshold": 0.5, "local_search_window": 6,
+                   "fft_workers": 2}
+        movie = Movie()
+        fourier.set_backend("numpy", 1)
+        with autotune.apply_profile(movie, profile):
+            self.assertEqual(fourier.get_backend(), ("numpy", 2))
+        self.assertEqual(fourier.get_backend(), ("numpy", 1))
+        self.assertEqual(movie.partitions_size, 3)
+        self.assertEqual(movie.max_iterations, 4)
+        self.assertEqual(movie.shift_threshold, 0.5)
+        self.assertEqual(movie.local_search_window, 6)
+        self.assertEqual(movie.alignment_binning, 2)
+        self.assertIsNone(movie.preprocessor)
+
+    def test_profiled_run(self):
+        profile = {"binning": 2, "partitions_size": 3, "max_iterations": 4,
+                   "shift_threshold": 0.5, "local_search_window": 4,
+                   "fft_workers": 2}
+        preprocessor = Preprocessor()
+        fourier.set_backend("scipy", 1)
+        rng = np.random.default_rng(0)
+        data = ndimage.gaussian_filter(rng.integers(0, 255, (48, 60)), 2)
+        data = data.astype(np.uint8)
+        with tempfile.TemporaryDirectory() as folder:
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(folder, str(i) + ".png"))
+                skimage.io.imsave(paths[-1], np.roll(data, 2 * i, axis=1))
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                res = main.motion_correct_files(paths, [0, 1, 2],
+                                                verbose=False,
+                                                preprocessor=preprocessor,
+                                                profile=profile)
+
+        # binning is used only by the alignment
+        self.assertEqual(res.shape, (48, 60))
+        self.assertEqual(preprocessor.binning, 1)
+        self.assertEqual(fourier.get_backend(), ("scipy", 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
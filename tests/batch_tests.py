@@ -0,0 +1,110 @@
+import unittest
+import multiprocessing
+import os
+import tempfile
+import time
+import json
+import sys
+sys.path.append("..")
+import batch
+
+
+def record_job(job, output_path):
+    """Fails when the job is processed twice"""
+    fd = os.open(output_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    os.close(fd)
+    time.sleep(0.01)
+
+
+def run_node(work_path, node_id):
+    batch.BatchRunner(work_path, node_id, lease_time=5.0,
+                      poll_interval=0.05, process=record_job).run()
+
+
+class BatchRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.jobs = [{"name": "movie" + str(i), "paths": [], "time_points": []}
+                     for i in range(20)]
+        batch.submit_jobs(self.tmp.name, self.jobs)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_several_nodes(self):
+        nodes = [multiprocessing.Process(target=run_node,
+                                         args=(self.tmp.name, "node" + str(i)))
+                 for i in range(4)]
+        for n in nodes:
+            n.start()
+        for n in nodes:
+            n.join()
+
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "failed")),
+                         [])
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "locks")), [])
+        for j in self.jobs:
+            with open(os.path.join(self.tmp.name, "done",
+                                   j["name"] + ".json")) as f:
+                self.assertTrue(json.load(f)["node"].startswith("node"))
+
+    def test_reclaim_stale_lease(self):
+        runner = batch.BatchRunner(self.tmp.name, "alive", lease_time=5.0,
+                                   process=record_job)
+        lock_path = os.path.join(self.tmp.name, "locks", "movie3")
+        with open(lock_path, "w") as f:
+            f.write("crashed")
+
+        self.assertIsNone(runner.claim("movie3"))
+        os.utime(lock_path, (time.time() - 10, time.time() - 10))
+        token = runner.claim("movie3")
+        self.assertIsNotNone(token)
+        self.assertTrue(runner.owns("movie3", token))
+        runner.release("movie3", token)
+
+        self.assertEqual(len(runner.run()), len(self.jobs))
+
+    def test_release_foreign_lease(self):
+        runner = batch.BatchRunner(self.tmp.name, "node", lease_time=5.0)
+        token = runner.claim("movie1")
+        lock_path = os.path.join(self.tmp.name, "locks", "movie1")
+        with open(lock_path, "w") as f:
+            f.write("other")
+        self.assertFalse(runner.release("movie1", token))
+        with open(lock_path) as f:
+            self.assertEqual(f.read(), "other")
+        self.assertFalse(runner.owns("movie1", token))
+        self.assertFalse(runner.release("movie2", token))
+
+    def test_lost_lease(self):
+        lock_path = os.path.join(self.tmp.name, "locks", "movie0")
+
+        def reclaimed(job, output_path):
+            # the lease disappears for a while (reclaimed by another node),
+            # the heartbeat notices it even though the lease is back later
+            with open(lock_path) as f:
+                content = f.read()
+            os.remove(lock_path)
+            time.sleep(0.1)
+            with open(lock_path, "w") as f:
+                f.write(content)
+
+        runner = batch.BatchRunner(self.tmp.name, "node", lease_time=0.03,
+                                   process=reclaimed)
+        token = runner.claim("movie0")
+        self.assertFalse(runner.run_job(self.jobs[0], token))
+        self.assertFalse(runner.finished("movie0"))
+
+    def test_failure(self):
+        def fail(job, output_path):
+            raise RuntimeError("broken movie")
+
+        runner = batch.BatchRunner(self.tmp.name, "node", process=fail)
+        self.assertEqual(len(runner.run()), len(self.jobs))
+        with open(os.path.join(self.tmp.name, "failed", "movie0.txt")) as f:
+            self.assertIn("broken movie", f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+import sys
+sys.path.append("..")
+import benchmark
+from deformation_model import DeformationModel
+
+
+class ErrorMeasuresTest(unittest.TestCase):
+
+    def test_displacement_error(self):
+        rng = np.random.default_rng(1)
+        coeffs = DeformationModel.generate_random_coeffs((40, 50), 4, rng)
+        time_points = [0, 1, 2, 3, 4]
+        no_shifts = ([0] * 5, [0] * 5)
+
+        self.assertAlmostEqual(benchmark.displacement_error(
+            (40, 50), time_points, coeffs, coeffs, no_shifts), 0)
+        # constant global shift is the same as no shift at all
+        self.assertAlmostEqual(benchmark.displacement_error(
+            (40, 50), time_points, coeffs, coeffs, ([2] * 5, [-1] * 5)), 0)
+        self.assertGreater(benchmark.displacement_error(
+            (40, 50), time_points, coeffs, np.zeros((2, 9)), no_shifts), 0)
+
+    def test_image_error(self):
+        reference = np.random.rand(20, 20)
+        self.assertEqual(benchmark.image_error(reference, reference), 0)
+
+        result = np.copy(reference)
+        result[0][0] = 100  # in the ignored border
+        self.assertEqual(benchmark.image_error(reference, result), 0)
+        result[10][10] += 1
+        self.assertGreater(benchmark.image_error(reference, result), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import os
+import numpy as np
+import sys
+sys.path.append("..")
+from cache import ShiftCache
+
+
+class ShiftCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_key(self):
+        frames = [np.zeros((4, 5)), np.ones((4, 5))]
+        key = ShiftCache.key(frames, [0, 1], {"partitions_size": 5})
+
+        self.assertEqual(key, ShiftCache.key([np.copy(f) for f in frames],
+                                             [0.0, 1.0],
+                                             {"partitions_size": 5}))
+        self.assertNotEqual(key, ShiftCache.key(frames, [0, 2],
+                                                {"partitions_size": 5}))
+        self.assertNotEqual(key, ShiftCache.key(frames, [0, 1],
+                                                {"partitions_size": 4}))
+        frames[1][2][3] = 2.0
+        self.assertNotEqual(key, ShiftCache.key(frames, [0, 1],
+                                                {"partitions_size": 5}))
+
+    def test_put_get_invalidate(self):
+        cache = ShiftCache(self.tmp.name)
+        self.assertIsNone(cache.get("abc"))
+
+        coeffs = np.arange(18.0).reshape(2, 9)
+        cache.put("abc", coeffs=coeffs, global_shifts=np.zeros((2, 3)))
+        entry = cache.get("abc")
+        np.testing.assert_array_equal(entry["coeffs"], coeffs)
+        self.assertEqual(entry["global_shifts"].shape, (2, 3))
+
+        cache.invalidate("abc")
+        self.assertIsNone(cache.get("abc"))
+
+        cache.put("a", coeffs=coeffs)
+        cache.put("b", coeffs=coeffs)
+        cache.invalidate()
+        self.assertEqual(cache.size(), 0)
+
+    def test_lru_eviction(self):
+        cache = ShiftCache(self.tmp.name)
+        data = np.zeros(1000)
+        cache.put("first", data=data)
+        cache.put("second", data=data)
+        entry_size = cache.size() // 2
+
+        # make "first" the most recently used one
+        os.utime(os.path.join(self.tmp.name, "second.npz"), (0, 0))
+        cache.get("first")
+
+        cache.max_size = entry_size * 2
+        cache.put("third", data=data)
+        self.assertIsNone(cache.get("second"))
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNotNone(cache.get("third"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import threading
+import numpy as np
+import sys
+sys.path.append("..")
+import copy_tracking
+import fourier
+from image import Image
+from movie import Movie
+
+
+class CopyTrackingTest(unittest.TestCase):
+
+    def setUp(self):
+        copy_tracking.enable()
+
+    def tearDown(self):
+        copy_tracking.enable(False)
+
+    def test_copy_on_write(self):
+        original = Image(time_stamp=0, img_data=np.zeros((4, 5)))
+        shared = Image()
+        shared.initialize_with_image(original)
+        self.assertTrue(np.shares_memory(original.image_data,
+                                         shared.image_data))
+        self.assertEqual(copy_tracking.report(), {})
+
+        shared.set(1, 2, 3.0)
+        self.assertEqual(shared.get(1, 2), 3.0)
+        self.assertEqual(original.get(1, 2), 0.0)
+        self.assertEqual(copy_tracking.report(), {"other": (1, 4 * 5 * 8)})
+
+        # data are owned now, so no other copy is made
+        shared.set(2, 2, 3.0)
+        self.assertEqual(copy_tracking.report()["other"][0], 1)
+
+        # the original is read-only as well, writing it leaves the first
+        # view intact
+        view = original.image_data
+        original.set(1, 2, 7.0)
+        self.assertEqual(original.get(1, 2), 7.0)
+        self.assertEqual(view[1, 2], 0.0)
+        self.assertEqual(copy_tracking.report()["other"][0], 2)
+
+    def test_stages(self):
+        with copy_tracking.stage("first"):
+            copy_tracking.copy(np.zeros(10))
+            with copy_tracking.stage("second"):
+                copy_tracking.record(3)
+            copy_tracking.record(2)
+        self.assertEqual(copy_tracking.report(),
+                         {"first": (2, 82), "second": (1, 3)})
+
+        copy_tracking.enable(False)
+        copy_tracking.record(5)
+        self.assertEqual(copy_tracking.report(), {})
+
+    def test_stages_of_threads(self):
+        # stage of one thread doesn't leak into another one
+        entered = threading.Event()
+        leave = threading.Event()
+
+        def other():
+            with copy_tracking.stage("other thread"):
+                entered.set()
+                leave.wait(5)
+                copy_tracking.record(1)
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        entered.wait(5)
+        with copy_tracking.stage("main"):
+            copy_tracking.record(2)
+            leave.set()
+            thread.join()
+            # bound function runs in the stage of the caller
+            thread = threading.Thread(
+                target=fourier.bind(lambda: copy_tracking.record(4)))
+            thread.start()
+            thread.join()
+        self.assertEqual(copy_tracking.report(),
+                         {"main": (2, 6), "other thread": (1, 1)})
+
+    def test_collect(self):
+        with copy_tracking.collect() as outer:
+            copy_tracking.record(1)
+            with copy_tracking.collect() as inner:
+                # other threads are not collected
+                thread = threading.Thread(
+                    target=lambda: copy_tracking.record(2))
+                thread.start()
+                thread.join()
+                with copy_tracking.stage("inner"):
+                    copy_tracking.record(4)
+        self.assertEqual(outer, {"other": (1, 1)})
+        self.assertEqual(inner, {"inner": (1, 4)})
+        self.assertEqual(copy_tracking.report(),
+                         {"other": (2, 3), "inner": (1, 4)})
+
+    def test_global_shift_keeps_frames(self):
+        data = np.zeros((20, 20))
+        data[5:8, 5:8] = 1
+        movie = Movie()
+        for i in range(3):
+            movie.add(Image(time_stamp=i, img_data=np.roll(data, i, axis=0)))
+        frames = [m.image_data for m in movie.micrographs]
+
+        with copy_tracking.stage("global"):
+            y, x = movie.correct_global_shift()
+        self.assertEqual(list(y), [-1, 0, 1])
+        np.testing.assert_array_equal(frames[2], np.roll(data, 2, axis=0))
+        # only the two shifted frames are new arrays, once during alignment
+        # and once when the shifts are applied
+        self.assertEqual(copy_tracking.report()["global"][0], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
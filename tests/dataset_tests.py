@@ -0,0 +1,100 @@
+import unittest
+import json
+import os
+import tempfile
+import numpy as np
+import skimage.io
+import sys
+sys.path.append("..")
+from image import Image
+import dataset
+
+
+class GenerateSampleTest(unittest.TestCase):
+
+    @staticmethod
+    def small_image():
+        img = Image()
+        img.time_stamp = 0
+        img.image_data = np.arange(12 * 16, dtype=float).reshape(12, 16)
+        return img
+
+    def test_reproducible(self):
+        img = self.small_image()
+        frames1, coeffs1 = dataset.generate_sample(img, [0, 1, 2],
+                                                   dataset.sample_rng(3, 7))
+        frames2, coeffs2 = dataset.generate_sample(img, [0, 1, 2],
+                                                   dataset.sample_rng(3, 7))
+        np.testing.assert_array_equal(coeffs1, coeffs2)
+        np.testing.assert_array_equal(frames1, frames2)
+
+        _, coeffs3 = dataset.generate_sample(img, [0, 1, 2],
+                                             dataset.sample_rng(3, 8))
+        self.assertFalse(np.array_equal(coeffs1, coeffs3))
+
+    def test_frames(self):
+        img = self.small_image()
+        frames, coeffs = dataset.generate_sample(img, [0, 1, 2],
+                                                 dataset.sample_rng(0, 0))
+        self.assertEqual(frames.shape, (3, 12, 16))
+        self.assertEqual(frames.dtype, np.float32)
+        self.assertEqual(coeffs.shape, (2, 9))
+        np.testing.assert_array_equal(frames[0], img.image_data)
+
+
+class GenerateDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "source.png")
+        data = np.random.default_rng(0).integers(0, 255, (48, 64))
+        skimage.io.imsave(self.source, data.astype(np.uint8))
+        self.folder = os.path.join(self.tmp.name, "dataset")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def generate(self, **kwargs):
+        # default shape (the one of shrink_to_reasonable)
+        return dataset.generate_dataset(self.folder, 3, [self.source],
+                                        time_points=[0, 1, 2], shard_size=2,
+                                        workers=1, verbose=False, **kwargs)
+
+    def read(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_restart(self):
+        manifest = self.read(self.generate())
+        self.assertEqual([e["sample"] for e in manifest], [0, 1, 2])
+        second = os.path.join(self.folder, dataset.shard_name(1))
+        with open(second + ".json") as f:
+            expected = json.load(f)
+        frames = dataset.mrc_io.read(second + ".mrc")
+        self.assertEqual(frames.shape, (3, 384, 512))
+
+        # interrupted run, the second shard is missing
+        os.remove(second + ".json")
+        os.remove(second + ".mrc")
+        self.assertEqual(self.read(self.generate()), manifest)
+        with open(second + ".json") as f:
+            self.assertEqual(json.load(f), expected)
+        np.testing.assert_array_equal(
+            dataset.mrc_io.read(second + ".mrc"), frames)
+
+        # more samples extend the dataset, the last shard is completed
+        extended = self.read(dataset.generate_dataset(
+            self.folder, 5, [self.source], time_points=[0, 1, 2],
+            shard_size=2, workers=1, verbose=False))
+        self.assertEqual(extended[:3], manifest)
+        self.assertEqual([e["sample"] for e in extended], [0, 1, 2, 3, 4])
+        self.assertEqual(self.read(self.generate()), manifest)
+
+        # shards of another dataset are not mixed in
+        self.assertRaises(ValueError, self.generate, seed=1)
+        os.remove(os.path.join(self.folder, "dataset.json"))
+        self.assertRaises(ValueError, self.generate)
+
+
+if __name__ == "__main__":
+    unittest.main()
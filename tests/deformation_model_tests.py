@@ -0,0 +1,248 @@
+import unittest
+import json
+import math
+import os
+import tempfile
+import numpy as np
+from unittest import mock
+import sys
+sys.path.append("..")
+import my_math
+from image import Image
+from deformation_model import DeformationModel
+
+
+class ApplyModelTest(unittest.TestCase):
+
+    @staticmethod
+    def image(shape):
+        img = Image()
+        img.time_stamp = 0
+        img.image_data = np.random.rand(*shape)
+        return img
+
+    @staticmethod
+    def model(shape, tn):
+        model = DeformationModel()
+        model.coeffs = DeformationModel.generate_random_coeffs(
+            shape, tn, np.random.default_rng(5))
+        return model
+
+    @staticmethod
+    def per_pixel(model, original, t1, t2):
+        """Reference implementation interpolating each pixel separately"""
+        res = np.zeros(original.shape())
+        for y in range(original.height()):
+            for x in range(original.width()):
+                posy = y + model.calculate_shift(y, x, t2, 0) - \
+                    model.calculate_shift(y, x, t1, 0)
+                posx = x + model.calculate_shift(y, x, t2, 1) - \
+                    model.calculate_shift(y, x, t1, 1)
+                y1 = math.floor(posy)
+                x1 = math.floor(posx)
+                res[y][x] = my_math.linear_interpolation(
+                    y1, x1, y1 + 1, x1 + 1, original.get(y1, x1),
+                    original.get(y1, x1 + 1), original.get(y1 + 1, x1),
+                    original.get(y1 + 1, x1 + 1), posy, posx)
+        return res
+
+    def test_apply_model(self):
+        img = self.image((13, 17))
+        model = self.model(img.shape(), 4)
+
+        for t1, t2 in [(0, 2), (0, 4), (3, 0)]:
+            res = model.apply_model(img, t1, t2)
+            self.assertEqual(res.time_stamp, t2)
+            np.testing.assert_array_almost_equal(
+                res.image_data, self.per_pixel(model, img, t1, t2))
+
+        res = model.apply_model(img, 2, 2)
+        np.testing.assert_array_equal(res.image_data, img.image_data)
+
+    def test_roi(self):
+        img = self.image((20, 24))
+        model = self.model(img.shape(), 4)
+
+        full = model.apply_model(img, 0, 3).image_data
+        res = model.apply_model(img, 0, 3, roi=(2, 5, 15, 24)).image_data
+        np.testing.assert_array_almost_equal(res, full[2:15, 5:24])
+
+        self.assertRaises(ValueError, model.apply_model, img, 0, 3,
+                          roi=(0, 0, 21, 24))
+
+    def test_binning(self):
+        img = self.image((20, 24))
+        model = self.model(img.shape(), 4)
+
+        res = model.apply_model(img, 1, 1, binning=2).image_data
+        np.testing.assert_array_almost_equal(
+            res, my_math.bin_data(img.image_data, 2))
+
+        res = model.apply_model(img, 1, 1, binning=4,
+                                roi=(4, 8, 16, 24)).image_data
+        np.testing.assert_array_almost_equal(
+            res, my_math.bin_data(img.image_data[4:16, 8:24], 4))
+
+        res = model.apply_model(img, 0, 3, binning=3).image_data
+        self.assertEqual(res.shape, (6, 8))
+
+    def test_binned_roi(self):
+        img = self.image((40, 48))
+        model = self.model(img.shape(), 4)
+
+        full = model.apply_model(img, 0, 3, binning=4).image_data
+        with mock.patch("my_math.bin_data", wraps=my_math.bin_data) as binned:
+            res = model.apply_model(img, 0, 3, binning=4,
+                                    roi=(8, 12, 24, 32)).image_data
+        np.testing.assert_array_almost_equal(res, full[2:6, 3:8])
+        # only the deformed roi (and its neighbourhood) is binned
+        cropped = binned.call_args[0][0]
+        self.assertLess(cropped.size, img.image_data.size)
+
+        # roi whose samples are all outside of the image
+        model.coeffs = np.zeros((2, 9))
+        model.coeffs[0, 0] = 100
+        model.coeffs[0, 6] = 1
+        res = model.apply_model(img, 0, 3, binning=4,
+                                roi=(8, 12, 24, 32)).image_data
+        np.testing.assert_array_equal(res, np.zeros((4, 5)))
+
+
+class TrajectoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = ApplyModelTest.model((100, 120), 10)
+        rng = np.random.default_rng(0)
+        self.positions = rng.uniform(0, 100, (37, 2))
+        self.time_points = [0, 0.5, 3, 10]
+
+    def test_trajectories(self):
+        res = self.model.trajectories(self.positions, self.time_points,
+                                      chunk_size=8)
+        self.assertEqual(res.shape, (37, 4, 2))
+        for i, (y, x) in enumerate(self.positions):
+            for j, t in enumerate(self.time_points):
+                for axis in range(2):
+                    self.assertAlmostEqual(
+                        res[i, j, axis],
+                        self.model.calculate_shift(y, x, t, axis))
+
+        relative = self.model.trajectories(self.positions, self.time_points,
+                                           reference_time=3)
+        np.testing.assert_array_almost_equal(relative,
+                                             res - res[:, 2:3, :])
+
+        out = np.zeros((37, 4, 2), dtype=np.float32)
+        self.assertIs(self.model.trajectories(self.positions,
+                                              self.time_points, out=out), out)
+        np.testing.assert_array_almost_equal(out, res, 4)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.model.trajectories,
+                          self.positions[:, 0], self.time_points)
+        self.assertRaises(ValueError, self.model.trajectories,
+                          self.positions, self.time_points, chunk_size=0)
+        self.assertRaises(ValueError, self.model.trajectories,
+                          self.positions, self.time_points,
+                          out=np.zeros((37, 3, 2)))
+
+    def test_load_coeffs(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, "coeffs.npy"),
+                     os.path.join(folder, "entry.npz"),
+                     os.path.join(folder, "entry.json")]
+            self.model.save_coeffs(paths[0])
+            np.savez(paths[1], coeffs=self.model.coeffs)
+            with open(paths[2], "w") as f:
+                json.dump({"coeffs": self.model.coeffs.tolist()}, f)
+
+            for path in paths:
+                model = DeformationModel()
+                model.load_coeffs(path)
+                np.testing.assert_array_equal(model.coeffs,
+                                              self.model.coeffs)
+
+            np.save(paths[0], np.zeros((2, 8)))
+            self.assertRaises(ValueError, DeformationModel().load_coeffs,
+                              paths[0])
+
+
+class BatchFitTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        y, x, t = np.meshgrid(np.linspace(0, 100, 4), np.linspace(0, 150, 4),
+                              np.arange(6.0), indexing="ij")
+        self.positions = np.stack((y.ravel(), x.ravel(), t.ravel()), axis=1)
+        self.coeffs = np.array([DeformationModel.generate_random_coeffs(
+            (100, 150), 5, rng) for i in range(4)])
+        # shifts by which is the data corrected, see initialize_model
+        self.shifts = -np.array([[self.model_shifts(c[axis])
+                                  for axis in range(2)]
+                                 for c in self.coeffs])
+        self.noisy = self.shifts + rng.normal(0, 0.3, self.shifts.shape)
+
+    def model_shifts(self, c):
+        p = self.positions
+        return DeformationModel.calculate_shifts_from_coeffs(p[:, 0], p[:, 1],
+                                                             p[:, 2], c)
+
+    def test_exact(self):
+        res = DeformationModel.fit_coeffs_batch(
+            self.positions, self.shifts[:, 0], self.shifts[:, 1])
+        self.assertEqual(res.shape, (4, 2, 9))
+        for m in range(4):
+            for axis in range(2):
+                np.testing.assert_array_almost_equal(
+                    self.model_shifts(res[m, axis]),
+                    -self.shifts[m, axis], 6)
+
+    def test_same_as_initialize_model(self):
+        res = DeformationModel.fit_coeffs_batch(
+            self.positions, self.noisy[:, 0], self.noisy[:, 1])
+        for m in range(4):
+            model = DeformationModel()
+            model.initialize_model(list(self.positions),
+                                   list(self.noisy[m, 0]),
+                                   list(self.noisy[m, 1]))
+            for axis in range(2):
+                np.testing.assert_array_almost_equal(
+                    self.model_shifts(res[m, axis]),
+                    self.model_shifts(model.coeffs[axis]), 4)
+
+    def test_large_frames(self):
+        # 4096 x 4096 frames, powers of the raw coordinates span ~23 orders
+        # of magnitude
+        rng = np.random.default_rng(3)
+        y, x, t = np.meshgrid(np.linspace(410, 3686, 5),
+                              np.linspace(410, 3686, 5), np.arange(20.0),
+                              indexing="ij")
+        self.positions = np.stack((y.ravel(), x.ravel(), t.ravel()), axis=1)
+        coeffs = [DeformationModel.generate_random_coeffs((4096, 4096), 19,
+                                                          rng)
+                  for i in range(2)]
+        shifts = -np.array([[self.model_shifts(c[axis]) for axis in range(2)]
+                            for c in coeffs])
+        noisy = shifts + rng.normal(0, 0.3, shifts.shape)
+
+        res = DeformationModel.fit_coeffs_batch(self.positions, noisy[:, 0],
+                                                noisy[:, 1])
+        for m in range(2):
+            model = DeformationModel()
+            model.initialize_model(list(self.positions), list(noisy[m, 0]),
+                                   list(noisy[m, 1]))
+            for axis in range(2):
+                expected = self.model_shifts(model.coeffs[axis])
+                self.assertLess(np.max(np.abs(expected + shifts[m, axis])),
+                                0.5)
+                np.testing.assert_allclose(
+                    self.model_shifts(res[m, axis]), expected, atol=0.01)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, DeformationModel.fit_coeffs_batch,
+                          self.positions, self.shifts[:, 0, :-1],
+                          self.shifts[:, 1, :-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import gc
+import weakref
+import numpy as np
+import sys
+sys.path.append("..")
+from dose_weighting import DoseWeighter
+from image import Image
+from movie import Movie
+from main import motion_correct_movie
+
+
+class DoseWeighterTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = [rng.random((16, 20)) for i in range(4)]
+
+    def test_zero_dose(self):
+        weighter = DoseWeighter(1.0, dose_per_time=0)
+        for i, f in enumerate(self.frames):
+            weighter.add(f, i)
+        np.testing.assert_array_almost_equal(weighter.result(),
+                                             sum(self.frames))
+
+    def test_weighting(self):
+        weighter = DoseWeighter(1.0, dose_per_time=20)
+        for i, f in enumerate(self.frames):
+            weighter.add(f, i)
+        res = weighter.result()
+        # mean is preserved, high frequencies are dominated by early frames
+        self.assertAlmostEqual(np.mean(res), np.mean(sum(self.frames)))
+        weights = [weighter.frame_weights(t) for t in range(4)]
+        for early, late in zip(weights, weights[1:]):
+            self.assertTrue(np.all(late <= early))
+        self.assertEqual(weights[3][0, 0], 1)
+        self.assertLess(weights[3][8, 10], 0.01)
+
+        # coarser pixels are less damaged
+        weighter.reset(binning=2)
+        weighter.add(self.frames[0], 0)
+        self.assertTrue(np.all(weighter.frame_weights(3) >= weights[3]))
+
+    def test_noise_is_not_amplified(self):
+        rng = np.random.default_rng(1)
+        frames = [rng.standard_normal((64, 64)) for i in range(8)]
+        weighter = DoseWeighter(1.0, dose_per_time=20)
+        for i, f in enumerate(frames):
+            weighter.add(f, i)
+
+        def high_power(data):
+            spectrum = np.fft.rfft2(data)
+            return np.mean(np.abs(spectrum[16:48, 16:]) ** 2)
+
+        # independent noise has the power of the plain sum at every frequency
+        ratio = high_power(weighter.result()) / high_power(sum(frames))
+        self.assertGreater(ratio, 0.7)
+        self.assertLess(ratio, 1.3)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, DoseWeighter, 0)
+        weighter = DoseWeighter(1.0)
+        self.assertRaises(RuntimeError, weighter.result)
+        weighter.add(self.frames[0], 0)
+        self.assertRaises(ValueError, weighter.add, np.zeros((3, 3)), 1)
+
+    def test_motion_correct_movie(self):
+        movie = Movie()
+        for i, f in enumerate(self.frames):
+            movie.add(Image(time_stamp=i, img_data=f))
+        coeffs = np.zeros((2, 9))
+        res = motion_correct_movie(movie, coeffs, verbose=False,
+                                   dose_weighter=DoseWeighter(1.0, 0))
+        np.testing.assert_array_almost_equal(res, sum(self.frames))
+        self.assertEqual(movie.micrographs, [])
+
+    def test_frames_are_released(self):
+        movie = Movie()
+        for i, f in enumerate(self.frames):
+            movie.add(Image(time_stamp=i, img_data=np.copy(f)))
+        sources = [weakref.ref(m.image_data) for m in movie.micrographs]
+        restored = []
+        test = self
+
+        class Tracking(DoseWeighter):
+            def add(self, frame, t):
+                # the previously restored frame is already dropped
+                if restored:
+                    gc.collect()
+                    test.assertIsNone(restored[-1]())
+                restored.append(weakref.ref(frame))
+                super().add(frame, t)
+
+        coeffs = np.zeros((2, 9))
+        coeffs[:, 6] = 0.5
+        res = motion_correct_movie(movie, coeffs, verbose=False,
+                                   dose_weighter=Tracking(1.0, 0))
+        self.assertEqual(res.shape, (16, 20))
+        self.assertEqual(len(restored), 4)
+        gc.collect()
+        self.assertTrue(all(s() is None for s in sources))
+
+
+if __name__ == "__main__":
+    unittest.main()
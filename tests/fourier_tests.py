@@ -0,0 +1,78 @@
+import unittest
+import threading
+import numpy as np
+import sys
+sys.path.append("..")
+import fourier
+
+
+class CorrelateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = fourier.get_backend()
+
+    def tearDown(self):
+        fourier.set_backend(*self.original)
+
+    @staticmethod
+    def direct_correlation(main, template, my, mx):
+        h, w = main.shape
+        res = np.zeros((2 * my + 1, 2 * mx + 1))
+        for ky in range(-my, my + 1):
+            for kx in range(-mx, mx + 1):
+                total = 0.0
+                for y in range(h):
+                    for x in range(w):
+                        if 0 <= y + ky < h and 0 <= x + kx < w:
+                            total += main[y + ky][x + kx] * template[y][x]
+                res[my + ky][mx + kx] = total
+        return res
+
+    def test_backends(self):
+        main = np.random.rand(9, 7)
+        template = np.random.rand(9, 7)
+        expected = self.direct_correlation(main, template, 3, 6)
+
+        backends = ["numpy", "scipy"]
+        if fourier.pyfftw is not None:
+            backends.append("pyfftw")
+        for b in backends:
+            fourier.set_backend(b, 2)
+            # second call reuses cached plans
+            for i in range(2):
+                np.testing.assert_array_almost_equal(
+                    fourier.correlate(main, template, (3, 6)), expected)
+
+    def test_fast_shape(self):
+        self.assertEqual(fourier.fast_shape((97, 64)), (100, 64))
+        for s in fourier.fast_shape((1021, 513)):
+            self.assertTrue(s >= 513)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, fourier.set_backend, "fftpack")
+        with self.assertRaises(ValueError):
+            with fourier.settings("fftpack"):
+                pass
+
+    def test_settings(self):
+        fourier.set_backend("scipy", 3)
+        seen = []
+        with fourier.settings("numpy", 2):
+            self.assertEqual(fourier.get_backend(), ("numpy", 2))
+            # other threads keep the default unless the function is bound
+            for fnc in (fourier.get_backend, fourier.bind(fourier.get_backend)):
+                thread = threading.Thread(target=lambda: seen.append(fnc()))
+                thread.start()
+                thread.join()
+        self.assertEqual(seen, [("scipy", 3), ("numpy", 2)])
+        self.assertEqual(fourier.get_backend(), ("scipy", 3))
+
+    def test_bind_divides_workers(self):
+        fourier.set_backend("scipy", 8)
+        self.assertEqual(fourier.bind(fourier.get_backend, 3)(), ("scipy", 2))
+        self.assertEqual(fourier.bind(fourier.get_backend, 16)(), ("scipy", 1))
+        self.assertEqual(fourier.get_backend(), ("scipy", 8))
+
+
+if __name__ == "__main__":
+    unittest.main()
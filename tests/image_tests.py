@@ -0,0 +1,101 @@
+import unittest
+import numpy as np
+import sys
+sys.path.append("..")
+from image import Image
+
+
+class GatherScatterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Image(time_stamp=0,
+                         img_data=np.arange(12, dtype=float).reshape(3, 4))
+
+    def test_gather_pixels(self):
+        y = np.array([0, 2, -1, 3, 1])
+        x = np.array([0, 3, 1, 1, -2])
+        np.testing.assert_array_equal(self.img.gather(y, x), [0, 11, 0, 0, 0])
+        np.testing.assert_array_equal(self.img.gather(y, x, cval=-1),
+                                      [0, 11, -1, -1, -1])
+        np.testing.assert_array_equal(self.img.gather(y, x, "nearest"),
+                                      [0, 11, 1, 9, 4])
+        # d c b a | a b c d | d c b a
+        np.testing.assert_array_equal(self.img.gather(y, x, "reflect"),
+                                      [0, 11, 1, 9, 5])
+        np.testing.assert_array_equal(self.img.gather(y, x, "wrap"),
+                                      [0, 11, 9, 1, 6])
+        for yi, xi in zip(y, x):
+            self.assertEqual(self.img.gather(yi, xi), self.img.get(yi, xi))
+
+        self.assertRaises(ValueError, self.img.gather, y, x, "mirror")
+
+    def test_gather_bilinear(self):
+        y = np.array([0.5, 1.25, 2.5])
+        x = np.array([0.5, 2.0, 3.0])
+        np.testing.assert_array_almost_equal(self.img.gather(y, x),
+                                             [2.5, 7.0, 5.5])
+        np.testing.assert_array_almost_equal(
+            self.img.gather(y, x, "nearest"), [2.5, 7.0, 11.0])
+
+        # positions are in twice greater resolution
+        np.testing.assert_array_almost_equal(
+            self.img.gather(np.array([1.5]), np.array([2.0]),
+                            resolution_scaling_factor=2), [3.0])
+
+    def test_scatter(self):
+        self.img.scatter(np.array([0, 2, 5]), np.array([1, 3, 0]),
+                         np.array([-1, -2, -3]))
+        self.assertEqual(self.img.get(0, 1), -1)
+        self.assertEqual(self.img.get(2, 3), -2)
+        self.assertEqual(self.img.image_data.sum(), 66 - 1 - 11 - 1 - 2)
+
+        self.img.scatter([0, 0], [0, 0], 1.0, accumulate=True)
+        self.assertEqual(self.img.get(0, 0), 2)
+
+        self.img.scatter([-1], [-1], 100.0, "wrap")
+        self.assertEqual(self.img.get(2, 3), 100)
+
+        # fractional positions are split among the neighbours, parts
+        # outside of the image are lost
+        img = Image(time_stamp=0, img_data=np.zeros((3, 3)))
+        img.scatter(np.array([0.5, 2.5]), np.array([1.0, 0.25]), 4.0)
+        np.testing.assert_array_almost_equal(
+            img.image_data, [[0, 2, 0], [0, 2, 0], [1.5, 0.5, 0]])
+
+    def test_scatter_copies_shared_data(self):
+        shared = Image()
+        shared.initialize_with_image(self.img)
+        shared.scatter([0], [0], 5.0)
+        self.assertEqual(shared.get(0, 0), 5)
+        self.assertEqual(self.img.get(0, 0), 0)
+
+    def test_writing_original_copies_shared_data(self):
+        shared = Image()
+        shared.initialize_with_image(self.img)
+        self.img.set(1, 2, 7.0)
+        self.img.scatter([0], [0], 5.0)
+        self.assertEqual(self.img.get(1, 2), 7)
+        self.assertEqual(self.img.get(0, 0), 5)
+        self.assertEqual(shared.get(1, 2), 6)
+        self.assertEqual(shared.get(0, 0), 0)
+
+    def test_add_grid(self):
+        img = Image(time_stamp=0, img_data=np.ones((10, 12)))
+        img.add_grid(grid_size=1, grid_spacing=3)
+        expected = np.ones((10, 12))
+        for yi in range(10):
+            for xi in range(12):
+                if (xi + 3) % 4 < 1 or (yi + 3) % 4 < 1:
+                    expected[yi][xi] = 0.0
+        np.testing.assert_array_equal(img.image_data, expected)
+
+    def test_shift_part(self):
+        self.img.shift_part(1, 0, 3, 2, 1, 1, -1)
+        np.testing.assert_array_equal(self.img.image_data,
+                                      [[0, -1, -1, 3],
+                                       [4, -1, 1, 2],
+                                       [8, 9, 5, 6]])
+
+
+if __name__ == "__main__":
+    unittest.main()
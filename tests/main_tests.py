@@ -0,0 +1,164 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+import numpy as np
+import skimage.io
+from scipy import ndimage
+import sys
+sys.path.append("..")
+import copy_tracking
+import main
+import my_math
+from image import Image
+from movie import Movie
+import mrc_io
+
+
+class DeformFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "source.png")
+        data = np.random.default_rng(0).integers(0, 255, (60, 80))
+        skimage.io.imsave(self.path, data.astype(np.uint8))
+        self.time_points = [0, 1, 2]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stream(self):
+        written = []
+        frames, coeffs = main.deform_file_stream(
+            self.path, (30, 40), self.time_points,
+            sink=lambda t, frame: written.append(t), verbose=False)
+        self.assertEqual(np.shape(coeffs), (2, 9))
+        # nothing is computed before iteration
+        self.assertEqual(written, [])
+
+        streamed = []
+        for t, frame in frames:
+            self.assertEqual(written[-1], t)
+            streamed.append(frame)
+        self.assertEqual(written, self.time_points)
+
+        results, _ = main.deform_file(self.path, (30, 40), self.time_points,
+                                      coeffs, verbose=False)
+        for s, r in zip(streamed, results):
+            np.testing.assert_array_equal(s, r)
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as folder:
+            results, _ = main.deform_file(self.path, (30, 40),
+                                          self.time_points, save=folder,
+                                          verbose=False)
+            movie = mrc_io.read(os.path.join(folder, "movie.mrc"))
+            np.testing.assert_array_almost_equal(movie, results, 4)
+            for t in self.time_points:
+                self.assertTrue(os.path.exists(os.path.join(
+                    folder, "DeformationTime" + str(t) + ".png")))
+
+    def test_aborted_save(self):
+        def progress(stage, done, total):
+            if done == 2:
+                raise RuntimeError("cancelled")
+
+        with tempfile.TemporaryDirectory() as folder:
+            self.assertRaises(RuntimeError, main.deform_file, self.path,
+                              (30, 40), self.time_points, save=folder,
+                              verbose=False, progress=progress)
+            # no partial movie is left behind
+            self.assertEqual(sorted(os.listdir(folder)),
+                             ["DeformationTime0.png", "DeformationTime1.png"])
+
+    def test_frames_are_owned(self):
+        results, _ = main.deform_file(self.path, (30, 40), self.time_points,
+                                      verbose=False)
+        for frame in results:
+            self.assertTrue(frame.flags.writeable)
+
+
+class ProgressiveTest(unittest.TestCase):
+
+    @staticmethod
+    def movie():
+        rng = np.random.default_rng(1)
+        data = ndimage.gaussian_filter(rng.standard_normal((64, 64)), 2)
+        shifts = [(0, 0), (4, -8), (-8, 4)]
+        movie = Movie()
+        for i, (y, x) in enumerate(shifts):
+            movie.add(Image(time_stamp=i, img_data=np.roll(data, (y, x),
+                                                           axis=(0, 1))))
+        return movie
+
+    def test_previews(self):
+        movie = self.movie()
+        previews = []
+        events = []
+        with mock.patch.object(main.DeformationModel, "apply_model",
+                               autospec=True,
+                               side_effect=main.DeformationModel.apply_model
+                               ) as apply_model:
+            res = main.motion_correct_movie(
+                movie, np.zeros((2, 9)), verbose=False,
+                preview=lambda stage, d: (previews.append((stage, d)),
+                                          events.append("preview " + stage)),
+                preview_binning=4,
+                progress=lambda stage, done, total: events.append(stage))
+        self.assertEqual([p[0] for p in previews],
+                         ["global", "local", "final"])
+        self.assertEqual(previews[0][1].shape, (16, 16))
+        self.assertEqual(previews[1][1].shape, (16, 16))
+        self.assertIs(previews[2][1], res)
+        # one binned pass for the preview, one full resolution pass
+        self.assertEqual(apply_model.call_count, 6)
+        binnings = [c.kwargs["binning"] for c in apply_model.call_args_list]
+        self.assertEqual(binnings, [4] * 3 + [1] * 3)
+        # the "local" preview does not wait for the restoration
+        self.assertLess(events.index("preview local"),
+                        events.index("restore"))
+        np.testing.assert_array_almost_equal(previews[1][1],
+                                             my_math.bin_data(res, 4),
+                                             decimal=0)
+
+        # the frames are aligned to each other
+        aligned = [m.image_data for m in movie.micrographs]
+        for d in aligned[1:]:
+            np.testing.assert_array_almost_equal(d[12:-12, 12:-12],
+                                                 aligned[0][12:-12, 12:-12])
+
+    def test_low_memory_preview(self):
+        movie = self.movie()
+        movie.low_memory = True
+        frames = [m.image_data for m in movie.micrographs]
+        copy_tracking.enable()
+        try:
+            with copy_tracking.stage("global"):
+                y_shifts, x_shifts, _ = movie.coarse_global_shift(4)
+                movie.correct_global_shift((y_shifts, x_shifts), 4)
+            copies = copy_tracking.report()
+        finally:
+            copy_tracking.enable(False)
+        # corrected in place, without shifted copies
+        self.assertEqual(copies, {})
+        for d, m in zip(frames, movie.micrographs):
+            self.assertIs(d, m.image_data)
+        for m in movie.micrographs[1:]:
+            np.testing.assert_array_almost_equal(
+                m.image_data[12:-12, 12:-12],
+                movie.micrographs[0].image_data[12:-12, 12:-12])
+
+    def test_coarse_alignment_mode(self):
+        movie = self.movie()
+        movie.alignment_mode = "all_pairs"
+        movie.group_size = 2
+        y_shifts, x_shifts, aligned = movie.coarse_global_shift(4)
+        self.assertEqual(len(y_shifts), 3)
+        self.assertEqual(aligned.shape, (16, 16))
+
+        movie.alignment_mode = "random"
+        self.assertRaises(ValueError, movie.coarse_global_shift, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,16 @@
 import unittest
 import random
 import numpy as np
+from unittest import mock
 import sys
 sys.path.append("..")
+import fourier
 from movie import Movie
 from image import Image
 import math
+import os
+import tempfile
+import skimage.io
 
 
 class GlobalShiftTest(unittest.TestCase):
@@ -86,6 +91,73 @@ class GlobalShiftTest(unittest.TestCase):
             shift = Movie.one_on_one_shift(data[3], data[1])
             self.assertEqual(shift, (1.0, 6.0))
 
+    def test_windowed_one_on_one_shift(self):
+        size = 15
+        data = [np.zeros((size, size), dtype=float) for d in range(3)]
+        data[0] = self.add_square(data[0], 7, 7, 4)
+        data[1] = self.add_square(data[1], 5, 8, 4)
+        data[2] = self.add_square(data[2], 2, 1, 4)
+
+        for main, template in [(0, 0), (0, 1), (1, 0), (1, 2), (2, 1)]:
+            self.assertEqual(
+                Movie.one_on_one_shift(data[main], data[template], 8),
+                Movie.one_on_one_shift(data[main], data[template]))
+
+        # real shift is outside of the window
+        shift = Movie.one_on_one_shift(data[0], data[2], 3)
+        self.assertTrue(max(abs(shift[0]), abs(shift[1])) <= 3)
+
+    def test_align_stack_statistics(self):
+        size = 15
+        data = [np.zeros((size, size), dtype=float) for d in range(4)]
+        positions = [(7, 7), (6, 7), (7, 5), (8, 8)]
+        for i, p in enumerate(positions):
+            data[i] = self.add_square(data[i], *p, 4)
+        inputs = list(data)
+        original = [np.copy(d) for d in data]
+
+        y_shifts, x_shifts, stats = Movie.align_stack(data, max_shift=3)
+        # items are replaced, the arrays passed in are never written to
+        for d, o in zip(inputs, original):
+            self.assertTrue(np.array_equal(d, o))
+        shifted = [(p[0] - y_shifts[i], p[1] - x_shifts[i])
+                   for i, p in enumerate(positions)]
+        self.assertTrue(all(map(lambda x: x == shifted[0], shifted)))
+
+        self.assertEqual(stats[0]["aligned"], len(data))
+        self.assertEqual(stats[-1]["max_change"], 0)
+        # converged frames are not aligned again
+        for prev, curr in zip(stats, stats[1:]):
+            self.assertLessEqual(curr["aligned"], prev["aligned"])
+
+    def test_aborted_align_stack(self):
+        data = [np.roll(self.add_square(np.zeros((15, 15)), 7, 7, 4), i, 0)
+                for i in range(3)]
+        events = []
+
+        def progress(stage, done, total):
+            events.append((stage, done, total))
+            raise RuntimeError("cancelled")
+
+        self.assertRaises(RuntimeError, Movie.align_stack, data,
+                          max_iterations=5, progress=progress)
+        self.assertEqual(events, [("global", 1, 5)])
+
+    def test_low_memory_align_stack(self):
+        size = 15
+        data = [np.zeros((size, size), dtype=float) for d in range(4)]
+        positions = [(7, 7), (3, 7), (7, 3), (2, 1)]
+        for i, p in enumerate(positions):
+            data[i] = self.add_square(data[i], *p, 4)
+        original = [np.copy(d) for d in data]
+
+        y_shifts, x_shifts, _ = Movie.align_stack(data, low_memory=True)
+        for d, o in zip(data, original):
+            self.assertTrue(np.array_equal(d, o))
+
+        expected = Movie.relative_shifts(data)
+        self.assertEqual((y_shifts, x_shifts), expected)
+
     def test_clean_relative_shifts(self):
         size = 15
         data = [np.zeros((size, size), dtype=float) for d in range(4)]
@@ -101,6 +173,76 @@ class GlobalShiftTest(unittest.TestCase):
 
         self.assertTrue(all(map(lambda x: x == shifted[0], shifted)))
 
+    def test_reference_shifts(self):
+        size = 15
+        positions = [(7, 7), (3, 7), (7, 3), (2, 1)]
+        data = [self.add_square(np.zeros((size, size)), *p, 4)
+                for p in positions]
+
+        y, x = Movie.reference_shifts(data, 0, workers=2)
+        self.assertEqual((y[0], x[0]), (0, 0))
+        shifted = [(p[0] - y[i], p[1] - x[i]) for i, p in enumerate(positions)]
+        self.assertTrue(all(s == positions[0] for s in shifted))
+
+    def test_alignment_threads(self):
+        self.assertEqual(Movie.alignment_threads(4, 10), 4)
+        self.assertEqual(Movie.alignment_threads(4, 2), 2)
+        self.assertEqual(Movie.alignment_threads(None, 100),
+                         min(32, (os.cpu_count() or 1) + 4))
+
+        # each thread gets its share of the FFT workers
+        backend = fourier.get_backend()
+        fourier.set_backend("scipy", 4)
+        try:
+            with mock.patch.object(Movie, "one_on_one_shift",
+                                   side_effect=lambda *args: (
+                                       fourier.get_backend()[1], 0)):
+                y, _ = Movie.reference_shifts([np.zeros((4, 4))] * 3,
+                                              workers=2)
+        finally:
+            fourier.set_backend(*backend)
+        self.assertEqual(y, [2, 2, 2])
+
+    def test_pairwise_shifts(self):
+        size = 15
+        positions = [(7, 7), (3, 7), (7, 3), (2, 1), (5, 6)]
+        data = [self.add_square(np.zeros((size, size)), *p, 4)
+                for p in positions]
+
+        for window in (None, 1, 2):
+            y, x = Movie.pairwise_shifts(data, window=window, workers=2)
+            self.assertAlmostEqual(np.mean(y), 0)
+            self.assertAlmostEqual(np.mean(x), 0)
+            shifted = np.array([(p[0] - y[i], p[1] - x[i])
+                                for i, p in enumerate(positions)])
+            np.testing.assert_array_almost_equal(
+                shifted, np.repeat(shifted[:1], len(positions), axis=0))
+
+        self.assertRaises(ValueError, Movie.pairwise_shifts, data, window=0)
+
+    def test_group_frames(self):
+        data = [np.full((2, 3), i, dtype=float) for i in range(5)]
+        times = [0, 1, 2, 3, 4]
+
+        sums, group_times = Movie.group_frames(data, times, 2)
+        self.assertEqual([s[0, 0] for s in sums], [1, 5, 4])
+        self.assertEqual(group_times, [0.5, 2.5, 4])
+
+        sums, group_times = Movie.group_frames(data, times, 3, "sliding")
+        self.assertEqual([s[0, 0] for s in sums], [3, 6, 9])
+        self.assertEqual(group_times, [1, 2, 3])
+
+        self.assertRaises(ValueError, Movie.group_frames, data, times, 0)
+        self.assertRaises(ValueError, Movie.group_frames, data, times, 2,
+                          "random")
+
+    def test_interpolate_shifts(self):
+        res = Movie.interpolate_shifts([0.5, 2.5, 4.5], [1, 3, 7],
+                                       [0, 1, 2, 3, 4, 5])
+        np.testing.assert_array_almost_equal(res, [0.5, 1.5, 2.5, 4, 6, 8])
+        self.assertEqual(Movie.interpolate_shifts([1], [2], [0, 1, 2]),
+                         [2, 2, 2])
+
 
 class ShiftCorrectionTest(unittest.TestCase):
 
@@ -144,13 +286,113 @@ class ShiftCorrectionTest(unittest.TestCase):
             movie.add(img)
 
         movie.correct_global_shift()
+        self.check_global_correction(movie, len(data), square_size)
 
+    def test_low_memory_global_shift_correction(self):
+        size = 15
+        square_size = 4
+        positions = [(7, 7), (3, 7), (7, 3), (2, 1)]
+        movie = Movie()
+        movie.low_memory = True
+        for i, p in enumerate(positions):
+            img = Image()
+            img.image_data = GlobalShiftTest.add_square(
+                np.zeros((size, size), dtype=float), *p, square_size)
+            img.time_stamp = i
+            movie.add(img)
+        data = [m.image_data for m in movie.micrographs]
+
+        movie.correct_global_shift()
+        for d, m in zip(data, movie.micrographs):
+            self.assertIs(d, m.image_data)  # corrected in place
+        self.check_global_correction(movie, len(data), square_size)
+
+    def test_low_memory_keeps_shared_frames(self):
+        size = 15
+        positions = [(7, 7), (3, 7)]
+        movie = Movie()
+        movie.low_memory = True
+        for i, p in enumerate(positions):
+            movie.add(Image(time_stamp=i, img_data=GlobalShiftTest.add_square(
+                np.zeros((size, size), dtype=float), *p, 4)))
+        shared = Image()
+        shared.initialize_with_image(movie.micrographs[1])
+        original = np.copy(shared.image_data)
+
+        movie.apply_shifts([0, -4], [0, 0])
+        self.assertTrue(np.array_equal(shared.image_data, original))
+        self.assertFalse(np.array_equal(movie.micrographs[1].image_data,
+                                        original))
+
+    def test_alignment_modes(self):
+        size = 15
+        square_size = 4
+        positions = [(7, 7), (3, 7), (7, 3), (2, 1)]
+        movie = Movie()
+        movie.alignment_mode = "reference"
+        movie.reference_frame = 0
+        for i, p in enumerate(positions):
+            img = Image()
+            img.image_data = GlobalShiftTest.add_square(
+                np.zeros((size, size), dtype=float), *p, square_size)
+            img.time_stamp = i
+            movie.add(img)
+
+        movie.correct_global_shift()
+        self.check_global_correction(movie, len(positions), square_size)
+
+        movie.alignment_mode = "random"
+        self.assertRaises(ValueError, movie.correct_global_shift)
+
+    def test_grouped_global_shift_correction(self):
+        # square moving with constant speed, so that the interpolated shifts
+        # of the groups are exact
+        size = 20
+        square_size = 4
+        movie = Movie()
+        movie.group_size = 2
+        for i in range(6):
+            img = Image()
+            img.image_data = GlobalShiftTest.add_square(
+                np.zeros((size, size), dtype=float), 4 + 2 * i, 8,
+                square_size)
+            img.time_stamp = i
+            movie.add(img)
+
+        y_shifts, x_shifts = movie.correct_global_shift()
+        np.testing.assert_array_almost_equal(np.diff(y_shifts), [2] * 5)
+        np.testing.assert_array_almost_equal(x_shifts, [0] * 6)
+        self.check_global_correction(movie, 6, square_size)
+
+    def test_binned_global_shift_correction(self):
+        # shifts are even, so that they are found exactly on binned data
+        size = 24
+        square_size = 4
+        positions = [(10, 10), (6, 10), (10, 4), (2, 14)]
+        movie = Movie()
+        movie.alignment_binning = 2
+        for i, p in enumerate(positions):
+            img = Image()
+            img.image_data = GlobalShiftTest.add_square(
+                np.zeros((size, size), dtype=float), *p, square_size)
+            img.time_stamp = i
+            movie.add(img)
+
+        y_shifts, x_shifts = movie.correct_global_shift()
+        np.testing.assert_array_almost_equal(np.diff(y_shifts),
+                                             [-4, 4, -8])
+        np.testing.assert_array_almost_equal(np.diff(x_shifts),
+                                             [0, -6, 10])
+        self.assertEqual(movie.micrographs[0].image_data.shape, (size, size))
+        self.check_global_correction(movie, len(positions), square_size)
+
+    def check_global_correction(self, movie, frame_count, square_size):
         sum_image = movie.sum_images()
 
         peak_count = 0
         for v in np.nditer(sum_image):
-            self.assertTrue(math.isclose(v, 0, abs_tol=1e-6) or math.isclose(v, len(data), abs_tol=1e-6))
-            if math.isclose(v, len(data), abs_tol=1e-6):
+            self.assertTrue(math.isclose(v, 0, abs_tol=1e-6) or math.isclose(v, frame_count, abs_tol=1e-6))
+            if math.isclose(v, frame_count, abs_tol=1e-6):
                 peak_count += 1
         self.assertEqual(peak_count, square_size*square_size)
 
@@ -224,6 +466,15 @@ class LocalShiftsTest(unittest.TestCase):
 
         self.partitioning_test(6, 89)
 
+    def test_partitioning_size(self):
+        data = [np.zeros((20, 13), dtype=float) for d in range(2)]
+        movie = Movie()
+        movie.partitions_size = 3
+        res = movie.partition(data)
+        self.assertEqual(len(res), 9)
+        self.assertEqual(res[0][0].shape, (7, 5))
+        self.assertEqual(res[8][1].shape, (6, 4))
+
     def test_calculate_local_shifts(self):
         size_y = 233
         size_x = 158
@@ -262,6 +513,152 @@ class LocalShiftsTest(unittest.TestCase):
 
         self.assertTrue(True)
 
+    def test_binned_local_positions(self):
+        movie = Movie()
+        for i in range(2):
+            movie.add(Image(time_stamp=i, img_data=np.zeros((40, 50))))
+        pos = movie.calculate_local_shifts()[0]
+        movie.alignment_binning = 2
+        binned = movie.calculate_local_shifts()[0]
+        # binned data are split into 4x5 patches with centres at binned pixel
+        # (2, 2), i.e. between full resolution pixels 4 and 5
+        self.assertEqual(pos[0], (4, 5, 0))
+        self.assertEqual(binned[0], (4.5, 4.5, 0))
+        self.assertEqual(binned[6], (12.5, 14.5, 0))
+
+    def test_calculate_grouped_local_shifts(self):
+        movie = Movie()
+        for i in range(4):
+            img = Image()
+            img.time_stamp = i
+            img.image_data = np.zeros((233, 158), dtype=float)
+            movie.add(img)
+        pos, s_y, s_x = movie.calculate_local_shifts()
+
+        # grouped frames still give shift for each frame
+        movie.group_size = 3
+        grouped = movie.calculate_local_shifts()
+        self.assertEqual(grouped[0], pos)
+        self.assertEqual(len(grouped[1]), len(s_y))
+        self.assertEqual(len(grouped[2]), len(s_x))
+        self.assertEqual(len(movie.local_statistics), 25)
+
+    def test_local_shifts_progress(self):
+        movie = Movie()
+        for i in range(3):
+            movie.add(Image(time_stamp=i, img_data=np.zeros((50, 50))))
+        events = []
+        movie.calculate_local_shifts(lambda *event: events.append(event))
+        self.assertEqual(events, [("local", i, 25) for i in range(1, 26)])
+
+
+class StarFileTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        movie = Movie()
+        for i in range(12):
+            img = Image()
+            img.time_stamp = i * 0.5
+            img.image_data = np.random.rand(6, 9)
+            movie.add(img)
+
+        with tempfile.TemporaryDirectory() as folder:
+            movie.save_movie_starfile(folder, "frame", workers=4)
+            loaded = Movie()
+            loaded.load_movie_starfile(os.path.join(folder, "frame.xmd"),
+                                       workers=4)
+
+        self.assertEqual(len(loaded.micrographs), len(movie.micrographs))
+        for orig, res in zip(movie.micrographs, loaded.micrographs):
+            self.assertEqual(orig.time_stamp, res.time_stamp)
+            np.testing.assert_array_almost_equal(orig.image_data,
+                                                 res.image_data, 6)
+
+    def test_missing_labels(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "broken.xmd")
+            with open(path, "w") as f:
+                f.write("data_movie_stack\nloop_\n  _image\n  a.mrc\n")
+            with self.assertRaisesRegex(ValueError, "missing _time label"):
+                Movie.read_starfile(path)
+
+            # labels of the previous loop don't apply
+            with open(path, "w") as f:
+                f.write("data_movie_stack\nloop_\n  _image\n  _time\n"
+                        "  a.mrc 0.0\nloop_\n  _time\n  1.0\n")
+            with self.assertRaisesRegex(ValueError, "missing _image label"):
+                Movie.read_starfile(path)
+
+            with open(path, "w") as f:
+                f.write("data_movie_stack\n")
+            self.assertRaises(ValueError, Movie.read_starfile, path)
+
+            with open(path, "w") as f:
+                f.write("data_movie_stack\nloop_\n  _image\n  _time\n"
+                        "  a.mrc\n")
+            with self.assertRaisesRegex(ValueError, "has 1 values instead"):
+                Movie.read_starfile(path)
+
+    def test_data_block_ends_loop(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "blocks.xmd")
+            with open(path, "w") as f:
+                f.write("data_movie_stack\nloop_\n  _image\n  _time\n"
+                        "  a.mrc 0.0\n  b.mrc 1.5\n\ndata_general\n"
+                        "_dose 2.0\n")
+            self.assertEqual(Movie.read_starfile(path),
+                             (["a.mrc", "b.mrc"], [0.0, 1.5]))
+
+
+class ImageSequenceTest(unittest.TestCase):
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            frames = [np.random.randint(0, 255, (7, 10), dtype=np.uint8)
+                      for i in range(5)]
+            paths = [os.path.join(folder, str(i) + ".png") for i in range(5)]
+            for p, f in zip(paths, frames):
+                skimage.io.imsave(p, f, check_contrast=False)
+
+            movie = Movie()
+            events = []
+            movie.load_image_sequence(
+                paths, [0, 1, 2, 3, 4], workers=3,
+                progress=lambda *event: events.append(event))
+
+        self.assertEqual(len(movie.micrographs), 5)
+        for i, (img, f) in enumerate(zip(movie.micrographs, frames)):
+            self.assertEqual(img.time_stamp, i)
+            np.testing.assert_array_equal(img.image_data, f)
+        self.assertEqual(events, [("load", i, 5) for i in range(1, 6)])
+
+    def test_aborted_load(self):
+        def progress(stage, done, total):
+            if done == 2:
+                raise RuntimeError("cancelled")
+
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, str(i) + ".png") for i in range(4)]
+            for p in paths:
+                skimage.io.imsave(p, np.zeros((5, 5), dtype=np.uint8),
+                                  check_contrast=False)
+            movie = Movie()
+            self.assertRaises(RuntimeError, movie.load_image_sequence, paths,
+                              [0, 1, 2, 3], workers=1, progress=progress)
+        self.assertEqual(movie.micrographs, [])
+
+    def test_invalid(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, str(i) + ".png") for i in range(3)]
+            for i, p in enumerate(paths):
+                skimage.io.imsave(p, np.zeros((5, 5 + i), dtype=np.uint8),
+                                  check_contrast=False)
+
+            self.assertRaises(RuntimeError, Movie().load_image_sequence,
+                              paths[:2], [0, 0])
+            self.assertRaises(RuntimeError, Movie().load_image_sequence,
+                              paths, [0, 1, 2])
+
 
 if __name__ == "__main__":
     unittest.main()
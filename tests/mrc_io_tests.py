@@ -0,0 +1,105 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import mrcfile as mrc
+import sys
+sys.path.append("..")
+import mrc_io
+
+
+class MrcIoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data.mrc")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_formats(self):
+        data = np.random.rand(3, 10, 12) * 100 - 20
+        # maximal error relative to the range of the data
+        tolerances = {"float32": 1e-6, "float16": 1e-3, "int16": 1e-4,
+                      "uint16": 1e-4, "int8": 1e-2}
+        modes = {"float32": 2, "float16": 12, "int16": 1, "uint16": 6,
+                 "int8": 0}
+        for data_format in mrc_io.FORMATS:
+            mrc_io.write(self.path, data, data_format)
+            with mrc.open(self.path) as f:
+                self.assertEqual(f.header.mode, modes[data_format])
+                self.assertTrue(f.is_image_stack())
+
+            loaded = mrc_io.read(self.path)
+            # stored precision is kept, no float64 copy
+            self.assertEqual(loaded.dtype, np.float32)
+            self.assertTrue(loaded.flags.writeable)
+            self.assertLess(np.max(np.abs(loaded - data)) / 100,
+                            tolerances[data_format])
+
+    def test_compression(self):
+        data = np.random.rand(20, 40)
+        for compression in mrc_io.COMPRESSIONS:
+            # small chunks, so that the file consists of several members
+            chunk_size = mrc_io.CHUNK_SIZE
+            mrc_io.CHUNK_SIZE = 1000
+            try:
+                mrc_io.write(self.path, data, "int16", compression, 3)
+            finally:
+                mrc_io.CHUNK_SIZE = chunk_size
+
+            self.assertTrue(mrc_io.is_compressed(self.path))
+            np.testing.assert_array_almost_equal(mrc_io.read(self.path),
+                                                 data, 4)
+
+    def test_failed_compression(self):
+        def broken(chunk):
+            raise OSError("disk full")
+
+        mrc_io.write(self.path, np.zeros((4, 5)))
+        mrc_io.COMPRESSIONS["broken"] = broken
+        try:
+            self.assertRaises(OSError, mrc_io.write, self.path,
+                              np.ones((4, 5)), "float32", "broken")
+        finally:
+            del mrc_io.COMPRESSIONS["broken"]
+        # the previous file is untouched and no temporary file is left
+        np.testing.assert_array_equal(mrc_io.read(self.path), 0)
+        self.assertEqual(os.listdir(self.tmp.name), ["data.mrc"])
+
+    def test_constant_data(self):
+        data = np.full((4, 5), 7.0)
+        mrc_io.write(self.path, data, "uint16")
+        np.testing.assert_array_equal(mrc_io.read(self.path), data)
+
+    def test_stack_writer(self):
+        data = np.random.rand(3, 10, 12)
+        for compression in (None, "gzip"):
+            with mrc_io.StackWriter(self.path, 3,
+                                    compression=compression) as writer:
+                for frame in data:
+                    writer.write(frame)
+                self.assertFalse(os.path.exists(self.path))
+                self.assertRaises(RuntimeError, writer.write, data[0])
+            np.testing.assert_array_almost_equal(mrc_io.read(self.path),
+                                                 data, 6)
+            os.remove(self.path)
+
+        writer = mrc_io.StackWriter(self.path, 3, (10, 12), "float16")
+        writer.write(data[0])
+        self.assertRaises(RuntimeError, writer.close)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+        self.assertRaises(ValueError, mrc_io.StackWriter, self.path, 3,
+                          (10, 12), "int16")
+
+    def test_invalid_arguments(self):
+        data = np.zeros((4, 5))
+        self.assertRaises(ValueError, mrc_io.write, self.path, data, "int32")
+        self.assertRaises(ValueError, mrc_io.write, self.path, data,
+                          "float32", "zip")
+
+
+if __name__ == "__main__":
+    unittest.main()
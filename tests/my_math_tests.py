@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import sys
 sys.path.append("..")
 import my_math
@@ -30,5 +31,15 @@ class LinearInterpolationTest(unittest.TestCase):
             ), item[-1])
 
 
+class BinDataTest(unittest.TestCase):
+
+    def test_bin_data(self):
+        data = np.arange(20.0).reshape(4, 5)
+        np.testing.assert_array_equal(my_math.bin_data(data, 1), data)
+        np.testing.assert_array_equal(my_math.bin_data(data, 2),
+                                      [[3, 5], [13, 15]])
+        self.assertEqual(my_math.bin_data(data, 3).shape, (1, 1))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import mrcfile as mrc
+import sys
+sys.path.append("..")
+import my_math
+from movie import Movie
+from preprocessing import Preprocessor
+
+
+class PreprocessorTest(unittest.TestCase):
+
+    def test_gain_and_dark(self):
+        data = np.random.rand(6, 8)
+        gain = np.random.rand(6, 8)
+        dark = np.random.rand(6, 8)
+
+        res = Preprocessor(gain=gain, dark=dark)(data)
+        np.testing.assert_array_almost_equal(res, (data - dark) * gain)
+        self.assertRaises(ValueError, Preprocessor(gain=gain),
+                          np.zeros((5, 8)))
+
+    def test_defects(self):
+        data = np.ones((5, 6))
+        data[2][3] = 1000.0  # hot pixel
+        data[0][0] = 0.0  # dead pixel
+        data[0][1] = 3.0
+        mask = np.zeros(data.shape, dtype=bool)
+        mask[0][0] = True
+
+        res = Preprocessor(defect_mask=mask, hot_pixel_sigma=4)(data)
+        self.assertEqual(res[2][3], 1.0)
+        self.assertEqual(res[0][0], 1.0)  # median of 3, 1, 1
+        self.assertEqual(res[0][1], 3.0)
+        self.assertEqual(data[2][3], 1000.0)  # input is not modified
+
+    def test_binning(self):
+        data = np.random.rand(8, 12)
+        res = Preprocessor(binning=2)(data)
+        np.testing.assert_array_almost_equal(res, my_math.bin_data(data, 2))
+
+        res = Preprocessor(binning=2, binning_mode="fourier")(data)
+        self.assertEqual(res.shape, (4, 6))
+        self.assertAlmostEqual(res.mean(), data.mean())
+
+        # low frequencies are kept intact
+        y, x = np.mgrid[0:16, 0:16]
+        smooth = np.cos(2 * np.pi * y / 16) + np.sin(2 * np.pi * x / 16)
+        np.testing.assert_array_almost_equal(
+            Preprocessor(binning=2, binning_mode="fourier")(smooth),
+            smooth[::2, ::2])
+
+    def test_movie_loading(self):
+        data = np.random.rand(3, 8, 10).astype(np.float32)
+        gain = np.random.rand(8, 10)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "movie.mrc")
+            with mrc.new(path) as f:
+                f.set_data(data)
+
+            movie = Movie()
+            movie.preprocessor = Preprocessor(gain=gain, binning=2)
+            movie.load_compact_mrc(path, [0, 1, 2])
+
+        for d, m in zip(data, movie.micrographs):
+            np.testing.assert_array_almost_equal(
+                m.image_data, my_math.bin_data(d * gain, 2), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()